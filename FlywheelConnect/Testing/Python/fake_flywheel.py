@@ -0,0 +1,715 @@
+"""
+In-process stand-in for the flywheel SDK, serving a synthetic hierarchy.
+
+The hierarchy of a FakeServer has one group and one project holding N subjects x M
+sessions, each session holding one acquisition with K files. Every request sleeps
+for the configured latency and every transfer for its size over the configured
+bandwidth, so that the module can be timed end to end without a Flywheel instance.
+
+Files are served over HTTP from a local port at the download urls of the Flywheel
+API, with range requests, so that clients with an API key download them as from a
+real instance. Install a server and use this module in place of the flywheel
+module:
+
+    fake_flywheel.install(fake_flywheel.FakeServer(subjects=10, sessions=2))
+    client = fake_flywheel.Client("any api key")
+    ...
+    fake_flywheel.SERVER.close()
+"""
+import datetime
+import hashlib
+import http.server
+import io
+import re
+import threading
+import time
+import urllib.parse
+import zipfile
+from pathlib import Path
+
+try:
+    import numpy as np
+    import pydicom
+    from pydicom.dataset import Dataset, FileMetaDataset
+    from pydicom.uid import ExplicitVRLittleEndian, generate_uid
+except ImportError:
+    pydicom = None
+
+# Server used by the clients created with Client()
+SERVER = None
+
+# Size of the synthetic volumes in the x and y dimensions
+SLICE_SHAPE = (64, 64)
+
+# SOP class of the synthetic DICOM slices (CT Image Storage)
+CT_IMAGE_STORAGE = "1.2.840.10008.5.1.4.1.1.2"
+
+# Start of the session timestamps, one day apart
+FIRST_SESSION = datetime.datetime(2020, 1, 1, 8, 0, 0)
+
+# Prefix of the API key in the Authorization header of requests
+API_KEY_PREFIX = "scitran-user"
+
+
+class ApiException(Exception):
+    """
+    Error of a request, with its HTTP status as in the flywheel SDK.
+    """
+
+    def __init__(self, status=None, reason=None):
+        super().__init__(f"({status}) {reason}")
+        self.status = status
+        self.reason = reason
+
+
+class FileReference:
+    """
+    Reference to a file of a container, as in the flywheel SDK.
+    """
+
+    def __init__(self, id=None, type=None, name=None):
+        self.id = id
+        self.type = type
+        self.name = name
+
+
+class FileEntry:
+    """
+    File of a fake container.
+    """
+
+    def __init__(self, parent, name, file_type, size, modality=None):
+        self.id = self.file_id = f"{parent.id}-{name}"
+        self.name = name
+        self.type = file_type
+        self.modality = modality
+        self.size = size
+        self.hash = None
+        self.version = 1
+        self.modified = parent.modified
+        self.parent_ref = {"id": parent.id, "type": parent.container_type}
+
+    def ref(self):
+        """
+        Reference the file from its parent.
+
+        Returns:
+            FileReference: Reference to the file.
+        """
+        return FileReference(self.parent_ref["id"], self.parent_ref["type"], self.name)
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the files of a FakeServer at /api/<containers>/<id>/files/<name>,
+    honouring Range headers.
+    """
+
+    def do_GET(self):
+        fake_server = self.server.fake_server
+        if not self.headers.get("Authorization", "").startswith(API_KEY_PREFIX):
+            self.send_error(401)
+            return
+        match = re.match(r"/api/\w+/([^/]+)/files/([^/?]+)$", self.path)
+        file_entry = None
+        if match:
+            container = fake_server.containers.get(urllib.parse.unquote(match[1]))
+            if container and hasattr(container, "files"):
+                file_entry = container.get_file(urllib.parse.unquote(match[2]))
+        if not file_entry:
+            self.send_error(404)
+            return
+
+        content = fake_server.content(file_entry)
+        start, end = 0, len(content)
+        range_match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if range_match:
+            start = int(range_match[1])
+            if range_match[2]:
+                end = min(end, int(range_match[2]) + 1)
+            if start >= end:
+                self.send_error(416)
+                return
+            with fake_server._lock:
+                fake_server.range_requests += 1
+        fake_server.request(end - start)
+        if range_match:
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        self.wfile.write(content[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+class Configuration:
+    """
+    API host and key of a client, as in the flywheel SDK.
+    """
+
+    def __init__(self, host, api_key):
+        self.host = host
+        self.api_key = {"Authorization": api_key}
+
+    def get_api_key_with_prefix(self, identifier):
+        """
+        API key of a header, with its prefix.
+
+        Args:
+            identifier (str): Name of the header (e.g. "Authorization").
+
+        Returns:
+            str: Value of the header or None, without an API key.
+        """
+        api_key = self.api_key.get(identifier)
+        return f"{API_KEY_PREFIX} {api_key}" if api_key else None
+
+
+class ApiClient:
+    """
+    Low-level client holding the configuration, as in the flywheel SDK.
+    """
+
+    def __init__(self, host, api_key):
+        self.configuration = Configuration(host, api_key)
+
+
+def install(server):
+    """
+    Serve a hierarchy to the clients created afterwards.
+
+    Args:
+        server (FakeServer): Server of the hierarchy.
+    """
+    global SERVER
+    SERVER = server
+
+
+def _nrrd_header(file_id, depth):
+    """
+    Header of a synthetic NRRD volume, unique to a file.
+
+    The id is written in the header, so that files have distinct contents.
+
+    Args:
+        file_id (str): Id of the file.
+        depth (int): Number of slices of the volume.
+
+    Returns:
+        bytes: NRRD header, followed by the raw voxels.
+    """
+    return (
+        "NRRD0004\n"
+        f"# fake flywheel file {file_id}\n"
+        "type: uint8\n"
+        "dimension: 3\n"
+        "space: left-posterior-superior\n"
+        f"sizes: {SLICE_SHAPE[0]} {SLICE_SHAPE[1]} {depth}\n"
+        "space directions: (1,0,0) (0,1,0) (0,0,1)\n"
+        "encoding: raw\n"
+        "space origin: (0,0,0)\n"
+        "\n"
+    ).encode()
+
+
+def _dicom_archive(label, slices):
+    """
+    Zip archive of a synthetic CT series, with its own study and series UIDs.
+
+    Args:
+        label (str): Patient name of the series.
+        slices (int): Number of slices.
+
+    Returns:
+        bytes: Zip archive of the DICOM files.
+    """
+    study_uid = generate_uid()
+    series_uid = generate_uid()
+    frame_uid = generate_uid()
+    pixels = np.zeros(SLICE_SHAPE, dtype=np.int16)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        for index in range(slices):
+            meta = FileMetaDataset()
+            meta.MediaStorageSOPClassUID = CT_IMAGE_STORAGE
+            meta.MediaStorageSOPInstanceUID = generate_uid()
+            meta.TransferSyntaxUID = ExplicitVRLittleEndian
+            ds = Dataset()
+            ds.file_meta = meta
+            ds.SOPClassUID = CT_IMAGE_STORAGE
+            ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+            ds.PatientName = label
+            ds.PatientID = label
+            ds.StudyInstanceUID = study_uid
+            ds.SeriesInstanceUID = series_uid
+            ds.FrameOfReferenceUID = frame_uid
+            ds.Modality = "CT"
+            ds.SeriesNumber = 1
+            ds.InstanceNumber = index + 1
+            ds.ImagePositionPatient = [0, 0, index]
+            ds.ImageOrientationPatient = [1, 0, 0, 0, 1, 0]
+            ds.PixelSpacing = [1, 1]
+            ds.SliceThickness = 1
+            ds.Rows, ds.Columns = SLICE_SHAPE
+            ds.SamplesPerPixel = 1
+            ds.PhotometricInterpretation = "MONOCHROME2"
+            ds.BitsAllocated = 16
+            ds.BitsStored = 16
+            ds.HighBit = 15
+            ds.PixelRepresentation = 1
+            ds.RescaleIntercept = 0
+            ds.RescaleSlope = 1
+            ds.PixelData = pixels.tobytes()
+            ds.is_little_endian = True
+            ds.is_implicit_VR = False
+            dicom_file = io.BytesIO()
+            ds.save_as(dicom_file, write_like_original=False)
+            zip_file.writestr(f"{index:04d}.dcm", dicom_file.getvalue())
+    return archive.getvalue()
+
+
+class FakeServer:
+    """
+    Synthetic Flywheel hierarchy with simulated latency and bandwidth.
+    """
+
+    def __init__(
+        self,
+        subjects=10,
+        sessions=2,
+        files=2,
+        file_size=256 * 1024,
+        dicom_slices=16,
+        latency=0.02,
+        bandwidth=None,
+    ):
+        """
+        Build the hierarchy.
+
+        Args:
+            subjects (int, optional): Number of subjects (N).
+            sessions (int, optional): Number of sessions per subject (M).
+            files (int, optional): Number of NRRD volumes per acquisition (K).
+            file_size (int, optional): Approximate size of each volume in bytes.
+            dicom_slices (int, optional): Number of slices of the DICOM archive of
+                each acquisition. No archives are served with 0 or without pydicom.
+            latency (float, optional): Seconds each request takes.
+            bandwidth (float, optional): Bytes per second of transfers. Unlimited
+                by default.
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = 0
+        self.range_requests = 0
+        self._http_server = None
+        self.containers = {}
+        self.children = {}
+        self._contents = {}
+        self._lock = threading.Lock()
+
+        depth = max(1, file_size // (SLICE_SHAPE[0] * SLICE_SHAPE[1]))
+        self.group = self._add("benchmark", "group", "Benchmark", None)
+        self.project = self._add(
+            "benchmark-project", "project", "Benchmark", self.group
+        )
+        for i in range(subjects):
+            subject = self._add(
+                f"{self.project.id}-sub{i:04d}", "subject", f"sub-{i:04d}", self.project
+            )
+            for j in range(sessions):
+                session = self._add(
+                    f"{subject.id}-ses{j:02d}", "session", f"ses-{j:02d}", subject
+                )
+                session.timestamp = FIRST_SESSION + datetime.timedelta(days=j)
+                acquisition = self._add(
+                    f"{session.id}-acq", "acquisition", "acq-anat", session
+                )
+                for k in range(files):
+                    file_entry = FileEntry(acquisition, f"volume_{k}.nrrd", "nrrd", 0)
+                    header = _nrrd_header(file_entry.id, depth)
+                    voxels = depth * SLICE_SHAPE[0] * SLICE_SHAPE[1]
+                    file_entry.size = len(header) + voxels
+                    self._contents[file_entry.id] = header
+                    acquisition.files.append(file_entry)
+                if dicom_slices and pydicom:
+                    archive = _dicom_archive(
+                        f"{subject.label}^{session.label}", dicom_slices
+                    )
+                    file_entry = FileEntry(
+                        acquisition, "series.dicom.zip", "dicom", len(archive), "CT"
+                    )
+                    self._contents[file_entry.id] = archive
+                    acquisition.files.append(file_entry)
+
+    def _add(self, container_id, container_type, label, parent):
+        """
+        Add a container under a parent.
+
+        Args:
+            container_id (str): Id of the container.
+            container_type (str): Type of the container (e.g. "session").
+            label (str): Label of the container.
+            parent (Container): Parent container or None for a group.
+
+        Returns:
+            Container: The new container.
+        """
+        container = Container(self, container_id, container_type, label, parent)
+        self.containers[container_id] = container
+        self.children.setdefault(container_type, []).append(container)
+        return container
+
+    def request(self, transferred=0):
+        """
+        Simulate the latency of a request and the duration of its transfer.
+
+        Args:
+            transferred (int, optional): Bytes transferred by the request.
+        """
+        with self._lock:
+            self.requests += 1
+        delay = self.latency
+        if self.bandwidth and transferred:
+            delay += transferred / self.bandwidth
+        if delay:
+            time.sleep(delay)
+
+    def serve(self):
+        """
+        Start serving the files over HTTP, if not served yet.
+
+        Returns:
+            str: Host of the API, as in the configuration of an SDK client.
+        """
+        with self._lock:
+            if self._http_server is None:
+                self._http_server = http.server.ThreadingHTTPServer(
+                    ("127.0.0.1", 0), FileHandler
+                )
+                self._http_server.fake_server = self
+                threading.Thread(
+                    target=self._http_server.serve_forever, daemon=True
+                ).start()
+            port = self._http_server.server_address[1]
+        return f"http://127.0.0.1:{port}/api"
+
+    def close(self):
+        """
+        Stop serving the files over HTTP.
+        """
+        with self._lock:
+            http_server, self._http_server = self._http_server, None
+        if http_server:
+            http_server.shutdown()
+            http_server.server_close()
+
+    def content(self, file_entry):
+        """
+        Content of a file.
+
+        Args:
+            file_entry (FileEntry): File to read.
+
+        Returns:
+            bytes: Content of the file.
+        """
+        content = self._contents[file_entry.id]
+        # Volumes are stored as their header, followed by empty voxels
+        return content + bytes(file_entry.size - len(content))
+
+    def store(self, file_entry, content):
+        """
+        Store the content of an uploaded file.
+
+        Args:
+            file_entry (FileEntry): Uploaded file.
+            content (bytes): Content of the file.
+        """
+        self._contents[file_entry.id] = content
+
+    def get(self, container_id):
+        """
+        Retrieve a container by id.
+
+        Args:
+            container_id (str): Id of the container.
+
+        Returns:
+            Container: The container.
+
+        Raises:
+            ApiException: 404, if the container does not exist.
+        """
+        self.request()
+        if container_id not in self.containers:
+            raise ApiException(404, f"{container_id} not found")
+        return self.containers[container_id]
+
+
+def _condition(container, condition):
+    """
+    Check a container against one condition of a finder filter.
+
+    Args:
+        container (Container): Container to check.
+        condition (str): Condition (e.g. "label=~^sub", "timestamp>=2020-01-01").
+
+    Returns:
+        bool: True if the container matches.
+    """
+    key, operator, value = re.match(
+        r"([\w.]+)(=~|>=|<=|!=|=|>|<)(.*)", condition
+    ).groups()
+    if key.startswith("files."):
+        attribute = key.split(".", 1)[1]
+        values = [str(getattr(fl, attribute, None)) for fl in container.files]
+    elif key.startswith("parents."):
+        values = [str(container.parents.get(key.split(".", 1)[1]))]
+    else:
+        values = [str(getattr(container, key, None) or "")]
+    if operator == "=~":
+        return any(re.search(value, val) for val in values)
+    if operator == "=":
+        return value in values
+    if operator == "!=":
+        return value not in values
+    compare = {
+        ">=": lambda val: val >= value,
+        "<=": lambda val: val <= value,
+        ">": lambda val: val > value,
+        "<": lambda val: val < value,
+    }[operator]
+    return any(val and compare(val) for val in values)
+
+
+class Finder:
+    """
+    Finder of containers, callable or with a paged `find`, as in the flywheel SDK.
+    """
+
+    def __init__(self, server, container_type, parent=None):
+        """
+        Initialize the finder.
+
+        Args:
+            server (FakeServer): Server of the containers.
+            container_type (str): Type of the found containers.
+            parent (Container, optional): Parent of the containers. All containers
+                of the site are found without a parent.
+        """
+        self.server = server
+        self.container_type = container_type
+        self.parent = parent
+
+    def __call__(self):
+        return self.find()
+
+    def find(self, filter=None, sort=None, limit=None, skip=0):
+        """
+        Find containers in one request.
+
+        Args:
+            filter (str, optional): Comma-separated conditions.
+            sort (str, optional): Sort order (e.g. "label:asc").
+            limit (int, optional): Maximum number of containers.
+            skip (int, optional): Number of containers to skip.
+
+        Returns:
+            list: Found containers.
+        """
+        containers = self.server.children.get(self.container_type, [])
+        if self.parent:
+            parent_type = self.parent.container_type
+            containers = [
+                c for c in containers if c.parents.get(parent_type) == self.parent.id
+            ]
+        for condition in filter.split(",") if filter else []:
+            containers = [c for c in containers if _condition(c, condition)]
+        if sort:
+            key, _, order = sort.partition(":")
+            containers = sorted(
+                containers,
+                key=lambda c: str(getattr(c, key, "")),
+                reverse=order == "desc",
+            )
+        end = skip + limit if limit else None
+        found = containers[skip:end]
+        self.server.request()
+        return found
+
+
+# Child containers of each container type
+CHILD_TYPES = {
+    "group": "project",
+    "project": "subject",
+    "subject": "session",
+    "session": "acquisition",
+}
+
+
+class Container:
+    """
+    Container of a fake hierarchy.
+    """
+
+    def __init__(self, server, container_id, container_type, label, parent):
+        """
+        Initialize the container.
+
+        Args:
+            server (FakeServer): Server of the container.
+            container_id (str): Id of the container.
+            container_type (str): Type of the container.
+            label (str): Label of the container.
+            parent (Container): Parent container or None for a group.
+        """
+        self.server = server
+        self.id = container_id
+        self.container_type = container_type
+        self.label = label
+        self.modified = FIRST_SESSION
+        self.timestamp = None
+        self.parents = {
+            par: None
+            for par in ["group", "project", "subject", "session", "acquisition"]
+        }
+        if parent:
+            self.parents.update(parent.parents)
+            self.parents[parent.container_type] = parent.id
+        if container_type != "group":
+            self.files = []
+            self.analyses = []
+        child_type = CHILD_TYPES.get(container_type)
+        if child_type:
+            setattr(self, f"{child_type}s", Finder(server, child_type, self))
+
+    def reload(self):
+        """
+        Fetch the container again.
+
+        Returns:
+            Container: The container.
+        """
+        return self.server.get(self.id)
+
+    def get_file(self, name):
+        """
+        Retrieve a file of the container by name.
+
+        Args:
+            name (str): Name of the file.
+
+        Returns:
+            FileEntry: The file or None.
+        """
+        for fl in self.files:
+            if fl.name == name:
+                return fl
+        return None
+
+    def download_file(self, name, dest_file):
+        """
+        Download a file of the container.
+
+        Args:
+            name (str): Name of the file.
+            dest_file (str): Path to write the file to.
+        """
+        file_entry = self.get_file(name)
+        if not file_entry:
+            raise ApiException(404, f"{name} not found")
+        content = self.server.content(file_entry)
+        self.server.request(len(content))
+        Path(dest_file).write_bytes(content)
+
+    def upload_file(self, file_path):
+        """
+        Upload a file to the container, as a new version of a file of the same name.
+
+        Args:
+            file_path (str): Path of the file.
+        """
+        content = Path(file_path).read_bytes()
+        self.server.request(len(content))
+        name = Path(file_path).name
+        file_entry = self.get_file(name)
+        if file_entry:
+            file_entry.version += 1
+        else:
+            file_entry = FileEntry(self, name, None, 0)
+            self.files.append(file_entry)
+        file_entry.size = len(content)
+        file_entry.hash = "v0-sha384-" + hashlib.sha384(content).hexdigest()
+        file_entry.modified = datetime.datetime.now()
+        self.server.store(file_entry, content)
+
+    def add_analysis(self, label=None, inputs=None):
+        """
+        Create an analysis under the container.
+
+        Args:
+            label (str, optional): Label of the analysis.
+            inputs (list, optional): FileReferences of the inputs.
+
+        Returns:
+            Container: The new analysis.
+        """
+        self.server.request()
+        analysis_id = f"{self.id}-analysis{len(self.analyses)}"
+        analysis = self.server._add(analysis_id, "analysis", label, self)
+        analysis.inputs = inputs or []
+        self.analyses.append(analysis)
+        return analysis
+
+
+class Client:
+    """
+    Client of the installed FakeServer, as flywheel.Client.
+    """
+
+    def __init__(self, api_key=None):
+        """
+        Connect to the installed server.
+
+        Args:
+            api_key (str, optional): Key sent with file downloads. Without a key,
+                files are only downloaded with download_file.
+        """
+        if SERVER is None:
+            raise ApiException(401, "No fake Flywheel server installed")
+        self.server = SERVER
+        self.api_client = ApiClient(self.server.serve(), api_key)
+        for child_type in ["group", "project", "subject", "session", "acquisition"]:
+            setattr(self, f"{child_type}s", Finder(self.server, child_type))
+
+    def get_current_user(self):
+        self.server.request()
+        return {"email": "benchmark@example.com"}
+
+    def get_config(self):
+        self.server.request()
+        return {"site": {"api_url": "https://benchmark.invalid/api"}}
+
+    def get(self, container_id):
+        return self.server.get(container_id)
+
+    def get_file(self, file_id):
+        """
+        Retrieve a file by id.
+
+        Args:
+            file_id (str): Id of the file.
+
+        Returns:
+            FileEntry: The file.
+        """
+        self.server.request()
+        for container in self.server.containers.values():
+            for fl in getattr(container, "files", []):
+                if fl.id == file_id:
+                    return fl
+        raise ApiException(404, f"{file_id} not found")
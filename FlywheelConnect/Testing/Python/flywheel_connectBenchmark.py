@@ -0,0 +1,642 @@
+"""
+End-to-end benchmark of Flywheel Connect against an in-process fake Flywheel.
+
+The benchmark times connecting, tree population and expansion, hierarchy
+prefetching, caching, volume and DICOM loading and uploads on a synthetic hierarchy
+of N subjects x M sessions x K files (see fake_flywheel.FakeServer), with simulated
+request latency and bandwidth, and measures the memory of tree nodes. Files are
+downloaded over local HTTP with resumable range requests, volumes above
+parallel_min_size in parallel ranges.
+
+Results are appended as JSON lines to a history file, one line per phase, and
+compared with the last run of the same parameters to report regressions:
+
+    Slicer --no-main-window --python-script flywheel_connectBenchmark.py \\
+        --subjects 50 --sessions 4 --files 3 --latency 0.05 --label v1.2.0 \\
+        --output flywheel_connect_benchmarks.jsonl
+
+The same benchmark runs with small parameters as a unit test, without a history.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import unittest
+from pathlib import Path
+
+import qt
+import slicer
+from DICOMLib import DICOMUtils
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fake_flywheel
+import flywheel_connect
+from management.child_loader import BackgroundTask, ChildLoader, LoadMoreItem
+from management.fw_container_items import ContainerItem, SessionItem
+from management.hierarchy_prefetch import prefetch_project
+from management.metadata_cache import MetadataCache
+from management.metrics import METRICS
+from management.tree_management import TreeManagement
+
+# Parameters of a benchmark run from the command line
+DEFAULT_PARAMS = {
+    "subjects": 20,
+    "sessions": 3,
+    "files": 2,
+    "file_size": 1024 * 1024,
+    "dicom_slices": 32,
+    "latency": 0.02,
+    "bandwidth": 50 * 1024 ** 2,
+    "download_workers": 4,
+    "parallel_min_size": 512 * 1024,
+    "load_limit": 4,
+    "uploads": 4,
+    "tree_nodes": 10000,
+}
+
+# Parameters of the unit test, small enough for every build
+SMOKE_PARAMS = dict(
+    DEFAULT_PARAMS,
+    subjects=3,
+    sessions=2,
+    file_size=64 * 1024,
+    dicom_slices=4,
+    latency=0.0,
+    bandwidth=None,
+    parallel_min_size=48 * 1024,
+    load_limit=2,
+    uploads=2,
+    tree_nodes=200,
+)
+
+# A phase slower than the last run by this ratio is reported as a regression
+REGRESSION_TOLERANCE = 0.25
+
+# Phases faster than this (in seconds) are not compared, their timing is noise
+MIN_COMPARED_SECONDS = 0.05
+
+# Seconds to wait for background listings before giving up
+IDLE_TIMEOUT = 600
+
+
+class BenchmarkHost:
+    """
+    Stand-in for the module widget, hosting the tree view of a TreeManagement.
+    """
+
+    def __init__(self, fw_client, download_workers):
+        """
+        Create the widgets used by the tree management.
+
+        Args:
+            fw_client (CachedClient): Connected client.
+            download_workers (int): Number of concurrent downloads.
+        """
+        self.fw_client = fw_client
+        self.treeView = qt.QTreeView()
+        self.loadFilesButton = qt.QPushButton()
+        self.uploadFilesButton = qt.QPushButton()
+        self.asAnalysisCheck = qt.QCheckBox()
+        self.downloadWorkersSpinBox = qt.QSpinBox()
+        self.downloadWorkersSpinBox.setRange(1, 16)
+        self.downloadWorkersSpinBox.setValue(download_workers)
+
+
+class Benchmark:
+    """
+    Time the phases of the module on a fake Flywheel hierarchy.
+    """
+
+    def __init__(self, work_dir, **params):
+        """
+        Initialize a benchmark run.
+
+        Args:
+            work_dir (pathlib.Path): Directory of the caches and uploaded files.
+            **params: Parameters overriding DEFAULT_PARAMS.
+        """
+        self.work_dir = Path(work_dir)
+        self.params = dict(DEFAULT_PARAMS, **params)
+        self.results = []
+
+    def timed(self, phase, func):
+        """
+        Time a phase and record its result.
+
+        Args:
+            phase (str): Name of the phase.
+            func (callable): Runs the phase and returns its number of items (e.g.
+                tree nodes, files), or the number of items and a dict of
+                measurements recorded with the phase.
+
+        Returns:
+            int: Number of items of the phase.
+        """
+        started = time.perf_counter()
+        items = func()
+        seconds = time.perf_counter() - started
+        measurements = {}
+        if isinstance(items, tuple):
+            items, measurements = items
+        self.results.append(
+            dict(measurements, phase=phase, seconds=seconds, items=items)
+        )
+        return items
+
+    @staticmethod
+    def wait_idle():
+        """
+        Process events until all background listings are inserted in the tree.
+
+        Raises:
+            RuntimeError: If the listings are still running after IDLE_TIMEOUT.
+        """
+        deadline = time.monotonic() + IDLE_TIMEOUT
+        while ChildLoader.active or BackgroundTask.active:
+            if time.monotonic() > deadline:
+                raise RuntimeError("Background listings did not complete.")
+            slicer.app.processEvents()
+            time.sleep(0.001)
+
+    def expand(self, items):
+        """
+        Expand tree nodes as a user would, then list all pages of their children.
+
+        Args:
+            items (list): Tree items to expand.
+        """
+        tree_view = self.tree_management.treeView
+        model = self.tree_management.source_model
+        for item in items:
+            tree_view.expand(model.indexFromItem(item))
+        self.wait_idle()
+        for item in items:
+            folder = getattr(item, "folderItem", None)
+            while folder and folder.rowCount():
+                last = folder.child(folder.rowCount() - 1)
+                if not isinstance(last, LoadMoreItem):
+                    break
+                last._dblclicked()
+                self.wait_idle()
+
+    def expand_all(self, project_item):
+        """
+        Expand the subjects, sessions and acquisitions of a project, level by level.
+
+        Args:
+            project_item (ProjectItem): Expanded project node.
+
+        Returns:
+            int: Number of expanded container nodes.
+        """
+        expanded = 0
+        level = [project_item]
+        while level:
+            folders = [item.folderItem for item in level if hasattr(item, "folderItem")]
+            self.expand(folders)
+            level = [
+                folder.child(row)
+                for folder in folders
+                for row in range(folder.rowCount())
+                if isinstance(folder.child(row), ContainerItem)
+            ]
+            self.expand(level)
+            expanded += len(level)
+        return expanded
+
+    def build_nodes(self, containers):
+        """
+        Build detached session nodes and measure their memory, before and after
+        their folders are created on expansion.
+
+        The Python memory is traced with tracemalloc, and the Qt items (each a C++
+        QStandardItem with its wrapper) are counted.
+
+        Args:
+            containers (list): Session containers of the nodes.
+
+        Returns:
+            tuple: Number of nodes and the "bytes_per_node" and "items_per_node"
+                of collapsed and "expanded" nodes.
+        """
+        model = self.tree_management.source_model
+        tracemalloc.start()
+        try:
+            nodes = [SessionItem(model, container) for container in containers]
+            collapsed_bytes = tracemalloc.get_traced_memory()[0]
+            collapsed_items = sum(1 + node.rowCount() for node in nodes)
+            for node in nodes:
+                node.create_folders()
+            expanded_bytes = tracemalloc.get_traced_memory()[0]
+            expanded_items = sum(1 + node.rowCount() for node in nodes)
+        finally:
+            tracemalloc.stop()
+        count = len(nodes)
+        return count, {
+            "bytes_per_node": collapsed_bytes / count,
+            "items_per_node": collapsed_items / count,
+            "expanded_bytes_per_node": expanded_bytes / count,
+            "expanded_items_per_node": expanded_items / count,
+        }
+
+    def populate(self, project_id):
+        """
+        Draw the project node and list its subjects.
+
+        Args:
+            project_id (str): Id of the project.
+
+        Returns:
+            ProjectItem: Root node of the tree.
+        """
+        metadata_cache = self.logic.metadata_cache
+        project = metadata_cache.get(project_id) or metadata_cache.put(
+            self.logic.fw_client.get(project_id)
+        )
+        project_item = self.tree_management.populateTreeFromProject(project)
+        self.expand([project_item])
+        return project_item
+
+    def load(self, jobs, dicom):
+        """
+        Load cached files into the scene.
+
+        Args:
+            jobs (list): Jobs of cached files (see flywheel_connectLogic.fetch_files).
+            dicom (bool): Load the DICOM archives instead of the volumes.
+
+        Returns:
+            int: Number of loaded files.
+        """
+        selected = [job for job in jobs if bool(job.get("dicom_dir")) == dicom]
+        selected = selected[: self.params["load_limit"]]
+        loaded = 0
+        for job in selected:
+            loaded += self.logic.load_file(
+                job["file_path"], job.get("dicom_dir"), job["file"]
+            )
+        return loaded
+
+    def upload(self, container_id, file_paths):
+        """
+        Upload files to a container.
+
+        Args:
+            container_id (str): Id of the container.
+            file_paths (list): Paths of the files.
+
+        Returns:
+            int: Number of files uploaded or skipped.
+
+        Raises:
+            RuntimeError: If an upload failed.
+        """
+        failed = self.logic.upload_to_container(container_id, file_paths)
+        if failed:
+            raise RuntimeError(f"Failed to upload {failed}")
+        return len(file_paths)
+
+    def run(self):
+        """
+        Run all phases.
+
+        Returns:
+            list: "phase", "seconds" and "items" of each phase, followed by the
+                "metrics" summary of the run.
+        """
+        params = self.params
+        server = fake_flywheel.FakeServer(
+            subjects=params["subjects"],
+            sessions=params["sessions"],
+            files=params["files"],
+            file_size=params["file_size"],
+            dicom_slices=params["dicom_slices"],
+            latency=params["latency"],
+            bandwidth=params["bandwidth"],
+        )
+        fake_flywheel.install(server)
+        self.server = server
+        saved_flywheel = getattr(flywheel_connect, "flywheel", None)
+        flywheel_connect.flywheel = fake_flywheel
+        METRICS.clear()
+        self.results = []
+        try:
+            # Keep the DICOM database of the user untouched
+            with DICOMUtils.TemporaryDICOMDatabase(str(self.work_dir / "dicom")):
+                self._run_phases(server)
+        finally:
+            flywheel_connect.flywheel = saved_flywheel
+            server.close()
+            slicer.mrmlScene.Clear(0)
+        self.results.append({"phase": "metrics", "summary": METRICS.summary()})
+        return self.results
+
+    def _run_phases(self, server):
+        """
+        Run the phases on a fake server.
+
+        Args:
+            server (fake_flywheel.FakeServer): Installed server.
+        """
+        params = self.params
+        project_id = server.project.id
+        self.logic = flywheel_connect.flywheel_connectLogic(
+            self.work_dir / "flywheelIO",
+            download_workers=params["download_workers"],
+        )
+        self.logic.file_cache.downloader.parallel_min_size = params["parallel_min_size"]
+
+        def connect():
+            self.logic.connect("benchmark")
+            return 1
+
+        self.timed("connect", connect)
+
+        host = BenchmarkHost(self.logic.fw_client, params["download_workers"])
+        self.tree_management = TreeManagement(host)
+        self.tree_management.metadata_cache = self.logic.metadata_cache
+        self.tree_management.file_cache = self.logic.file_cache
+        self.tree_management.logic = self.logic
+        try:
+            project_item = None
+
+            def populate():
+                nonlocal project_item
+                project_item = self.populate(project_id)
+                return 1
+
+            self.timed("tree.populate", populate)
+            self.timed("tree.expand", lambda: self.expand_all(project_item))
+            self.tree_management.clear_tree()
+            self.timed("tree.populate.cached", populate)
+            self.timed("tree.expand.cached", lambda: self.expand_all(project_item))
+            sessions = server.children["session"]
+            containers = [
+                sessions[index % len(sessions)]
+                for index in range(params["tree_nodes"])
+            ]
+            self.timed("tree.nodes", lambda: self.build_nodes(containers))
+        finally:
+            self.tree_management.clear_tree()
+
+        prefetch_cache = MetadataCache(
+            self.work_dir / "prefetch.sqlite", self.logic.fw_client
+        )
+        try:
+            self.timed(
+                "prefetch",
+                lambda: sum(
+                    prefetch_project(
+                        self.logic.fw_client, prefetch_cache, server.project
+                    ).values()
+                ),
+            )
+        finally:
+            prefetch_cache.close()
+
+        files = []
+
+        def resolve():
+            files.extend(self.logic.resolve_files([project_id]))
+            return len(files)
+
+        self.timed("resolve", resolve)
+        jobs = []
+
+        def fetch():
+            jobs[:] = list(self.logic.fetch_files(files))
+            errors = [job["error"] for job in jobs if "error" in job]
+            if errors:
+                raise RuntimeError(f"Failed to cache {len(errors)} files: {errors[0]}")
+            return len(jobs)
+
+        self.timed("cache.cold", fetch)
+        self.timed("cache.warm", fetch)
+
+        self.timed("load.volume", lambda: self.load(jobs, dicom=False))
+        slicer.mrmlScene.Clear(0)
+        self.timed("load.dicom", lambda: self.load(jobs, dicom=True))
+        slicer.mrmlScene.Clear(0)
+        self.timed("load.dicom.indexed", lambda: self.load(jobs, dicom=True))
+        slicer.mrmlScene.Clear(0)
+
+        output_dir = self.work_dir / "outputs"
+        output_dir.mkdir(parents=True, exist_ok=True)
+        file_paths = []
+        for index in range(params["uploads"]):
+            file_path = output_dir / f"output_{index}.bin"
+            file_path.write_bytes(os.urandom(params["file_size"]))
+            file_paths.append(str(file_path))
+        session_id = server.children["session"][0].id
+        self.timed("upload", lambda: self.upload(session_id, file_paths))
+        self.timed("upload.unchanged", lambda: self.upload(session_id, file_paths))
+        self.logic.metadata_cache.close()
+
+
+def release_label():
+    """
+    Describe the checked out revision of the module.
+
+    Returns:
+        str: Output of `git describe` or "unknown" outside of a git checkout.
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=Path(flywheel_connect.__file__).resolve().parent,
+            stderr=subprocess.DEVNULL,
+            text=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run_records(results, params, label):
+    """
+    Represent the results of a run as history records.
+
+    Args:
+        results (list): Results of Benchmark.run.
+        params (dict): Parameters of the run.
+        label (str): Release or revision of the run.
+
+    Returns:
+        list: One record per phase.
+    """
+    run = {
+        "run": datetime.datetime.now().isoformat(timespec="seconds"),
+        "label": label,
+        "host": platform.node(),
+        "slicer": slicer.app.applicationVersion,
+        "params": params,
+    }
+    return [dict(run, **result) for result in results]
+
+
+def load_history(history_path):
+    """
+    Read the records of past runs.
+
+    Args:
+        history_path (pathlib.Path): JSON lines file of past runs.
+
+    Returns:
+        list: Records of past runs, oldest first.
+    """
+    if not history_path.exists():
+        return []
+    with open(history_path) as fp:
+        return [json.loads(line) for line in fp if line.strip()]
+
+
+def compare(records, history, tolerance=REGRESSION_TOLERANCE):
+    """
+    Compare a run with the last run of the same parameters.
+
+    Args:
+        records (list): Records of the run.
+        history (list): Records of past runs.
+        tolerance (float, optional): Ratio over which a slower phase regressed.
+
+    Returns:
+        list: (phase, previous seconds, seconds, previous label) of each
+            regression.
+    """
+    params = records[0]["params"]
+    previous_runs = [rec["run"] for rec in history if rec["params"] == params]
+    if not previous_runs:
+        return []
+    previous_run = previous_runs[-1]
+    previous = {
+        rec["phase"]: rec
+        for rec in history
+        if rec["run"] == previous_run and "seconds" in rec
+    }
+    regressions = []
+    for rec in records:
+        before = previous.get(rec["phase"])
+        if not before or "seconds" not in rec:
+            continue
+        if max(rec["seconds"], before["seconds"]) < MIN_COMPARED_SECONDS:
+            continue
+        if rec["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(
+                (rec["phase"], before["seconds"], rec["seconds"], before["label"])
+            )
+    return regressions
+
+
+def format_results(results, regressions=()):
+    """
+    Describe the results of a run as text.
+
+    Args:
+        results (list): Results of Benchmark.run.
+        regressions (list, optional): Regressions found by compare.
+
+    Returns:
+        str: One line per phase, followed by the regressions.
+    """
+    lines = []
+    for result in results:
+        if "seconds" not in result:
+            continue
+        line = (
+            f"{result['phase']:<22}{result['seconds']:>9.3f} s  "
+            f"{result['items']} items"
+        )
+        if "bytes_per_node" in result:
+            line += (
+                f", {result['bytes_per_node']:.0f} B and "
+                f"{result['items_per_node']:.0f} Qt items per node "
+                f"({result['expanded_bytes_per_node']:.0f} B and "
+                f"{result['expanded_items_per_node']:.0f} once expanded)"
+            )
+        lines.append(line)
+    for phase, before, after, label in regressions:
+        lines.append(
+            f"REGRESSION {phase}: {after:.3f} s, was {before:.3f} s in {label}"
+        )
+    return "\n".join(lines)
+
+
+class flywheel_connectBenchmark(unittest.TestCase):
+    """
+    Run the benchmark with small parameters to keep it working.
+    """
+
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as work_dir:
+            benchmark = Benchmark(work_dir, **SMOKE_PARAMS)
+            results = benchmark.run()
+        print(format_results(results))
+        phases = {result["phase"]: result for result in results}
+        params = SMOKE_PARAMS
+        acquisitions = params["subjects"] * params["sessions"]
+        self.assertEqual(
+            phases["tree.expand"]["items"],
+            params["subjects"] + 2 * acquisitions,
+        )
+        self.assertEqual(
+            phases["tree.expand.cached"]["items"], phases["tree.expand"]["items"]
+        )
+        counters = phases["metrics"]["summary"]["counters"]
+        self.assertEqual(counters["cache.hit"], phases["cache.warm"]["items"])
+        self.assertEqual(phases["load.volume"]["items"], params["load_limit"])
+        # Folders of session nodes are only created on expansion
+        self.assertEqual(phases["tree.nodes"]["items_per_node"], 1)
+        self.assertEqual(phases["tree.nodes"]["expanded_items_per_node"], 4)
+        # Volumes above parallel_min_size are fetched in parallel byte ranges
+        self.assertGreater(benchmark.server.range_requests, 0)
+
+
+def main(argv):
+    """
+    Run the benchmark from the command line and record it in the history.
+
+    Args:
+        argv (list): Command line arguments.
+
+    Returns:
+        int: Exit status, 1 for regressions with --fail-on-regression.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    for name, default in DEFAULT_PARAMS.items():
+        parser.add_argument(
+            "--" + name.replace("_", "-"),
+            type=type(default),
+            default=default,
+            help=f"(default: {default})",
+        )
+    parser.add_argument("--label", help="Release of the run (default: git describe)")
+    parser.add_argument(
+        "--output",
+        type=Path,
+        default=Path("flywheel_connect_benchmarks.jsonl"),
+        help="JSON lines history of the runs, appended to",
+    )
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE)
+    parser.add_argument("--fail-on-regression", action="store_true")
+    args = parser.parse_args(argv)
+
+    params = {name: getattr(args, name) for name in DEFAULT_PARAMS}
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = Benchmark(work_dir, **params).run()
+    records = run_records(results, params, args.label or release_label())
+    regressions = compare(records, load_history(args.output), args.tolerance)
+    with open(args.output, "a") as fp:
+        for record in records:
+            fp.write(json.dumps(record, default=str) + "\n")
+    print(format_results(results, regressions))
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    slicer.util.exit(main(sys.argv[1:]))
@@ -0,0 +1,186 @@
+"""
+Tests of the resumable chunked downloads against a local HTTP stand-in of Flywheel.
+"""
+import http.server
+import os
+import re
+import sys
+import tempfile
+import threading
+import types
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from management.chunked_download import ChunkedDownloader
+from management.file_cache import PARENT_TYPES, TMP_DIR, FileCache
+
+# Content served by the stand-in, not a multiple of the chunk and range sizes
+CONTENT = bytes(range(256)) * 1001
+
+
+class FileHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serve the content of the server at any url, honouring Range headers.
+    """
+
+    def do_GET(self):
+        server = self.server
+        server.authorizations.append(self.headers.get("Authorization"))
+        if server.redirect and server.redirect.split("/", 3)[3] != self.path[1:]:
+            self.send_response(302)
+            self.send_header("Location", server.redirect)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        server.ranges.append(self.headers.get("Range"))
+        content = server.content
+        start, end = 0, len(content)
+        match = re.match(r"bytes=(\d+)-(\d*)", self.headers.get("Range") or "")
+        if match and not server.ignore_range:
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(end, int(match.group(2)) + 1)
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(content)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        body = content[start:end]
+        if server.drops:
+            # Interrupt the transfer half-way, as a dropped connection would
+            server.drops -= 1
+            body = body[: len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FileServer(http.server.ThreadingHTTPServer):
+    """
+    Local HTTP server of one file.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, content=CONTENT):
+        super(FileServer, self).__init__(("127.0.0.1", 0), FileHandler)
+        self.content = content
+        self.ignore_range = False
+        self.drops = 0
+        self.redirect = None
+        self.ranges = []
+        self.authorizations = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/files/data.bin"
+
+
+class flywheel_connectChunkedDownloadTest(unittest.TestCase):
+    """
+    Download from a local server that drops connections or ignores ranges.
+    """
+
+    def setUp(self):
+        self.server = FileServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.dest = Path(self.work_dir.name) / "data.bin"
+        self.downloader = ChunkedDownloader(
+            chunk_size=4096, parallel_min_size=64 * 1024, timeout=5
+        )
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.work_dir.cleanup()
+
+    def redirect_download(self, api):
+        api.redirect = self.server.url.replace("/files/", "/storage/")
+        self.downloader.parallel_ranges = 1
+        headers = {"Authorization": "scitran-user key"}
+        self.downloader.download(api.url, self.dest, headers, size=len(CONTENT))
+        self.assertEqual(self.dest.read_bytes(), CONTENT)
+
+    def download(self):
+        self.downloader.download(self.server.url, self.dest, size=len(CONTENT))
+        self.assertEqual(self.dest.read_bytes(), CONTENT)
+
+    def test_resume(self):
+        self.downloader.parallel_ranges = 1
+        self.server.drops = 1
+        self.download()
+        self.assertEqual(
+            self.server.ranges[1], f"bytes={len(CONTENT) // 2}-{len(CONTENT) - 1}"
+        )
+
+    def test_resume_partial_file(self):
+        self.downloader.parallel_ranges = 1
+        self.dest.write_bytes(CONTENT[:1000])
+        self.download()
+        self.assertEqual(self.server.ranges, [f"bytes=1000-{len(CONTENT) - 1}"])
+
+    def test_resume_without_ranges(self):
+        self.downloader.parallel_ranges = 1
+        self.server.ignore_range = True
+        self.dest.write_bytes(CONTENT[:1000])
+        self.download()
+
+    def test_redirect_to_storage(self):
+        api = FileServer()
+        threading.Thread(target=api.serve_forever, daemon=True).start()
+        self.addCleanup(api.server_close)
+        self.addCleanup(api.shutdown)
+        self.redirect_download(api)
+        # The signed url of the storage (on another host) does not get the API key
+        self.assertEqual(api.authorizations, ["scitran-user key"])
+        self.assertEqual(self.server.authorizations, [None])
+
+    def test_redirect_on_api_host(self):
+        self.redirect_download(self.server)
+        self.assertEqual(self.server.authorizations, ["scitran-user key"] * 2)
+
+    def test_parallel_ranges(self):
+        self.download()
+        self.assertEqual(len(self.server.ranges), self.downloader.parallel_ranges)
+        self.assertEqual(os.listdir(self.work_dir.name), ["data.bin"])
+
+    def test_parallel_ranges_without_ranges(self):
+        self.server.ignore_range = True
+        self.download()
+        self.assertEqual(os.listdir(self.work_dir.name), ["data.bin"])
+
+    def test_partials_of_other_versions(self):
+        configuration = types.SimpleNamespace(
+            host=self.server.url.split("/files/")[0],
+            get_api_key_with_prefix=lambda name: "scitran-user key",
+        )
+        cache = FileCache(Path(self.work_dir.name) / "cache", max_bytes=10 ** 9)
+        cache.client = types.SimpleNamespace(
+            api_client=types.SimpleNamespace(configuration=configuration)
+        )
+        cache.downloader = self.downloader
+        parent = types.SimpleNamespace(
+            id="files",
+            container_type="acquisition",
+            parents=dict.fromkeys(PARENT_TYPES),
+            files=[],
+        )
+        file_obj = types.SimpleNamespace(
+            id="f", name="data.bin", version=2, size=len(CONTENT), hash=None
+        )
+        tmp_dir = cache.root / TMP_DIR
+        tmp_dir.mkdir(parents=True)
+        (tmp_dir / "files-f-1-data.bin").write_bytes(CONTENT[:1000])
+        (tmp_dir / "files-f-1-data.bin.range2").write_bytes(CONTENT[:1000])
+        (tmp_dir / "other-g-1-data.bin").write_bytes(CONTENT[:1000])
+
+        file_path = cache.fetch(parent, file_obj)
+        self.assertEqual(file_path.read_bytes(), CONTENT)
+        self.assertEqual(os.listdir(tmp_dir), ["other-g-1-data.bin"])
+        cache.clear()
+        self.assertEqual(os.listdir(tmp_dir), [])
@@ -0,0 +1,104 @@
+"""
+Tests of the in-memory container cache of the Flywheel client.
+"""
+import sys
+import types
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from management.client_cache import CachedClient, TTLCache
+from management.metrics import CLIENT_CACHE_HIT, CLIENT_CACHE_MISS, METRICS
+
+
+class Client:
+    """
+    Client counting the containers it fetches.
+    """
+
+    def __init__(self):
+        self.gets = []
+        self.reloads = []
+
+    def get(self, container_id):
+        self.gets.append(container_id)
+        container = types.SimpleNamespace(id=container_id)
+        container.reload = lambda: self.reloads.append(container_id) or container
+        return container
+
+    def get_current_user(self):
+        return {"email": "user@example.com"}
+
+
+class flywheel_connectClientCacheTest(unittest.TestCase):
+    """
+    Cache containers of a counting client, on a controlled clock.
+    """
+
+    def setUp(self):
+        self.now = 0.0
+        patcher = mock.patch("management.client_cache.time.monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        METRICS.clear()
+        self.addCleanup(METRICS.clear)
+
+    def test_expiry(self):
+        cache = TTLCache(max_size=4, ttl=10)
+        cache.put("a", 1)
+        self.now = 9.9
+        self.assertEqual(cache.get("a"), 1)
+        self.now = 10.0
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats(), {"entries": 0, "hits": 1, "misses": 1})
+
+    def test_least_recently_used_evicted(self):
+        cache = TTLCache(max_size=2, ttl=10)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+        self.assertEqual([cache.get(key) for key in "abc"], [1, None, 3])
+
+    def test_invalidate_and_clear(self):
+        cache = TTLCache(max_size=2, ttl=10)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.invalidate("a")
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), 2)
+        cache.clear()
+        self.assertEqual(cache.stats(), {"entries": 0, "hits": 0, "misses": 0})
+
+    def test_get_reused(self):
+        client = Client()
+        cached_client = CachedClient(client, ttl=10)
+        container = cached_client.get("ses")
+        self.assertIs(cached_client.get("ses"), container)
+        # Reloading within the time-to-live reuses the container too
+        self.assertIs(cached_client.reload(container), container)
+        self.assertEqual(client.gets, ["ses"])
+        self.assertEqual(client.reloads, [])
+        self.now = 10.0
+        cached_client.reload(container)
+        self.assertEqual(client.reloads, ["ses"])
+        counters = METRICS.summary()["counters"]
+        self.assertEqual(counters[CLIENT_CACHE_HIT], 2)
+        self.assertEqual(counters[CLIENT_CACHE_MISS], 2)
+        self.assertEqual(METRICS.summary()["client_cache_hit_ratio"], 0.5)
+
+    def test_invalidated_container_fetched_again(self):
+        client = Client()
+        cached_client = CachedClient(client, ttl=10)
+        cached_client.get("ses")
+        cached_client.invalidate("ses")
+        cached_client.get("ses")
+        self.assertEqual(client.gets, ["ses", "ses"])
+
+    def test_pass_through(self):
+        cached_client = CachedClient(Client())
+        self.assertEqual(
+            cached_client.get_current_user(), {"email": "user@example.com"}
+        )
@@ -0,0 +1,182 @@
+"""
+Tests of the content-addressed file cache against the in-process fake Flywheel.
+"""
+import hashlib
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fake_flywheel
+from management.file_cache import INDEX_NAME, FileCache
+
+
+def add_file(server, container, name, content):
+    """
+    Add a file to a container of a fake server.
+
+    Args:
+        server (fake_flywheel.FakeServer): Server of the container.
+        container (fake_flywheel.Container): Parent of the file.
+        name (str): Name of the file.
+        content (bytes): Content of the file.
+
+    Returns:
+        fake_flywheel.FileEntry: The new file.
+    """
+    file_entry = fake_flywheel.FileEntry(container, name, None, len(content))
+    file_entry.hash = "v0-sha384-" + hashlib.sha384(content).hexdigest()
+    server.store(file_entry, content)
+    container.files.append(file_entry)
+    return file_entry
+
+
+class SlowStoreCache(FileCache):
+    """
+    Cache taking a while to store downloads, as on a slow disk.
+    """
+
+    def store(self, *args, **kwargs):
+        time.sleep(0.02)
+        return super(SlowStoreCache, self).store(*args, **kwargs)
+
+
+class flywheel_connectFileCacheTest(unittest.TestCase):
+    """
+    Fetch files of a fake Flywheel into a temporary cache.
+    """
+
+    def setUp(self):
+        self.server = fake_flywheel.FakeServer(
+            subjects=1, sessions=1, files=0, dicom_slices=0, latency=0.0
+        )
+        fake_flywheel.install(self.server)
+        self.client = fake_flywheel.Client("key")
+        self.acquisition = self.server.children["acquisition"][0]
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.cache = self.new_cache()
+
+    def tearDown(self):
+        self.server.close()
+        self.work_dir.cleanup()
+
+    def new_cache(self, max_bytes=10 ** 9, cache_class=FileCache):
+        cache = cache_class(Path(self.work_dir.name) / "cache", max_bytes)
+        cache.client = self.client
+        cache.downloader.parallel_min_size = 16 * 1024
+        return cache
+
+    def test_companion_fetched_twice(self):
+        header = add_file(self.server, self.acquisition, "vol.mhd", b"ElementType")
+        raw = add_file(self.server, self.acquisition, "vol.raw", bytes(64 * 1024))
+        # The .raw is fetched with its header and on its own at the same time
+        self.cache = self.new_cache(cache_class=SlowStoreCache)
+        for _ in range(10):
+            self.cache.clear()
+            requests = self.server.requests
+            errors = []
+
+            def fetch(file_obj):
+                try:
+                    self.cache.fetch_with_companions(self.acquisition, file_obj)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [
+                threading.Thread(target=fetch, args=(fl,)) for fl in (header, raw)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+            raw_path = self.cache.cache_path(self.acquisition, raw)
+            self.assertEqual(raw_path.read_bytes(), bytes(64 * 1024))
+            # The header in one request, the .raw once in parallel ranges
+            self.assertEqual(
+                self.server.requests - requests,
+                1 + self.cache.downloader.parallel_ranges,
+            )
+            self.assertEqual(self.cache._partial_locks, {})
+
+    def test_eviction(self):
+        files = [
+            add_file(self.server, self.acquisition, f"{name}.bin", bytes([i]) * 100)
+            for i, name in enumerate("abc")
+        ]
+        self.cache = self.new_cache(max_bytes=250)
+        self.cache.fetch(self.acquisition, files[0])
+        self.cache.fetch(self.acquisition, files[1])
+        time.sleep(0.01)
+        # A cache hit makes a file the most recently accessed
+        self.cache.fetch(self.acquisition, files[0])
+        self.cache.fetch(self.acquisition, files[2])
+        self.assertEqual(
+            [self.cache.is_cached(self.acquisition, fl) for fl in files],
+            [True, False, True],
+        )
+        self.assertFalse(self.cache.cache_path(self.acquisition, files[1]).exists())
+        self.assertEqual(self.cache.usage(), 200)
+
+    def test_same_content_stored_once(self):
+        session = self.server.children["session"][0]
+        content = b"DICM" * 100
+        in_acquisition = add_file(self.server, self.acquisition, "a.dcm", content)
+        in_session = add_file(self.server, session, "copy.dcm", content)
+        requests = self.server.requests
+        acquisition_path = self.cache.fetch(self.acquisition, in_acquisition)
+        session_path = self.cache.fetch(session, in_session)
+        self.assertEqual(self.server.requests - requests, 1)
+        self.assertEqual(session_path.read_bytes(), content)
+        self.assertTrue(os.path.samefile(acquisition_path, session_path))
+        self.assertEqual(self.cache.usage(), len(content))
+
+    def test_batch_pinning(self):
+        files = [
+            add_file(self.server, self.acquisition, f"{name}.bin", bytes([i]) * 100)
+            for i, name in enumerate("ab")
+        ]
+        self.cache = self.new_cache(max_bytes=150)
+        with self.cache.batch():
+            for fl in files:
+                self.cache.fetch(self.acquisition, fl)
+            # Files of a running batch are kept over the size limit
+            self.assertTrue(
+                all(self.cache.is_cached(self.acquisition, fl) for fl in files)
+            )
+        self.assertEqual(
+            [self.cache.is_cached(self.acquisition, fl) for fl in files],
+            [False, True],
+        )
+
+    def test_legacy_files_adopted(self):
+        content = b"legacy" * 100
+        legacy = add_file(self.server, self.acquisition, "legacy.nii", content)
+        changed = add_file(self.server, self.acquisition, "changed.nii", content * 2)
+        # Files cached directly under their parents, by a version without the index
+        self.cache.wait_for_sweep()
+        os.remove(self.cache.root / INDEX_NAME)
+        for fl, cached_content in [(legacy, content), (changed, content)]:
+            file_path = self.cache.cache_path(self.acquisition, fl)
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_bytes(cached_content)
+        self.cache = self.new_cache()
+        self.cache.wait_for_sweep()
+        self.assertEqual(self.cache.usage(), 2 * len(content))
+        requests = self.server.requests
+        legacy_path = self.cache.fetch(self.acquisition, legacy)
+        self.assertEqual(self.server.requests, requests)
+        # Moved to the object of its content
+        object_path = self.cache._object_path(legacy.hash.split("-")[-1])
+        self.assertTrue(os.path.samefile(legacy_path, object_path))
+        # A file changed on the server since is downloaded again
+        changed_path = self.cache.fetch(self.acquisition, changed)
+        self.assertEqual(self.server.requests, requests + 1)
+        self.assertEqual(changed_path.read_bytes(), content * 2)
+        self.assertEqual(self.cache.usage(), 3 * len(content))
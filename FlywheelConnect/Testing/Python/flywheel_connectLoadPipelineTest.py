@@ -0,0 +1,100 @@
+"""
+Tests of the staged load pipeline.
+"""
+import sys
+import threading
+import time
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from management.load_pipeline import LoadPipeline
+
+
+class flywheel_connectLoadPipelineTest(unittest.TestCase):
+    """
+    Run jobs through pipelines of plain functions.
+    """
+
+    def setUp(self):
+        self.pipeline = LoadPipeline(queue_size=2, poll_interval=0.01)
+
+    def test_stages_in_order(self):
+        self.pipeline.add_stage("double", lambda job: dict(job, value=job["value"] * 2))
+        self.pipeline.add_stage("add", lambda job: dict(job, value=job["value"] + 1))
+        jobs = self.pipeline.run({"value": i} for i in range(20))
+        self.assertEqual(
+            sorted(job["value"] for job in jobs), [i * 2 + 1 for i in range(20)]
+        )
+
+    def test_workers(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+
+        def slow(job):
+            with lock:
+                running.append(job)
+                peak.append(len(running))
+            time.sleep(0.02)
+            with lock:
+                running.remove(job)
+            return job
+
+        self.pipeline.add_stage("slow", slow, workers=4)
+        jobs = list(self.pipeline.run({"value": i} for i in range(12)))
+        self.assertEqual(len(jobs), 12)
+        self.assertEqual(max(peak), 4)
+
+    def test_error_skips_later_stages(self):
+        def fail_odd(job):
+            if job["value"] % 2:
+                raise ValueError(job["value"])
+            return job
+
+        later = []
+        self.pipeline.add_stage("check", fail_odd)
+        self.pipeline.add_stage("load", lambda job: later.append(job) or job)
+        jobs = list(self.pipeline.run({"value": i} for i in range(6)))
+        failed = [job for job in jobs if job.get("error")]
+        self.assertEqual(sorted(job["value"] for job in failed), [1, 3, 5])
+        self.assertTrue(all(job["failed_stage"] == "check" for job in failed))
+        self.assertIsInstance(failed[0]["error"], ValueError)
+        self.assertEqual(sorted(job["value"] for job in later), [0, 2, 4])
+
+    def test_backpressure(self):
+        fed = []
+
+        def jobs():
+            for i in range(50):
+                fed.append(i)
+                yield {"value": i}
+
+        self.pipeline.add_stage("pass", lambda job: job)
+        results = self.pipeline.run(jobs())
+        next(results)
+        time.sleep(0.1)
+        # Only the queues (and the jobs held by the threads) run ahead
+        self.assertLess(len(fed), 10)
+        results.close()
+
+    def test_idle_callback(self):
+        idle = []
+        self.pipeline.add_stage("slow", lambda job: time.sleep(0.05) or job)
+        jobs = list(self.pipeline.run([{"value": 0}], lambda: idle.append(1)))
+        self.assertEqual(len(jobs), 1)
+        self.assertTrue(idle)
+
+    def test_stop_early(self):
+        processed = []
+        self.pipeline.add_stage("pass", lambda job: processed.append(job) or job)
+        results = self.pipeline.run({"value": i} for i in range(1000))
+        next(results)
+        results.close()
+        time.sleep(0.1)
+        count = len(processed)
+        time.sleep(0.1)
+        # The workers stop with the consumer
+        self.assertEqual(len(processed), count)
+        self.assertLess(count, 1000)
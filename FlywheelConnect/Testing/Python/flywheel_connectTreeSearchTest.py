@@ -0,0 +1,110 @@
+"""
+Tests of the search queries of the project tree.
+"""
+import sys
+import types
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import fake_flywheel
+from management.tree_search import combine, parse_query, search_server
+
+
+def container(container_id, container_type, parent=None):
+    """
+    Make a container of a project, under a parent.
+
+    Args:
+        container_id (str): Id of the container.
+        container_type (str): Type of the container.
+        parent (types.SimpleNamespace, optional): Parent container.
+
+    Returns:
+        types.SimpleNamespace: The container.
+    """
+    parents = dict.fromkeys(["group", "project", "subject", "session"])
+    parents.update(group="group", project="project")
+    if parent:
+        parents.update(parent.parents)
+        parents[parent.container_type] = parent.id
+    return types.SimpleNamespace(
+        id=container_id, container_type=container_type, parents=parents
+    )
+
+
+class flywheel_connectTreeSearchTest(unittest.TestCase):
+    """
+    Parse queries and combine the containers matching their criteria.
+    """
+
+    def setUp(self):
+        self.subjects = [container(f"sub{i}", "subject") for i in range(2)]
+        self.sessions = [
+            container(f"{sub.id}-ses", "session", sub) for sub in self.subjects
+        ]
+        self.acquisitions = [
+            container(f"{ses.id}-{label}", "acquisition", ses)
+            for ses in self.sessions
+            for label in ["t1", "dwi"]
+        ]
+
+    def test_parse_query(self):
+        self.assertEqual(
+            parse_query("T1 Subject:001 brain date:2020-01-31 modality:MR"),
+            {
+                "label": "T1 brain",
+                "subject": "001",
+                "date": "2020-01-31",
+                "modality": "MR",
+            },
+        )
+        self.assertEqual(parse_query("  "), {})
+        self.assertEqual(parse_query("type:"), {})
+
+    def test_parse_query_errors(self):
+        for text in ["site:x", "date:2020-31-01", "label:a,b"]:
+            with self.assertRaises(ValueError):
+                parse_query(text)
+
+    def test_combine_deepest(self):
+        t1 = [acq for acq in self.acquisitions if acq.id.endswith("t1")]
+        criteria = {"subject": "0", "label": "t1"}
+        # The subject matches above the acquisitions matching the label
+        matches = combine(criteria, {"subject": [self.subjects[0]], "label": t1})
+        self.assertEqual([c.id for c in matches], ["sub0-ses-t1"])
+
+    def test_combine_through_descendants(self):
+        ses0, ses1 = self.sessions
+        mr = [self.acquisitions[0], self.acquisitions[2]]
+        criteria = {"date": "2020-01-31", "modality": "MR"}
+        matches = combine(criteria, {"date": [ses1], "modality": mr})
+        self.assertEqual([c.id for c in matches], ["sub1-ses-t1"])
+        # A session matching without a matching acquisition is kept
+        matches = combine({"date": "2020-01-31"}, {"date": [ses0, ses1]})
+        self.assertEqual([c.id for c in matches], ["sub0-ses", "sub1-ses"])
+
+    def test_combine_no_match(self):
+        criteria = {"subject": "0", "label": "t1"}
+        matches = combine(
+            criteria, {"subject": [self.subjects[0]], "label": [self.acquisitions[2]]}
+        )
+        self.assertEqual(matches, [])
+        self.assertEqual(combine(criteria, {"subject": [self.subjects[0]]}), [])
+
+    def test_search_server_pages(self):
+        server = fake_flywheel.FakeServer(
+            subjects=12, sessions=1, files=0, dicom_slices=0, latency=0.0
+        )
+        fake_flywheel.install(server)
+        self.addCleanup(server.close)
+        client = fake_flywheel.Client("key")
+        requests = server.requests
+        matches = search_server(
+            client, server.project.id, {"subject": "sub-"}, page_size=5
+        )
+        self.assertEqual(len(matches), 12)
+        # Three pages, the last one short
+        self.assertEqual(server.requests - requests, 3)
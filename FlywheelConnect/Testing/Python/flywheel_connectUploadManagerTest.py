@@ -0,0 +1,127 @@
+"""
+Tests of the concurrent uploads with retries and skipping of unchanged files.
+"""
+import sys
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+
+from management.file_cache import hash_file
+from management.transfer_manager import UploadManager
+
+
+class UploadError(Exception):
+    """
+    Error of an upload, with the HTTP status of the response.
+    """
+
+    def __init__(self, status=None):
+        super(UploadError, self).__init__(status)
+        self.status = status
+
+
+class Container:
+    """
+    Container recording uploads, failing the first ones with given errors.
+    """
+
+    def __init__(self, errors=()):
+        self.errors = list(errors)
+        self.uploads = []
+        self._lock = threading.Lock()
+
+    def upload_file(self, file_path):
+        with self._lock:
+            self.uploads.append(Path(file_path).name)
+            if self.errors:
+                raise self.errors.pop(0)
+
+
+class flywheel_connectUploadManagerTest(unittest.TestCase):
+    """
+    Upload temporary files to containers that fail on demand.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.file_paths = []
+        for i in range(3):
+            file_path = Path(self.work_dir.name) / f"output{i}.nii.gz"
+            file_path.write_bytes(bytes([i]) * 100)
+            self.file_paths.append(str(file_path))
+        self.manager = UploadManager(max_workers=2, poll_interval=0.01)
+        # Record the backoff delays instead of waiting
+        patcher = mock.patch("management.transfer_manager.time.sleep")
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.work_dir.cleanup()
+
+    def upload(self, container, file_paths, known_hashes=None):
+        return dict(
+            self.manager.upload(container, file_paths, known_hashes=known_hashes)
+        )
+
+    def test_upload_all(self):
+        container = Container()
+        results = self.upload(container, self.file_paths)
+        self.assertEqual(sorted(results), sorted(self.file_paths))
+        self.assertTrue(all(result["uploaded"] for result in results.values()))
+        self.assertEqual(len(container.uploads), 3)
+        self.sleep.assert_not_called()
+
+    def test_retry_with_backoff(self):
+        container = Container([UploadError(503), ConnectionError(), UploadError(429)])
+        result = self.upload(container, self.file_paths[:1])[self.file_paths[0]]
+        self.assertTrue(result["uploaded"])
+        self.assertIsNone(result["error"])
+        self.assertEqual(len(container.uploads), 4)
+        self.assertEqual(
+            [delay for (delay,), _ in self.sleep.call_args_list], [1.0, 2.0, 4.0]
+        )
+
+    def test_retries_exhausted(self):
+        errors = [UploadError(500) for _ in range(self.manager.max_retries + 1)]
+        container = Container(errors)
+        result = self.upload(container, self.file_paths[:1])[self.file_paths[0]]
+        self.assertFalse(result["uploaded"])
+        self.assertIs(result["error"], errors[-1])
+        self.assertEqual(len(container.uploads), self.manager.max_retries + 1)
+
+    def test_client_error_not_retried(self):
+        container = Container([UploadError(403)])
+        results = self.upload(container, self.file_paths)
+        failed = [path for path, result in results.items() if result["error"]]
+        # The other uploads go on
+        self.assertEqual(len(failed), 1)
+        self.assertEqual(results[failed[0]]["error"].status, 403)
+        self.assertEqual(len(container.uploads), 3)
+        self.sleep.assert_not_called()
+
+    def test_skip_unchanged(self):
+        unchanged, changed, new = self.file_paths
+        known_hashes = {
+            Path(unchanged).name: hash_file(unchanged),
+            Path(changed).name: hash_file(new),
+        }
+        container = Container()
+        results = self.upload(container, self.file_paths, known_hashes)
+        self.assertEqual(
+            sorted(container.uploads), sorted(Path(p).name for p in [changed, new])
+        )
+        self.assertFalse(results[unchanged]["uploaded"])
+        self.assertIsNone(results[unchanged]["error"])
+        self.assertEqual(results[changed]["sha384"], hash_file(changed))
+        self.assertTrue(results[changed]["uploaded"])
+
+    def test_missing_file(self):
+        missing = str(Path(self.work_dir.name) / "missing.nii.gz")
+        container = Container()
+        result = self.upload(container, [missing], {})[missing]
+        self.assertIsInstance(result["error"], OSError)
+        self.assertEqual(container.uploads, [])
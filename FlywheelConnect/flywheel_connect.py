@@ -1,13 +1,14 @@
 import datetime
+import fnmatch
+import hashlib
 import logging
 import os
 import os.path as op
-import shutil
 import tempfile
+import threading
 from glob import glob
 from importlib import import_module
 from pathlib import Path
-from zipfile import ZipFile
 
 import ctk
 import DICOMLib
@@ -16,8 +17,101 @@ import slicer
 import vtk
 from slicer.ScriptedLoadableModule import *
 
+from management.child_loader import BackgroundTask
+from management.client_cache import CachedClient
+from management.dicom_index import in_database, index_entry, restore_loadables
+from management.file_cache import DEFAULT_MAX_BYTES, FileCache, content_key
+from management.load_pipeline import LoadPipeline
+from management.metrics import METRICS
+from management.metadata_cache import MetadataCache, modified_text
+from management.transfer_manager import DEFAULT_MAX_WORKERS, UploadManager
+from management.tree_search import parse_query
 from management.tree_management import TreeManagement
 
+# Default directory of the disk cache
+DEFAULT_CACHE_DIR = Path(os.path.expanduser("~")) / "flywheelIO"
+
+# Application setting holding the size limit of the disk cache in GB
+CACHE_SIZE_SETTING = "FlywheelConnect/CacheSizeGB"
+
+# Type of the children of each container type, as listed by the SDK
+CHILD_TYPES = {
+    "project": "subjects",
+    "subject": "sessions",
+    "session": "acquisitions",
+}
+
+
+# Thread importing the flywheel SDK in the background, once started
+_flywheel_import = None
+
+
+def _import_flywheel_quietly():
+    """
+    Import the flywheel SDK into the module globals. Runs in a worker thread.
+
+    A missing SDK is left to import_flywheel, which offers to install it. A module
+    set in the meantime (e.g. a stand-in SDK of the benchmarks) is kept.
+    """
+    try:
+        globals().setdefault("flywheel", import_module("flywheel"))
+    except ImportError:
+        pass
+
+
+def warm_flywheel_import():
+    """
+    Start importing the flywheel SDK in a background thread, once.
+
+    The SDK is a large import, so it is warmed after Slicer started rather than
+    during startup.
+    """
+    global _flywheel_import
+    if _flywheel_import is None and not globals().get("flywheel"):
+        _flywheel_import = threading.Thread(target=_import_flywheel_quietly)
+        _flywheel_import.daemon = True
+        _flywheel_import.start()
+
+
+def import_flywheel(idle_callback=None):
+    """
+    Import the flywheel SDK into the module globals, on first use.
+
+    Waits for the background import, if started. If the SDK is not installed and
+    Slicer has a main window, offers to install it. Must run on the main thread.
+
+    Args:
+        idle_callback (callable, optional): Called while waiting for the background
+            import (e.g. to process GUI events).
+
+    Returns:
+        module: The flywheel module.
+
+    Raises:
+        ModuleNotFoundError: If the SDK is not installed, and not installed now.
+    """
+    if _flywheel_import is not None:
+        while _flywheel_import.is_alive():
+            _flywheel_import.join(0.05)
+            if idle_callback:
+                idle_callback()
+    if not globals().get("flywheel"):
+        try:
+            globals()["flywheel"] = import_module("flywheel")
+        except ModuleNotFoundError:
+            if not (
+                slicer.util.mainWindow()
+                and slicer.util.confirmOkCancelDisplay(
+                    "Flywheel Connect requires 'flywheel-sdk' Python package. "
+                    "Click OK to install it now."
+                )
+            ):
+                raise
+            slicer.util.pip_install("flywheel-sdk")
+            globals()["flywheel"] = import_module("flywheel")
+    return globals()["flywheel"]
+
+
 #
 # flywheel_connect
 #
@@ -42,16 +136,10 @@ class flywheel_connect(ScriptedLoadableModule):
         slicer.app.connect("startupCompleted()", self.onStartupCompleted)
 
     def onStartupCompleted(self):
-        FlyW = ""
-        try:
-            FlyW = import_module("flywheel")
-        except ModuleNotFoundError as e:
-            if slicer.util.confirmOkCancelDisplay(
-                "Flywheel Connect requires 'flywheel-sdk' Python package. Click OK to install it now."
-            ):
-                slicer.util.pip_install("flywheel-sdk")
-                FlyW = import_module("flywheel")
-        globals()["flywheel"] = FlyW
+        """
+        Import the flywheel SDK in the background, so that startup is not delayed.
+        """
+        warm_flywheel_import()
 
 
 #
@@ -70,8 +158,12 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         """
         ScriptedLoadableModuleWidget.setup(self)
 
-        # Declare Cache path
-        self.CacheDir = Path(os.path.expanduser("~")) / "flywheelIO"
+        # Downloads, caches, loads and uploads are run by the logic
+        self.logic = flywheel_connectLogic()
+        self.CacheDir = self.logic.cache_dir
+        self.file_cache = self.logic.file_cache
+        self.metadata_cache = None
+        self._revalidation_tasks = {}
 
         # #################Declare form elements#######################
 
@@ -119,6 +211,51 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         self.useCacheCheckBox.setCheckState(True)
         self.useCacheCheckBox.setTristate(False)
 
+        #
+        # Cache Size Limit SpinBox
+        #
+        self.cacheSizeLabel = qt.QLabel("Cache Size Limit (GB):")
+        apiKeyFormLayout.addWidget(self.cacheSizeLabel)
+        self.cacheSizeSpinBox = qt.QSpinBox()
+        self.cacheSizeSpinBox.setRange(1, 10000)
+        cache_size = int(
+            qt.QSettings().value(CACHE_SIZE_SETTING, DEFAULT_MAX_BYTES // 1024 ** 3)
+        )
+        self.cacheSizeSpinBox.setValue(cache_size)
+        self.file_cache.max_bytes = cache_size * 1024 ** 3
+        # Evict once the size is entered, not at each digit typed
+        self.cacheSizeSpinBox.keyboardTracking = False
+        self.cacheSizeSpinBox.toolTip = (
+            "Least recently used files are removed from the cache above this size."
+        )
+        apiKeyFormLayout.addWidget(self.cacheSizeSpinBox)
+
+        #
+        # Download Workers SpinBox
+        #
+        self.downloadWorkersLabel = qt.QLabel("Concurrent Downloads:")
+        apiKeyFormLayout.addWidget(self.downloadWorkersLabel)
+        self.downloadWorkersSpinBox = qt.QSpinBox()
+        self.downloadWorkersSpinBox.setRange(1, 16)
+        self.downloadWorkersSpinBox.setValue(DEFAULT_MAX_WORKERS)
+        self.downloadWorkersSpinBox.toolTip = (
+            "Number of files downloaded from Flywheel at the same time."
+        )
+        apiKeyFormLayout.addWidget(self.downloadWorkersSpinBox)
+
+        #
+        # Upload Workers SpinBox
+        #
+        self.uploadWorkersLabel = qt.QLabel("Concurrent Uploads:")
+        apiKeyFormLayout.addWidget(self.uploadWorkersLabel)
+        self.uploadWorkersSpinBox = qt.QSpinBox()
+        self.uploadWorkersSpinBox.setRange(1, 16)
+        self.uploadWorkersSpinBox.setValue(DEFAULT_MAX_WORKERS)
+        self.uploadWorkersSpinBox.toolTip = (
+            "Number of files uploaded to Flywheel at the same time."
+        )
+        apiKeyFormLayout.addWidget(self.uploadWorkersSpinBox)
+
         # Data View Section
         self.dataCollapsibleGroupBox = ctk.ctkCollapsibleGroupBox()
         self.dataCollapsibleGroupBox.setTitle("Data")
@@ -150,6 +287,26 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         self.projectSelector.setMinimumWidth(200)
         dataFormLayout.addWidget(self.projectSelector)
 
+        # Prefetch Hierarchy Checkbox
+        self.prefetchCheckBox = qt.QCheckBox("Prefetch hierarchy")
+        self.prefetchCheckBox.toolTip = (
+            "List all subjects, sessions, acquisitions and files of the selected "
+            "project in the background with a few bulk queries."
+        )
+        dataFormLayout.addWidget(self.prefetchCheckBox)
+
+        # Search Line Edit
+        self.searchLineEdit = qt.QLineEdit()
+        self.searchLineEdit.placeholderText = (
+            "Search: label subject:code date:YYYY-MM-DD modality:MR type:dicom"
+        )
+        self.searchLineEdit.toolTip = (
+            "Show only the subjects, sessions and acquisitions matching all terms. "
+            "Clear to show the whole project."
+        )
+        self.searchLineEdit.enabled = False
+        dataFormLayout.addWidget(self.searchLineEdit)
+
         # TreeView for Single Projects containers:
         self.treeView = qt.QTreeView()
 
@@ -157,6 +314,8 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         self.treeView.setMinimumWidth(200)
         self.treeView.setMinimumHeight(350)
         self.tree_management = TreeManagement(self)
+        self.tree_management.file_cache = self.file_cache
+        self.tree_management.logic = self.logic
         dataFormLayout.addWidget(self.treeView)
 
         # Load Files Button
@@ -180,6 +339,30 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
 
         dataFormLayout.addWidget(self.asAnalysisCheck)
 
+        # Performance Section
+        self.metricsCollapsibleGroupBox = ctk.ctkCollapsibleGroupBox()
+        self.metricsCollapsibleGroupBox.setTitle("Performance")
+        self.metricsCollapsibleGroupBox.collapsed = True
+        self.layout.addWidget(self.metricsCollapsibleGroupBox)
+
+        metricsFormLayout = qt.QFormLayout(self.metricsCollapsibleGroupBox)
+
+        # Timings of API requests, transfers, cache lookups and loads
+        self.metricsTextEdit = qt.QPlainTextEdit()
+        self.metricsTextEdit.readOnly = True
+        self.metricsTextEdit.setMinimumHeight(150)
+        metricsFormLayout.addWidget(self.metricsTextEdit)
+
+        metricsButtonsLayout = qt.QHBoxLayout()
+        self.refreshMetricsButton = qt.QPushButton("Refresh")
+        metricsButtonsLayout.addWidget(self.refreshMetricsButton)
+        self.clearMetricsButton = qt.QPushButton("Clear")
+        metricsButtonsLayout.addWidget(self.clearMetricsButton)
+        self.exportMetricsButton = qt.QPushButton("Export...")
+        self.exportMetricsButton.toolTip = "Save all recorded timings as JSON lines."
+        metricsButtonsLayout.addWidget(self.exportMetricsButton)
+        metricsFormLayout.addRow(metricsButtonsLayout)
+
         # ################# Connect form elements #######################
         self.connectAPIButton.connect("clicked(bool)", self.onConnectAPIPushed)
 
@@ -191,10 +374,21 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
 
         self.loadFilesButton.connect("clicked(bool)", self.onLoadFilesPushed)
 
+        self.searchLineEdit.connect("returnPressed()", self.onSearch)
+
         self.uploadFilesButton.connect("clicked(bool)", self.save_scene_to_flywheel)
 
         self.asAnalysisCheck.stateChanged.connect(self.onAnalysisCheckChanged)
 
+        self.cacheSizeSpinBox.connect("valueChanged(int)", self.onCacheSizeChanged)
+
+        self.metricsCollapsibleGroupBox.connect(
+            "toggled(bool)", self.onRefreshMetrics
+        )
+        self.refreshMetricsButton.connect("clicked(bool)", self.onRefreshMetrics)
+        self.clearMetricsButton.connect("clicked(bool)", self.onClearMetrics)
+        self.exportMetricsButton.connect("clicked(bool)", self.onExportMetrics)
+
         # Add vertical spacer
         self.layout.addStretch(1)
 
@@ -203,22 +397,31 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         Connect to a Flywheel instance for valid api-key.
         """
         try:
+            # Wait for the SDK imported in the background, processing events
+            self.connectAPIButton.enabled = False
+            self.logAlertTextLabel.setText("Loading the Flywheel SDK...")
+            try:
+                with METRICS.span("import.flywheel"):
+                    import_flywheel(idle_callback=slicer.app.processEvents)
+            finally:
+                self.connectAPIButton.enabled = True
+                self.logAlertTextLabel.setText("")
+
             # Instantiate and connect widgets ...
-            if self.apiKeyTextBox.text:
-                self.fw_client = flywheel.Client(self.apiKeyTextBox.text)
-            else:
-                self.fw_client = flywheel.Client()
-            fw_user = self.fw_client.get_current_user()["email"]
-            fw_site = self.fw_client.get_config()["site"]["api_url"]
+            fw_user, fw_site = self.logic.connect(self.apiKeyTextBox.text)
+            self.fw_client = self.logic.fw_client
+            self.metadata_cache = self.logic.metadata_cache
             self.logAlertTextLabel.setText(
                 f"You are logged in as {fw_user} to {fw_site}"
             )
-            # if client valid: TODO
-            groups = self.fw_client.groups()
-            self.groupSelector.enabled = True
-            self.groupSelector.clear()
-            for group in groups:
-                self.groupSelector.addItem(group.label, group.id)
+            self.tree_management.metadata_cache = self.metadata_cache
+            self._populate_selector(
+                self.groupSelector,
+                "",
+                "groups",
+                self.fw_client.groups,
+                self.onGroupSelected,
+            )
 
             # Clear out any other instance's data from Slicer before proceeding.
             slicer.mrmlScene.Clear(0)
@@ -239,12 +442,15 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         """
         if item:
             group_id = self.groupSelector.currentData
-            self.group = self.fw_client.get(group_id)
-            projects = self.group.projects()
-            self.projectSelector.enabled = len(projects) > 0
-            self.projectSelector.clear()
-            for project in projects:
-                self.projectSelector.addItem(project.label, project.id)
+            self.group = self.metadata_cache.get(group_id)
+            group = self.group
+            self._populate_selector(
+                self.projectSelector,
+                group_id,
+                "projects",
+                lambda: group.projects(),
+                self.onProjectSelected,
+            )
 
     def onProjectSelected(self, item):
         """
@@ -253,120 +459,201 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         Args:
             item (str): Name of project or empty string
         """
-        tree_rows = self.tree_management.source_model.rowCount()
         if item:
             project_id = self.projectSelector.currentData
-            self.project = self.fw_client.get(project_id)
+            self.project = self.metadata_cache.get(project_id)
+            if not self.project:
+                self.project = self.metadata_cache.put(self.fw_client.get(project_id))
 
             # Remove the rows from the tree and repopulate
-            if tree_rows > 0:
-                self.tree_management.source_model.removeRows(0, tree_rows)
-            self.tree_management.populateTreeFromProject(self.project)
+            self.searchLineEdit.clear()
+            self.searchLineEdit.enabled = True
+            self.tree_management.clear_tree()
+            project_item = self.tree_management.populateTreeFromProject(
+                self.project, prefetch=self.prefetchCheckBox.isChecked()
+            )
             self.treeView.enabled = True
+
+            # Revalidate the project drawn from the metadata cache
+            cached = self.project
+            self._start_revalidation(
+                "project",
+                lambda: self.metadata_cache.put(self.fw_client.get(project_id)),
+                lambda fresh: self._revalidate_project(project_item, cached, fresh),
+            )
         else:
+            if "project" in self._revalidation_tasks:
+                self._revalidation_tasks.pop("project").cancel()
             self.treeView.enabled = False
+            self.searchLineEdit.enabled = False
             # Remove the rows from the tree and don't repopulate
-            if tree_rows > 0:
-                self.tree_management.source_model.removeRows(0, tree_rows)
+            self.tree_management.clear_tree()
             self.loadFilesButton.enabled = False
 
-    def is_compressed_dicom(self, file_path, file_type):
+    def onSearch(self):
         """
-        Check file_path and file_type for a flywheel compressed dicom archive.
+        Show only the paths to the containers of the project matching the search.
+
+        An empty search shows the whole project again.
+        """
+        try:
+            criteria = parse_query(self.searchLineEdit.text)
+        except ValueError as e:
+            slicer.util.errorDisplay(f"Invalid search: {e}")
+            return
+        # The project node is rebuilt, drop its pending revalidation
+        if "project" in self._revalidation_tasks:
+            self._revalidation_tasks.pop("project").cancel()
+        if criteria:
+            self.tree_management.search(self.project, criteria)
+        else:
+            self.tree_management.clear_tree()
+            self.tree_management.populateTreeFromProject(self.project)
+
+    def _revalidate_project(self, project_item, cached, fresh):
+        """
+        Update the project tree node drawn from the metadata cache, if modified.
 
         Args:
-            file_path (str): Path to cached file
-            file_type (str): Type of Flywheel file
+            project_item (ProjectItem): Root node of the tree.
+            cached (ContainerRecord): Project record the tree was drawn from.
+            fresh (ContainerRecord): Project record fetched from the server.
+        """
+        if modified_text(fresh) != modified_text(cached):
+            self.project = fresh
+            project_item._refresh(fresh)
 
-        Returns:
-            boolean: True for supported compressed dicom type
+    def _start_revalidation(self, key, fetch, callback):
         """
-        if file_path.endswith(".zip") and file_type == "dicom":
-            return True
+        Fetch containers in the background, replacing any pending fetch for key.
 
-        return False
+        Args:
+            key (str): Name of what is revalidated (e.g. "projects").
+            fetch (callable): Fetches from the server in a worker thread.
+            callback (callable): Called with the fetched result on the GUI thread.
+        """
+        if key in self._revalidation_tasks:
+            self._revalidation_tasks.pop(key).cancel()
+        task = BackgroundTask(
+            fetch,
+            callback,
+            lambda e: slicer.util.errorDisplay(f"Failed to refresh the {key}: {e}"),
+        )
+        self._revalidation_tasks[key] = task
+        task.start()
 
-    def load_dicom_archive(self, file_path):
+    def _fill_selector(self, selector, containers):
         """
-        Load unzipped DICOMs into Slicer.
+        Fill a selector ComboBox with containers.
 
         Args:
-            file_path (str): path to the cached dicom archive.
+            selector (qt.QComboBox): Group or project selector.
+            containers (list): Containers or records to list.
+        """
+        selector.enabled = len(containers) > 0
+        selector.clear()
+        for container in containers:
+            selector.addItem(container.label, container.id)
 
-        https://discourse.slicer.org/t/fastest-way-to-load-dicom/9317/2
+    def _populate_selector(self, selector, parent_id, child_type, fetch, on_changed):
         """
-        with tempfile.TemporaryDirectory() as dicomDataDir:
-            dicom_zip = ZipFile(file_path)
-            dicom_zip.extractall(path=dicomDataDir)
-            DICOMLib.importDicom(dicomDataDir)
-            dicomFiles = slicer.util.getFilesInDirectory(dicomDataDir)
-            loadablesByPlugin, loadEnabled = DICOMLib.getLoadablesFromFileLists(
-                [dicomFiles]
+        Populate a selector from the metadata cache and revalidate it in background.
+
+        If the listing is not cached, it is fetched right away instead.
+
+        Args:
+            selector (qt.QComboBox): Group or project selector.
+            parent_id (str): Id of the parent container ("" for the site).
+            child_type (str): Name of the listed containers (e.g. "projects").
+            fetch (callable): Lists the containers from the server.
+            on_changed (callable): Handler of the selector's current item.
+        """
+        cached = self.metadata_cache.get_children(parent_id, child_type)
+        if cached is None:
+            containers = self.metadata_cache.put_children(
+                parent_id, child_type, fetch(), complete=True
             )
-            loadedNodeIDs = DICOMLib.loadLoadables(loadablesByPlugin)
+            self._fill_selector(selector, containers)
+            return
+
+        self._fill_selector(selector, cached)
+        self._start_revalidation(
+            child_type,
+            lambda: self.metadata_cache.put_children(
+                parent_id, child_type, fetch(), complete=True
+            ),
+            lambda fresh: self._revalidate_selector(selector, cached, fresh, on_changed),
+        )
+
+    def _revalidate_selector(self, selector, cached, fresh, on_changed):
+        """
+        Update a selector drawn from the metadata cache with the server listing.
+
+        The current item is kept, if it still exists.
+
+        Args:
+            selector (qt.QComboBox): Group or project selector.
+            cached (list): Records the selector was filled with.
+            fresh (list): Records listed from the server.
+            on_changed (callable): Handler of the selector's current item.
+        """
+        if [(c.id, c.label) for c in cached] == [(c.id, c.label) for c in fresh]:
+            return
+        current_id = selector.currentData
+        selector.blockSignals(True)
+        self._fill_selector(selector, fresh)
+        index = selector.findData(current_id)
+        selector.setCurrentIndex(max(index, 0))
+        selector.blockSignals(False)
+        # The current container is gone, select the new current item
+        if index < 0:
+            on_changed(selector.currentText)
 
     def onLoadFilesPushed(self):
         """
         Load tree-selected files into 3D Slicer for viewing.
+
+        Downloading, extracting and loading are pipelined: archives are extracted in
+        the background while earlier files are loaded and later files downloaded.
+        The tree is disabled in the meantime. Failures are reported once all files
+        are loaded.
         """
 
-        # If Cache not checked, delete CacheDir recursively
+        # If Cache not checked, remove all files from the cache
         if not self.useCacheCheckBox.checkState():
-            shutil.rmtree(self.CacheDir)
-            Path(self.CacheDir).mkdir(parents=True, exist_ok=True)
-
-        # Cache all selected files
-        self.tree_management.cache_selected_for_open()
-
-        # Walk through cached files... This could use "types"
-        for k, file_dict in self.tree_management.cache_files.items():
-            file_path = file_dict["file_path"]
-            file_type = file_dict["file_type"]
-            # Check for Flywheel compressed dicom
-            if self.is_compressed_dicom(file_path, file_type):
-                try:
-                    self.load_dicom_archive(file_path)
-                    continue
-                except Exception as e:
-                    print("Not a valid DICOM archive.")
-            # Load using Slicer default node reader
-            if not slicer.app.ioManager().loadFile(file_path):
-                print("Failed to read file: " + file_path)
+            self.file_cache.clear()
+
+        failed = []
+        with self.tree_management.transferring():
+            # Load each file as soon as it is cached and extracted.
+            # This could use "types"
+            for job in self.tree_management.cache_selected_for_open():
+                file_name = job["file"].name
+                if "file_path" not in job:
+                    error = job.get("error")
+                    print(f"Failed to download {file_name}: {error}")
+                    failed.append(f"{file_name}: {error}")
+                elif not self.logic.load_file(
+                    job["file_path"], job.get("dicom_dir"), job["file"]
+                ):
+                    failed.append(f"{file_name}: could not be read")
+        if failed:
+            slicer.util.errorDisplay("Failed to load:\n" + "\n".join(failed))
 
     def save_analysis(self, parent_container_item, output_path):
         """
         Save selected files to a new analysis container under a parent container.
 
+        The cached files loaded in Slicer are referenced as inputs of the analysis.
+
         Args:
             parent_container_item (ContainerItem): Tree Item representation of parent
                 container.
             output_path (Path): Temporary path to where Slicer files are saved.
         """
         parent_container = self.fw_client.get(parent_container_item.data())
-
-        # Get all cached paths represented in Slicer
-        input_files_paths = [
-            Path(node.GetFileName())
-            for node in slicer.util.getNodesByClass("vtkMRMLStorageNode")
-            if self.CacheDir in node.GetFileName()
-        ]
-
-        # Represent those files as file reference from their respective parents
-        input_files = [
-            self.fw_client.get(str(input_path.parents[1]).split("/")[-1])
-            .get_file(input_path.name)
-            .ref()
-            for input_path in input_files_paths
-        ]
-
-        # Generic name... could be improved.
-        analysis_name = "3D Slicer " + datetime.datetime.now().strftime(
-            "%Y-%m-%d %H:%M:%S"
-        )
-
-        # Create analysis container
-        analysis = parent_container.add_analysis(
-            label=analysis_name, inputs=input_files
+        analysis = self.logic.create_analysis(
+            parent_container, self.logic.cached_inputs()
         )
 
         # Get all files from temp directory
@@ -377,32 +664,90 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         ]
 
         # Finalize analysis
-        analysis.upload_file(outputs)
+        self.upload_files(analysis, outputs)
+        self.fw_client.invalidate(parent_container.id)
 
     def save_files_to_container(self, parent_container_item, output_path):
         """
         Save selected files to a parent Flywheel container.
 
-        Files that already exist in the container are ignored.
-
-        TODO: Update the file version
+        Files are compared by content with the files of the container: unchanged
+        files are skipped and changed files are uploaded as new versions.
 
         Args:
             parent_container_item (ContainerItem):  Tree Item representation of parent
                 container.
             output_path (Path): Temporary path to where Slicer files are saved.
         """
-        parent_container = self.fw_client.get(parent_container_item.data()).reload()
-        parent_container_files = [fl.name for fl in parent_container.files]
-        for output_file in [
+        # Compare with the current files of the container, not a cached list
+        self.fw_client.invalidate(parent_container_item.data())
+        parent_container = self.fw_client.get(parent_container_item.data())
+        output_files = [
             file_path
             for file_path in glob(str(output_path / "*"))
-            if (
-                Path(file_path).is_file()
-                and Path(file_path).name not in parent_container_files
+            if Path(file_path).is_file()
+        ]
+        self.upload_files(
+            parent_container, output_files, self.logic.known_hashes(parent_container)
+        )
+        self.fw_client.invalidate(parent_container.id)
+
+    def upload_files(self, container, file_paths, known_hashes=None):
+        """
+        Upload files to a container concurrently, showing their progress.
+
+        Uploads run in worker threads while Slicer events are processed. Failed
+        uploads are retried with backoff and reported once all uploads completed.
+
+        Args:
+            container (flywheel.Container): Container to upload the files to.
+            file_paths (list): Paths of the files to upload.
+            known_hashes (dict, optional): sha384 digests of the files in the
+                container by name. Files with the same name and content are skipped.
+
+        Returns:
+            list: Paths of the files that failed to upload.
+        """
+        failed = []
+        if not file_paths:
+            return failed
+        self.logic.upload_manager.max_workers = self.uploadWorkersSpinBox.value
+        progress = slicer.util.createProgressDialog(
+            windowTitle="Uploading to Flywheel",
+            labelText=f"Uploading {len(file_paths)} files...",
+            maximum=len(file_paths),
+        )
+        try:
+            uploads = self.logic.upload_files(
+                container,
+                file_paths,
+                known_hashes=known_hashes,
+                idle_callback=slicer.app.processEvents,
+            )
+            for done, (file_path, result) in enumerate(uploads, 1):
+                file_name = Path(file_path).name
+                if result["error"]:
+                    failed.append(file_path)
+                    print(f"Failed to upload {file_name}: {result['error']}")
+                    status = "Failed to upload"
+                elif result["uploaded"]:
+                    status = "Uploaded"
+                else:
+                    status = "Unchanged, skipped"
+                progress.setValue(done)
+                progress.setLabelText(
+                    f"{status} {file_name} ({done} of {len(file_paths)})"
+                )
+                # Queued uploads are cancelled when leaving the loop
+                if progress.wasCanceled:
+                    break
+        finally:
+            progress.close()
+        if failed:
+            slicer.util.errorDisplay(
+                "Failed to upload:\n" + "\n".join(Path(fl).name for fl in failed)
             )
-        ]:
-            parent_container.upload_file(output_file)
+        return failed
 
     def save_scene_to_flywheel(self):
         """
@@ -417,10 +762,12 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
                 index = self.treeView.selectedIndexes()[0]
                 container_item = self.tree_management.source_model.itemFromIndex(index)
                 save_as_analysis = self.asAnalysisCheck.isChecked()
-                if save_as_analysis:
-                    self.save_analysis(container_item, output_path)
-                else:
-                    self.save_files_to_container(container_item, output_path)
+                # Events are processed during uploads, do not start another save
+                with self.tree_management.transferring():
+                    if save_as_analysis:
+                        self.save_analysis(container_item, output_path)
+                    else:
+                        self.save_files_to_container(container_item, output_path)
 
             # Remove storage nodes with the tmp_output_path in them
             for node in [
@@ -430,6 +777,47 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
             ]:
                 slicer.mrmlScene.RemoveNode(node)
 
+    def onCacheSizeChanged(self, size):
+        """
+        Update the size limit of the cache, remember it and evict files above it.
+
+        Args:
+            size (int): Size limit in GB.
+        """
+        qt.QSettings().setValue(CACHE_SIZE_SETTING, size)
+        self.file_cache.max_bytes = size * 1024 ** 3
+        self.file_cache.evict()
+
+    def onRefreshMetrics(self, checked=True):
+        """
+        Show the summary of the recorded timings and counters.
+
+        Args:
+            checked (bool, optional): Whether the panel is expanded.
+        """
+        if checked:
+            self.metricsTextEdit.setPlainText(METRICS.format_summary())
+
+    def onClearMetrics(self):
+        """
+        Remove the recorded timings and counters.
+        """
+        METRICS.clear()
+        self.onRefreshMetrics()
+
+    def onExportMetrics(self):
+        """
+        Save the recorded timings and counters to a JSON lines file.
+        """
+        file_path = qt.QFileDialog.getSaveFileName(
+            None,
+            "Export Flywheel Connect Metrics",
+            str(Path.home() / "flywheel_connect_metrics.jsonl"),
+            "JSON lines (*.jsonl)",
+        )
+        if file_path:
+            METRICS.export(file_path)
+
     def onAnalysisCheckChanged(self, item):
         """
         Update the text on the "Upload" button depending on item state
@@ -444,7 +832,10 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
         self.uploadFilesButton.setText(text)
 
     def cleanup(self):
-        pass
+        """
+        Write the access times of the cache hits not written yet.
+        """
+        self.file_cache.flush()
 
 
 #
@@ -453,81 +844,537 @@ class flywheel_connectWidget(ScriptedLoadableModuleWidget):
 
 
 class flywheel_connectLogic(ScriptedLoadableModuleLogic):
-    """This class should implement all the actual
-    computation done by your module.  The interface
-    should be such that other python code can import
-    this class and make use of the functionality without
-    requiring an instance of the Widget.
+    """
+    Download, cache, load and upload Flywheel files without the module widget.
+
+    The widget drives the same logic from its tree. Scripts can use it directly,
+    e.g. for batch jobs run with `Slicer --no-main-window --python-script`:
+
+        logic = flywheel_connectLogic()
+        logic.connect(api_key)
+        results = logic.fetch_and_load([session_id], file_types=["dicom"])
+
     Uses ScriptedLoadableModuleLogic base class, available at:
     https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
     """
 
-    def hasImageData(self, volumeNode):
-        """This is an example logic method that
-        returns true if the passed in volume
-        node has valid image data
+    def __init__(
+        self,
+        cache_dir=DEFAULT_CACHE_DIR,
+        max_bytes=DEFAULT_MAX_BYTES,
+        download_workers=DEFAULT_MAX_WORKERS,
+        upload_workers=DEFAULT_MAX_WORKERS,
+    ):
         """
-        if not volumeNode:
-            logging.debug("hasImageData failed: no volume node")
-            return False
-        if volumeNode.GetImageData() is None:
-            logging.debug("hasImageData failed: no image data in volume node")
-            return False
-        return True
+        Initialize the file cache and the transfer workers.
 
-    def isValidInputOutputData(self, inputVolumeNode, outputVolumeNode):
-        """Validates if the output is not the same as input"""
-        if not inputVolumeNode:
-            logging.debug("isValidInputOutputData failed: no input volume node defined")
-            return False
-        if not outputVolumeNode:
-            logging.debug(
-                "isValidInputOutputData failed: no output volume node defined"
+        Args:
+            cache_dir (str or pathlib.Path, optional): Directory of the disk cache.
+            max_bytes (int, optional): Size limit of the disk cache.
+            download_workers (int, optional): Number of concurrent downloads.
+            upload_workers (int, optional): Number of concurrent uploads.
+        """
+        ScriptedLoadableModuleLogic.__init__(self)
+        self.cache_dir = Path(cache_dir)
+        self.file_cache = FileCache(self.cache_dir, max_bytes)
+        self.download_workers = download_workers
+        self.upload_manager = UploadManager(upload_workers)
+        self.fw_client = None
+        self.metadata_cache = None
+
+    def connect(self, api_key=None):
+        """
+        Connect to a Flywheel instance and open the metadata cache of the user.
+
+        Args:
+            api_key (str, optional): Flywheel API key. Defaults to the key of the
+                Flywheel CLI login.
+
+        Returns:
+            tuple: (str, str) email of the logged in user and API url of the site.
+        """
+        flywheel = import_flywheel()
+        with METRICS.span("api.connect"):
+            # Reuse containers fetched within the last seconds
+            if api_key:
+                fw_client = CachedClient(flywheel.Client(api_key))
+            else:
+                fw_client = CachedClient(flywheel.Client())
+            fw_user = fw_client.get_current_user()["email"]
+            fw_site = fw_client.get_config()["site"]["api_url"]
+
+        self.fw_client = fw_client
+        if self.metadata_cache:
+            self.metadata_cache.close()
+        self.metadata_cache = MetadataCache(
+            self.metadata_cache_path(fw_user, fw_site), self.fw_client
+        )
+        # Resume interrupted downloads with range requests
+        self.file_cache.client = self.fw_client
+        return fw_user, fw_site
+
+    def metadata_cache_path(self, fw_user, fw_site):
+        """
+        Path to the metadata cache database of a user on a Flywheel instance.
+
+        The database is kept next to the disk cache, so that clearing the disk cache
+        keeps the metadata.
+
+        Args:
+            fw_user (str): Email of the logged in user.
+            fw_site (str): API url of the Flywheel instance.
+
+        Returns:
+            pathlib.Path: Path to the SQLite database.
+        """
+        key = hashlib.sha1(f"{fw_user}@{fw_site}".encode()).hexdigest()[:16]
+        return (
+            self.cache_dir.parent / f"{self.cache_dir.name}_metadata" / f"{key}.sqlite"
+        )
+
+    def _get_file(self, file_id):
+        """
+        Retrieve a file and its parent container by file id.
+
+        Args:
+            file_id (str): Flywheel id of the file.
+
+        Returns:
+            tuple: (flywheel.Container, flywheel.FileEntry) parent and file.
+        """
+        file_entry = self.fw_client.get_file(file_id)
+        parent = self.fw_client.get(file_entry.parent_ref["id"])
+        for fl in parent.files:
+            if fl.id == file_id:
+                return parent, fl
+        return parent, file_entry
+
+    def _container_files(self, container):
+        """
+        List the files of a container and of all containers below it.
+
+        Args:
+            container (flywheel.Container): Container to list the files of.
+
+        Returns:
+            list: (flywheel.Container, flywheel.FileEntry) parent and file tuples.
+        """
+        files = [(container, fl) for fl in container.files or []]
+        child_type = CHILD_TYPES.get(container.container_type)
+        if child_type:
+            for child in getattr(container, child_type)():
+                files.extend(self._container_files(child))
+        return files
+
+    def resolve_files(self, ids, file_types=None, name_pattern=None):
+        """
+        Resolve container and file ids to the files to fetch.
+
+        A container id resolves to the files of the container and of the containers
+        below it (e.g. the acquisition files of a session).
+
+        Args:
+            ids (list): Flywheel ids of containers or files.
+            file_types (list, optional): Flywheel file types to keep (e.g. "dicom").
+            name_pattern (str, optional): Shell-style pattern of the file names to
+                keep (e.g. "*.nii.gz").
+
+        Returns:
+            list: Distinct (flywheel.Container, flywheel.FileEntry) parent and file
+                tuples.
+        """
+        files = []
+        for fw_id in ids:
+            try:
+                files.extend(self._container_files(self.fw_client.get(fw_id)))
+            except flywheel.ApiException as e:
+                if e.status != 404:
+                    raise
+                files.append(self._get_file(fw_id))
+        selected = {}
+        for parent, fl in files:
+            if (not file_types or fl.type in file_types) and (
+                not name_pattern or fnmatch.fnmatch(fl.name, name_pattern)
+            ):
+                selected.setdefault((parent.id, fl.id), (parent, fl))
+        return list(selected.values())
+
+    def _download_job(self, job):
+        """
+        Pipeline stage downloading the file of a job and its companions to the cache.
+
+        Args:
+            job (dict): Job with the "parent" and "file" to download.
+
+        Returns:
+            dict: Job with "file_path" and "file_type" of the cached file.
+        """
+        file_path = self.file_cache.fetch_with_companions(job["parent"], job["file"])
+        job["file_path"] = str(file_path)
+        job["file_type"] = job["file"].type
+        return job
+
+    def extract_job(self, job):
+        """
+        Pipeline stage extracting compressed dicoms of a cached file job.
+
+        Args:
+            job (dict): Job with the "file_path" and "file_type" of a cached file.
+
+        Returns:
+            dict: Job with "dicom_dir" set for a valid dicom archive.
+        """
+        if self.is_compressed_dicom(job["file_path"], job["file_type"]):
+            try:
+                job["dicom_dir"] = str(self.file_cache.extract(job["file_path"]))
+            except Exception as e:
+                print("Not a valid DICOM archive.")
+        return job
+
+    def fetch_files(self, files, idle_callback=None, extract=True):
+        """
+        Download files to the cache and extract their DICOM archives.
+
+        Files are run through a LoadPipeline: archives are extracted while later
+        files are still downloading. The files are fetched as one cache batch, so
+        that none of them is evicted before all are yielded.
+
+        Args:
+            files (list): (parent, file) tuples, as returned by resolve_files.
+            idle_callback (callable, optional): Called on the calling thread while
+                waiting for files (e.g. to process GUI events).
+            extract (bool, optional): Extract the DICOM archives.
+
+        Yields:
+            dict: Jobs with the "parent" and "file" and, once cached, the
+                "file_path", "file_type" and "dicom_dir" of each file, in completion
+                order. Failed jobs have their "error" set.
+        """
+        pipeline = LoadPipeline()
+        pipeline.add_stage("download", self._download_job, self.download_workers)
+        if extract:
+            pipeline.add_stage("extract", self.extract_job, 1)
+        jobs = [{"parent": parent, "file": fl} for parent, fl in files]
+        with self.file_cache.batch():
+            yield from pipeline.run(jobs, idle_callback=idle_callback)
+
+    def fetch_and_load(self, ids, file_types=None, name_pattern=None):
+        """
+        Download files of containers or by id and load them into the scene.
+
+        Args:
+            ids (list): Flywheel ids of containers or files.
+            file_types (list, optional): Flywheel file types to keep.
+            name_pattern (str, optional): Shell-style pattern of the file names.
+
+        Returns:
+            dict: "loaded" paths of the loaded files and "failed" names of the files
+                that failed to download or load.
+        """
+        results = {"loaded": [], "failed": []}
+        files = self.resolve_files(ids, file_types, name_pattern)
+        for job in self.fetch_files(files):
+            if "file_path" in job and self.load_file(
+                job["file_path"], job.get("dicom_dir"), job["file"]
+            ):
+                results["loaded"].append(job["file_path"])
+            else:
+                results["failed"].append(job["file"].name)
+        return results
+
+    def is_compressed_dicom(self, file_path, file_type):
+        """
+        Check file_path and file_type for a flywheel compressed dicom archive.
+
+        Args:
+            file_path (str): Path to cached file
+            file_type (str): Type of Flywheel file
+
+        Returns:
+            boolean: True for supported compressed dicom type
+        """
+        if file_path.endswith(".zip") and file_type == "dicom":
+            return True
+
+        return False
+
+    def load_file(self, file_path, dicom_dir=None, file_obj=None):
+        """
+        Load a cached file into the scene. Must run on the main thread.
+
+        Args:
+            file_path (str): Path to the cached file.
+            dicom_dir (str, optional): Directory the file was extracted to, for a
+                compressed dicom archive.
+            file_obj (flywheel.FileEntry or FileRecord, optional): Flywheel file.
+
+        Returns:
+            bool: True if the file was loaded.
+        """
+        # Check for extracted Flywheel compressed dicom
+        if dicom_dir:
+            try:
+                self.load_dicom_directory(dicom_dir, file_obj)
+                return True
+            except Exception as e:
+                print("Not a valid DICOM archive.")
+        # Load using Slicer default node reader
+        with METRICS.span("load", bytes=os.path.getsize(file_path)) as span:
+            loaded = slicer.app.ioManager().loadFile(file_path)
+            if not loaded:
+                span["error"] = "load failed"
+        if not loaded:
+            print("Failed to read file: " + file_path)
+        return bool(loaded)
+
+    def load_dicom_directory(self, dicomDataDir, file_obj=None):
+        """
+        Import and load a directory of DICOMs into Slicer.
+
+        The loadables computed for a Flywheel file are indexed by file id and
+        version in the metadata cache. A series loaded before is loaded from the
+        index, without importing the directory or parsing its headers again.
+
+        The DICOM database and the scene are not thread-safe, so this must run on the
+        main thread.
+
+        Args:
+            dicomDataDir (str): directory of extracted DICOMs.
+            file_obj (flywheel.FileEntry or FileRecord, optional): Flywheel file the
+                DICOMs were extracted from.
+
+        https://discourse.slicer.org/t/fastest-way-to-load-dicom/9317/2
+        """
+        indexed = file_obj is not None and self.metadata_cache is not None
+        if indexed:
+            entry = self.metadata_cache.get_dicom_loadables(
+                file_obj.id, file_obj.version
             )
-            return False
-        if inputVolumeNode.GetID() == outputVolumeNode.GetID():
-            logging.debug(
-                "isValidInputOutputData failed: input and output volume is the same. "
-                "Create a new volume for output to avoid this error."
+            loadablesByPlugin = entry and restore_loadables(
+                entry["loadables"], dicomDataDir
             )
-            return False
-        return True
+            if loadablesByPlugin:
+                METRICS.count("dicom.index.hit")
+                # The DICOM database may have been cleared since
+                if not in_database(entry):
+                    with METRICS.span("dicom.import"):
+                        DICOMLib.importDicom(dicomDataDir)
+                with METRICS.span("dicom.load"):
+                    DICOMLib.loadLoadables(loadablesByPlugin)
+                return
+
+        with METRICS.span("dicom.import"):
+            DICOMLib.importDicom(dicomDataDir)
+        with METRICS.span("dicom.examine"):
+            dicomFiles = slicer.util.getFilesInDirectory(dicomDataDir)
+            loadablesByPlugin, loadEnabled = DICOMLib.getLoadablesFromFileLists(
+                [dicomFiles]
+            )
+        if indexed:
+            entry = index_entry(loadablesByPlugin, dicomDataDir)
+            if entry:
+                self.metadata_cache.put_dicom_loadables(
+                    file_obj.id, file_obj.version, entry
+                )
+        with METRICS.span("dicom.load"):
+            loadedNodeIDs = DICOMLib.loadLoadables(loadablesByPlugin)
 
-    def run(self, inputVolume, outputVolume, imageThreshold, enableScreenshots=0):
+    def cached_inputs(self):
         """
-        Run the actual algorithm
+        Paths of the cached files loaded in the scene.
+
+        Returns:
+            list: pathlib.Path of the files of the storage nodes in the cache.
         """
+        return [
+            Path(node.GetFileName())
+            for node in slicer.util.getNodesByClass("vtkMRMLStorageNode")
+            if node.GetFileName() and str(self.cache_dir) in node.GetFileName()
+        ]
 
-        if not self.isValidInputOutputData(inputVolume, outputVolume):
-            slicer.util.errorDisplay(
-                "Input volume is the same as output volume. "
-                "Choose a different output volume."
+    def resolve_input_refs(self, input_files_paths):
+        """
+        Represent cached files as file references to their Flywheel parents.
+
+        References are built from the parent recorded in the cache index at
+        download. Members extracted from an archive (e.g. DICOM slices) reference
+        the archive. Files cached without their parent are grouped by parent, and
+        each parent is fetched once.
+
+        Args:
+            input_files_paths (list): Paths of files in the cache.
+
+        Returns:
+            list: flywheel.FileReference of each distinct file.
+        """
+        refs = {}
+        by_parent = {}
+        for input_path in input_files_paths:
+            source = self.file_cache.file_source(input_path)
+            if source:
+                refs[input_path] = flywheel.FileReference(
+                    id=source["parent_id"],
+                    type=source["parent_type"],
+                    name=source["name"],
+                )
+            elif self.file_cache.is_object_path(input_path):
+                # Not under its parents, so the path does not name the parent
+                print(f"No Flywheel source recorded for {input_path.name}.")
+            else:
+                # cache_root/.../parent_id/file_id/file_name
+                by_parent.setdefault(input_path.parents[1].name, []).append(input_path)
+
+        for parent_id, paths in by_parent.items():
+            try:
+                parent = self.fw_client.get(parent_id)
+            except Exception as e:
+                print(f"Failed to find the parent of {paths[0].name}: {e}")
+                continue
+            for input_path in paths:
+                file_obj = parent.get_file(input_path.name)
+                if file_obj:
+                    refs[input_path] = file_obj.ref()
+
+        # A file may be referenced by several storage nodes
+        unique_refs = {(ref.id, ref.type, ref.name): ref for ref in refs.values()}
+        return list(unique_refs.values())
+
+    def create_analysis(self, parent_container, input_files_paths, label=None):
+        """
+        Create an analysis container referencing cached input files.
+
+        Args:
+            parent_container (flywheel.Container): Parent of the analysis.
+            input_files_paths (list): Paths of the cached input files.
+            label (str, optional): Label of the analysis. Defaults to a timestamped
+                "3D Slicer" label.
+
+        Returns:
+            flywheel.AnalysisOutput: The new analysis container.
+        """
+        if not label:
+            # Generic name... could be improved.
+            label = "3D Slicer " + datetime.datetime.now().strftime(
+                "%Y-%m-%d %H:%M:%S"
             )
-            return False
+        input_files = self.resolve_input_refs(input_files_paths)
+        return parent_container.add_analysis(label=label, inputs=input_files)
 
-        logging.info("Processing started")
-
-        # Compute the thresholded output volume using the Threshold Scalar Volume
-        # CLI module
-        cliParams = {
-            "InputVolume": inputVolume.GetID(),
-            "OutputVolume": outputVolume.GetID(),
-            "ThresholdValue": imageThreshold,
-            "ThresholdType": "Above",
-        }
-        cliNode = slicer.cli.run(
-            slicer.modules.thresholdscalarvolume,
-            None,
-            cliParams,
-            wait_for_completion=True,
+    def known_hashes(self, container):
+        """
+        Content of the files of a container, to skip unchanged files on upload.
+
+        The content of a file is known from its server-side hash or, if the server
+        does not report one, from the local record of past uploads.
+
+        Args:
+            container (flywheel.Container): Reloaded container.
+
+        Returns:
+            dict: sha384 digests of the files by name.
+        """
+        known_hashes = {}
+        if self.metadata_cache:
+            known_hashes.update(self.metadata_cache.get_uploads(container.id))
+        for fl in container.files:
+            if content_key(fl):
+                known_hashes[fl.name] = content_key(fl)
+        return known_hashes
+
+    def upload_files(
+        self, container, file_paths, known_hashes=None, idle_callback=None
+    ):
+        """
+        Upload files to a container concurrently, recording their content.
+
+        Failed uploads are retried with backoff.
+
+        Args:
+            container (flywheel.Container): Container to upload the files to.
+            file_paths (list): Paths of the files to upload.
+            known_hashes (dict, optional): sha384 digests of the files in the
+                container by name. Files with the same name and content are skipped.
+            idle_callback (callable, optional): Called on the calling thread while
+                waiting for uploads.
+
+        Yields:
+            tuple: (str, dict) path and upload result of each file, in completion
+                order (see UploadManager.upload).
+        """
+        uploads = self.upload_manager.upload(
+            container,
+            file_paths,
+            idle_callback=idle_callback,
+            known_hashes=known_hashes,
         )
+        for file_path, result in uploads:
+            if result["uploaded"] and self.metadata_cache and result["sha384"]:
+                self.metadata_cache.put_upload(
+                    container.id, Path(file_path).name, result["sha384"]
+                )
+            yield file_path, result
+
+    def upload_to_container(self, container_id, file_paths):
+        """
+        Upload files to a container, skipping the unchanged ones.
+
+        Args:
+            container_id (str): Flywheel id of the container.
+            file_paths (list): Paths of the files to upload.
+
+        Returns:
+            list: Paths of the files that failed to upload.
+        """
+        # Compare with the current files of the container, not a cached list
+        self.fw_client.invalidate(container_id)
+        container = self.fw_client.get(container_id)
+        failed = [
+            file_path
+            for file_path, result in self.upload_files(
+                container, file_paths, self.known_hashes(container)
+            )
+            if result["error"]
+        ]
+        self.fw_client.invalidate(container.id)
+        return failed
 
-        # Capture screenshot
-        if enableScreenshots:
-            self.takeScreenshot("flywheel_connectTest-Start", "MyScreenshot", -1)
+    def upload_analysis(
+        self, container_id, file_paths, input_files_paths=(), label=None
+    ):
+        """
+        Upload files as the outputs of a new analysis under a container.
 
-        logging.info("Processing completed")
+        Args:
+            container_id (str): Flywheel id of the parent container.
+            file_paths (list): Paths of the output files.
+            input_files_paths (list, optional): Paths of the cached input files.
+            label (str, optional): Label of the analysis.
 
+        Returns:
+            tuple: (flywheel.AnalysisOutput, list) the analysis and the paths of the
+                files that failed to upload.
+        """
+        parent_container = self.fw_client.get(container_id)
+        analysis = self.create_analysis(parent_container, input_files_paths, label)
+        failed = [
+            file_path
+            for file_path, result in self.upload_files(analysis, file_paths)
+            if result["error"]
+        ]
+        self.fw_client.invalidate(parent_container.id)
+        return analysis, failed
+
+    def hasImageData(self, volumeNode):
+        """This is an example logic method that
+        returns true if the passed in volume
+        node has valid image data
+        """
+        if not volumeNode:
+            logging.debug("hasImageData failed: no volume node")
+            return False
+        if volumeNode.GetImageData() is None:
+            logging.debug("hasImageData failed: no image data in volume node")
+            return False
         return True
 
 
@@ -0,0 +1,520 @@
+import queue
+import threading
+
+import slicer
+from PythonQt import QtGui
+from PythonQt.QtCore import QTimer
+
+from .metadata_cache import ContainerRecord, modified_text
+from .metrics import METRICS
+
+# Number of child containers requested from the server per page
+PAGE_SIZE = 250
+
+# Server-side sort order of the child containers
+SORT_ORDER = "label:asc"
+
+# Number of child items inserted into the tree per timer tick
+BATCH_SIZE = 100
+
+# Milliseconds between two batch insertions
+BATCH_INTERVAL = 10
+
+# Milliseconds between two checks for the result of a background task
+POLL_INTERVAL = 50
+
+# Seconds during which a cached listing is drawn without revalidation
+FRESH_FOR = 300
+
+# Marks the end of a fetched page
+_END = object()
+
+
+class BackgroundTask:
+    """
+    Run a function in a worker thread and pass its result to a callback on the GUI
+    thread.
+    """
+
+    # Tasks currently running, kept alive until their callback is called
+    active = set()
+
+    def __init__(self, func, callback, error_callback=None):
+        """
+        Initialize a background task.
+
+        Args:
+            func (callable): Function run in the worker thread without arguments.
+                Must not touch Qt objects.
+            callback (callable): Called on the GUI thread with the result of func.
+            error_callback (callable, optional): Called on the GUI thread with the
+                exception raised by func. By default, the error is displayed.
+        """
+        self.func = func
+        self.callback = callback
+        self.error_callback = error_callback
+        self._result = None
+        self._error = None
+        self._done = threading.Event()
+        self._cancelled = False
+        self._timer = QTimer()
+        self._timer.timeout.connect(self._poll)
+
+    def start(self):
+        """
+        Start the function in a worker thread.
+        """
+        BackgroundTask.active.add(self)
+        worker = threading.Thread(target=self._run)
+        worker.daemon = True
+        worker.start()
+        self._timer.start(POLL_INTERVAL)
+
+    def _run(self):
+        """
+        Run the function. Runs in the worker thread.
+        """
+        try:
+            self._result = self.func()
+        except Exception as e:
+            self._error = e
+        self._done.set()
+
+    def _poll(self):
+        """
+        Pass the result to the callback once the function returned.
+        """
+        if not self._done.is_set():
+            return
+        self._timer.stop()
+        BackgroundTask.active.discard(self)
+        if self._cancelled:
+            return
+        if self._error:
+            if self.error_callback:
+                self.error_callback(self._error)
+            else:
+                slicer.util.errorDisplay(f"Background task failed: {self._error}")
+        else:
+            self.callback(self._result)
+
+    def cancel(self):
+        """
+        Drop the result of the task.
+        """
+        self._cancelled = True
+        self._timer.stop()
+        BackgroundTask.active.discard(self)
+
+
+class LoadMoreItem(QtGui.QStandardItem):
+    """
+    Tree node listing the next page of child containers when double-clicked.
+    """
+
+    def __init__(self, loader):
+        """
+        Initialize the "Load more..." node of a loader.
+
+        Args:
+            loader (ChildLoader): Loader of the folder this node belongs to.
+        """
+        super(LoadMoreItem, self).__init__("Load more…")
+        self.loader = loader
+        self.setToolTip("Double-Click to list more.")
+
+    def _dblclicked(self):
+        self.loader.load_more()
+
+
+class RetryItem(LoadMoreItem):
+    """
+    Tree node reporting a failed listing, listing again when double-clicked.
+    """
+
+    def __init__(self, loader, message, error, retry):
+        """
+        Initialize the node of a failed listing.
+
+        Args:
+            loader (ChildLoader): Loader of the folder this node belongs to.
+            message (str): What failed (e.g. "Failed to list").
+            error (Exception): Error of the listing.
+            retry (callable): Lists again.
+        """
+        super(RetryItem, self).__init__(loader)
+        self.retry = retry
+        self.setText(f"{message}: {error}")
+        self.setToolTip(f"{error}\nDouble-Click to retry.")
+
+    def _dblclicked(self):
+        self.retry()
+
+
+class ChildLoader:
+    """
+    List child containers of a tree node page by page without blocking the GUI.
+
+    Each page is requested, sorted on the server, from a worker thread, which
+    streams the child containers into a queue. A timer on the GUI thread drains the
+    queue and inserts the tree items in batches. A "Loading..." placeholder is shown
+    under the folder in the meantime. If the page is full, a "Load more..." node is
+    appended to list the next page. If listing fails, the error is shown in a node
+    listing the page again on double-click.
+
+    With a metadata cache, the first page of a listing cached on disk is drawn right
+    away and then revalidated against the server in the background. Only added,
+    removed or modified children are updated in the tree, and the cached rows are
+    kept if the revalidation fails. Listings stored within the last FRESH_FOR
+    seconds (e.g. prefetched with the project) are not revalidated: their cached
+    rows are drawn page by page, and no "Load more..." node follows the last page
+    of a complete listing.
+    """
+
+    # Loaders currently running, so that they can be cancelled with the tree
+    active = set()
+
+    def __init__(
+        self,
+        folder_item,
+        container,
+        child_type,
+        item_class,
+        metadata_cache=None,
+        page_size=PAGE_SIZE,
+        batch_size=BATCH_SIZE,
+    ):
+        """
+        Initialize the loader of a folder item.
+
+        Args:
+            folder_item (FolderItem): Folder to populate (e.g. SUBJECTS).
+            container (flywheel.Container or ContainerRecord): Parent container.
+            child_type (str): Name of the SDK finder of the children (e.g.
+                "subjects"). The finder is called from the worker thread, on the
+                container or, for a record, on the client with a parent filter.
+            item_class (type): ContainerItem subclass to instantiate for each child.
+            metadata_cache (MetadataCache, optional): Persistent cache of listings.
+            page_size (int, optional): Number of children requested per page.
+            batch_size (int, optional): Number of items inserted per timer tick.
+        """
+        self.folder_item = folder_item
+        self.container = container
+        self.child_type = child_type
+        self.item_class = item_class
+        self.metadata_cache = metadata_cache
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.loading = False
+        self.listed = 0
+        self._page_count = 0
+        self._page_start_row = 0
+        self._from_cache = False
+        self._fresh = False
+        self._complete = False
+        self._stale = False
+        self._error = None
+        self._cached = []
+        self._cached_page = []
+        self._queue = queue.Queue()
+        self._cancelled = threading.Event()
+        self._placeholder = None
+        self._revalidation = None
+        self._timer = QTimer()
+        self._timer.timeout.connect(self._insert_batch)
+
+    def start(self):
+        """
+        Start listing the children, from the metadata cache if possible.
+        """
+        self.listed = 0
+        cached = None
+        if self.metadata_cache:
+            cached = self.metadata_cache.get_children(
+                self.container.id, self.child_type
+            )
+        if cached is not None:
+            age = self.metadata_cache.listing_age(self.container.id, self.child_type)
+            self._fresh = age is not None and age < FRESH_FOR
+            self._complete = self.metadata_cache.listing_complete(
+                self.container.id, self.child_type
+            )
+            self._cached = cached
+            self._draw_cached_page()
+        else:
+            self._complete = False
+            self._cached = []
+            self.load_more()
+
+    def load_more(self):
+        """
+        Show the placeholder and list the next page of children, from the rows of
+        the cached listing not drawn yet or else in the background.
+        """
+        if self.loading:
+            return
+        if self._cached:
+            self._draw_cached_page()
+            return
+        self._begin_page(from_cache=False)
+        worker = threading.Thread(
+            target=self._fetch_page, args=(self.listed, self._queue, self._cancelled)
+        )
+        worker.daemon = True
+        worker.start()
+
+    def _draw_cached_page(self):
+        """
+        Insert the next page of the rows of the cached listing.
+        """
+        self._cached_page = self._cached[: self.page_size]
+        self._cached = self._cached[self.page_size :]
+        self._begin_page(from_cache=True)
+        for record in self._cached_page:
+            self._queue.put(record)
+        self._queue.put(_END)
+
+    def _begin_page(self, from_cache):
+        """
+        Show the placeholder and start inserting the children of a new page.
+
+        Args:
+            from_cache (bool): The page is read from the metadata cache.
+        """
+        # Replace a "Load more..." (or retry) node with the placeholder
+        last_row = self.folder_item.rowCount() - 1
+        if last_row >= 0 and isinstance(self.folder_item.child(last_row), LoadMoreItem):
+            self.folder_item.removeRow(last_row)
+        self._page_start_row = self.folder_item.rowCount()
+        self._page_count = 0
+        self._from_cache = from_cache
+        self._error = None
+        self._placeholder = QtGui.QStandardItem("Loading…")
+        self._placeholder.setEnabled(False)
+        self._placeholder.setSelectable(False)
+        self.folder_item.appendRow(self._placeholder)
+
+        self.loading = True
+        self._queue = queue.Queue()
+        self._cancelled = threading.Event()
+        ChildLoader.active.add(self)
+        self._timer.start(BATCH_INTERVAL)
+
+    def _find(self, skip, limit):
+        """
+        Request a page of children sorted on the server and store it in the cache.
+
+        Args:
+            skip (int): Number of children to skip.
+            limit (int): Maximum number of children to return.
+
+        Returns:
+            list: Child containers (as records, with a metadata cache).
+        """
+        args = []
+        if isinstance(self.container, ContainerRecord):
+            # Records do not hold their SDK container: list through the site-wide
+            # finder rather than fetching the container first
+            finder = getattr(self.metadata_cache.client, self.child_type)
+            args.append(f"parents.{self.container.container_type}={self.container.id}")
+        else:
+            finder = getattr(self.container, self.child_type)
+        with METRICS.span(f"api.list.{self.child_type}") as span:
+            page = finder.find(*args, sort=SORT_ORDER, limit=limit, skip=skip)
+            span["containers"] = len(page)
+        if self.metadata_cache:
+            page = self.metadata_cache.put_children(
+                self.container.id,
+                self.child_type,
+                page,
+                skip=skip,
+                complete=len(page) < limit,
+            )
+        return page
+
+    def _fetch_page(self, skip, page_queue, cancelled):
+        """
+        Stream a page of children into the queue. Runs in the worker thread.
+
+        Args:
+            skip (int): Number of children already listed.
+            page_queue (queue.Queue): Queue of the page being listed.
+            cancelled (threading.Event): Set if the page listing was cancelled.
+        """
+        try:
+            for child in self._find(skip, self.page_size):
+                if cancelled.is_set():
+                    return
+                page_queue.put(child)
+        except Exception as e:
+            page_queue.put(e)
+        page_queue.put(_END)
+
+    def _insert_batch(self):
+        """
+        Insert the next batch of fetched children into the tree.
+
+        The items of the batch are built detached from the tree and inserted with a
+        single appendRows.
+        """
+        items = []
+        finished = False
+        for _ in range(self.batch_size):
+            try:
+                child = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if child is _END:
+                finished = True
+                break
+            if isinstance(child, Exception):
+                self._error = child
+                continue
+            items.append(self.item_class(self.folder_item, child))
+        if items:
+            self.folder_item.appendRows(items)
+            self._page_count += len(items)
+        if finished:
+            self._finish_page()
+
+    def _finish_page(self):
+        """
+        Remove the placeholder once the page is listed and offer the next page, or
+        to list the page again if it failed.
+        """
+        self._timer.stop()
+        self.folder_item.removeRow(self._placeholder.row())
+        self._placeholder = None
+        self.listed += self._page_count
+        self.loading = False
+        ChildLoader.active.discard(self)
+        if self._error:
+            self.folder_item.appendRow(
+                RetryItem(self, "Failed to list", self._error, self.load_more)
+            )
+        elif self._from_cache and not self._fresh:
+            self._revalidate()
+        # Cached rows are left to draw, or a full page of an incomplete listing
+        # means there may be more children on the server
+        elif self._cached or (
+            not self._complete and self._page_count >= self.page_size
+        ):
+            self.folder_item.appendRow(LoadMoreItem(self))
+
+    def resume(self):
+        """
+        Revalidate a listing drawn from the cache whose revalidation was cancelled.
+        """
+        if self._stale and not self.loading and not self._revalidation:
+            self._revalidate()
+
+    def _revalidate(self):
+        """
+        Fetch the children drawn from the cache again in the background.
+        """
+        self._stale = False
+        limit = max(self.listed, self.page_size)
+        self._revalidation = BackgroundTask(
+            lambda: self._find(0, limit),
+            lambda fresh: self._apply_revalidation(fresh, limit),
+            self._revalidation_failed,
+        )
+        ChildLoader.active.add(self)
+        self._revalidation.start()
+
+    def _revalidation_failed(self, error):
+        """
+        Keep the rows drawn from the cache and offer to revalidate them again.
+
+        Args:
+            error (Exception): Error of the revalidation.
+        """
+        self._revalidation = None
+        self._stale = True
+        ChildLoader.active.discard(self)
+        last_row = self.folder_item.rowCount() - 1
+        if last_row >= 0 and isinstance(self.folder_item.child(last_row), LoadMoreItem):
+            self.folder_item.removeRow(last_row)
+        self.folder_item.appendRow(
+            RetryItem(self, "Failed to refresh", error, self.resume)
+        )
+
+    def _apply_revalidation(self, fresh, limit):
+        """
+        Update the rows drawn from the cache with the children on the server.
+
+        Args:
+            fresh (list): Child containers on the server.
+            limit (int): Number of children requested.
+        """
+        self._revalidation = None
+        ChildLoader.active.discard(self)
+        # The listing stored by the revalidation replaces the cached rows
+        self._cached = []
+        self._complete = len(fresh) < limit
+        items = {}
+        load_more = None
+        for row in range(self.folder_item.rowCount()):
+            child = self.folder_item.child(row)
+            if isinstance(child, LoadMoreItem):
+                load_more = child
+            else:
+                items[child.data()] = child
+
+        fresh_ids = set()
+        added = []
+        for container in fresh:
+            fresh_ids.add(container.id)
+            item = items.get(container.id)
+            if item is None:
+                added.append(self.item_class(self.folder_item, container))
+            elif modified_text(item.container) != modified_text(container):
+                item._refresh(container)
+        for container_id, item in items.items():
+            if container_id not in fresh_ids:
+                self.folder_item.removeRow(item.row())
+        if added:
+            self.folder_item.appendRows(added)
+
+        self.listed = len(fresh)
+        if load_more:
+            self.folder_item.removeRow(load_more.row())
+        if len(fresh) >= limit:
+            self.folder_item.appendRow(LoadMoreItem(self))
+
+    def cancel(self):
+        """
+        Stop listing the current page and remove its rows.
+
+        Pages already listed are kept. If the first page was cancelled, the folder
+        is left empty, so it is listed again on the next expansion. A cancelled
+        revalidation is run again on the next expansion (see resume).
+        """
+        if self._revalidation:
+            self._revalidation.cancel()
+            self._revalidation = None
+            self._stale = True
+            ChildLoader.active.discard(self)
+        if not self.loading:
+            return
+        self._cancelled.set()
+        self._timer.stop()
+        if self._from_cache:
+            # Draw the rows of the cancelled page again with the next page
+            self._cached = self._cached_page + self._cached
+        self.folder_item.removeRows(
+            self._page_start_row, self.folder_item.rowCount() - self._page_start_row
+        )
+        self._placeholder = None
+        self.loading = False
+        ChildLoader.active.discard(self)
+        if self.listed > 0:
+            self.folder_item.appendRow(LoadMoreItem(self))
+
+    @classmethod
+    def cancel_all(cls):
+        """
+        Cancel all running loaders (e.g. before clearing the tree).
+        """
+        for loader in list(cls.active):
+            loader.cancel()
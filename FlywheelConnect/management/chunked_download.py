@@ -0,0 +1,316 @@
+import http.client
+import os
+import shutil
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+# Bytes read from the connection at a time
+CHUNK_SIZE = 1024 * 1024
+
+# Number of attempts to resume a transfer before giving up
+MAX_RETRIES = 5
+
+# Seconds to wait before the first retry, doubled on each retry
+BACKOFF = 1.0
+
+# Seconds without data before a connection is considered stalled
+TIMEOUT = 60
+
+# Files at least this large are fetched as several byte ranges in parallel
+PARALLEL_MIN_SIZE = 256 * 1024 ** 2
+
+# Number of byte ranges fetched in parallel for large files
+PARALLEL_RANGES = 4
+
+# Plural path segment of each container type in the API
+CONTAINER_PATHS = {
+    "group": "groups",
+    "project": "projects",
+    "subject": "subjects",
+    "session": "sessions",
+    "acquisition": "acquisitions",
+    "analysis": "analyses",
+}
+
+
+def sdk_file_request(client, file_parent, file_name):
+    """
+    Build the download request of a file from the configuration of an SDK client.
+
+    Args:
+        client (flywheel.Client): Authenticated client.
+        file_parent (flywheel.Container or ContainerRecord): Parent of the file.
+        file_name (str): Name of the file.
+
+    Returns:
+        tuple: (url, headers) of the request or None, if the client configuration
+            does not expose the API host and key.
+    """
+    try:
+        config = client.api_client.configuration
+        auth = config.get_api_key_with_prefix("Authorization")
+        host = config.host.rstrip("/")
+        container_path = CONTAINER_PATHS[file_parent.container_type]
+    except (AttributeError, KeyError):
+        return None
+    if not auth:
+        return None
+    url = "/".join(
+        [
+            host,
+            container_path,
+            file_parent.id,
+            "files",
+            urllib.parse.quote(file_name, safe=""),
+        ]
+    )
+    return url, {"Authorization": auth}
+
+
+class _RedirectHandler(urllib.request.HTTPRedirectHandler):
+    """
+    Follow redirects, dropping the credentials when leaving the host of the request.
+
+    Flywheel redirects downloads to signed storage urls, which must not receive the
+    API key.
+    """
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        new_request = super(_RedirectHandler, self).redirect_request(
+            req, fp, code, msg, headers, newurl
+        )
+        if new_request is not None:
+            old_host = urllib.parse.urlsplit(req.full_url).netloc
+            if urllib.parse.urlsplit(new_request.full_url).netloc != old_host:
+                new_request.remove_header("Authorization")
+        return new_request
+
+
+_opener = urllib.request.build_opener(_RedirectHandler)
+
+
+class RangeNotSupportedError(ValueError):
+    """
+    The server (or a proxy) answered a range request with the whole file.
+    """
+
+
+class ChunkedDownloader:
+    """
+    Download files in chunks, resuming interrupted transfers with range requests.
+
+    The partial file is kept on disk between attempts (and between sessions), and
+    the transfer resumes from its size with an HTTP Range request. If the server
+    ignores the Range header, the transfer starts over from the beginning. Large
+    files can be fetched as several byte ranges in parallel, each range resumable
+    on its own, falling back to a single transfer without range support. At the
+    end, the size of the file is checked.
+    """
+
+    def __init__(
+        self,
+        chunk_size=CHUNK_SIZE,
+        max_retries=MAX_RETRIES,
+        parallel_ranges=PARALLEL_RANGES,
+        parallel_min_size=PARALLEL_MIN_SIZE,
+        timeout=TIMEOUT,
+    ):
+        """
+        Initialize the downloader.
+
+        Args:
+            chunk_size (int, optional): Bytes read at a time.
+            max_retries (int, optional): Attempts to resume a transfer.
+            parallel_ranges (int, optional): Byte ranges fetched in parallel for
+                large files. 1 disables parallel ranges.
+            parallel_min_size (int, optional): Minimum size of a file fetched in
+                parallel ranges.
+            timeout (float, optional): Seconds without data before retrying.
+        """
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.parallel_ranges = max(1, int(parallel_ranges))
+        self.parallel_min_size = parallel_min_size
+        self.timeout = timeout
+
+    def download(self, url, dest, headers=None, size=None):
+        """
+        Download a url to a file, resuming a partial file left at dest.
+
+        Args:
+            url (str): Url of the file.
+            dest (pathlib.Path): Destination file. A partial file at this path is
+                resumed.
+            headers (dict, optional): Headers of the requests (e.g. Authorization).
+            size (int, optional): Expected size of the file in bytes.
+
+        Raises:
+            IOError: If the downloaded file does not have the expected size. The
+                partial file is removed.
+        """
+        dest = Path(dest)
+        headers = headers or {}
+        if size and self.parallel_ranges > 1 and size >= self.parallel_min_size:
+            try:
+                self._download_ranges(url, dest, headers, size)
+            except RangeNotSupportedError:
+                self._download_range(url, dest, headers, 0, size)
+        else:
+            self._download_range(url, dest, headers, 0, size)
+        self._verify(dest, size)
+
+    def _download_range(self, url, dest, headers, start, end, partial=False):
+        """
+        Download bytes [start, end) of a url to a file, resuming on failures.
+
+        Args:
+            url (str): Url of the file.
+            dest (pathlib.Path): File receiving the range. Its current size is the
+                number of bytes of the range already downloaded.
+            headers (dict): Headers of the requests.
+            start (int): First byte of the range.
+            end (int): End of the range (exclusive) or None for the end of file.
+            partial (bool, optional): The range is a part of the file, which can
+                not be replaced by the whole file.
+
+        Raises:
+            RangeNotSupportedError: If a part was answered with the whole file.
+        """
+        attempt = 0
+        while True:
+            done = dest.stat().st_size if dest.exists() else 0
+            if end is not None and start + done >= end:
+                return
+            error = None
+            try:
+                if self._fetch(url, dest, headers, start, start + done, end, partial):
+                    return
+            except (OSError, http.client.HTTPException) as e:
+                if isinstance(e, urllib.error.HTTPError):
+                    # The partial file already holds the whole file
+                    if e.code == 416 and end is None and done > 0:
+                        return
+                    if e.code < 500:
+                        raise
+                error = e
+            # Retries are counted from the last attempt that made progress
+            progressed = dest.exists() and dest.stat().st_size > done
+            attempt = 0 if progressed else attempt + 1
+            if attempt > self.max_retries:
+                raise error or IOError(f"Transfer of {url} keeps being interrupted.")
+            if error and not progressed:
+                time.sleep(BACKOFF * 2 ** (attempt - 1))
+
+    def _fetch(self, url, dest, headers, start, offset, end, partial=False):
+        """
+        Request the bytes of a range from offset and append them to the file.
+
+        Args:
+            url (str): Url of the file.
+            dest (pathlib.Path): File receiving the range.
+            headers (dict): Headers of the request.
+            start (int): First byte of the range.
+            offset (int): First byte to request.
+            end (int): End of the range (exclusive) or None for the end of file.
+            partial (bool, optional): The range is a part of the file.
+
+        Returns:
+            bool: True if the end of the range was reached.
+
+        Raises:
+            RangeNotSupportedError: If a part of the file was answered with the
+                whole file.
+        """
+        request_headers = dict(headers)
+        if offset > 0 or end is not None:
+            last = "" if end is None else str(end - 1)
+            request_headers["Range"] = f"bytes={offset}-{last}"
+        request = urllib.request.Request(url, headers=request_headers)
+        with _opener.open(request, timeout=self.timeout) as response:
+            mode = "ab"
+            if "Range" in request_headers and response.status != 206:
+                if partial:
+                    raise RangeNotSupportedError(
+                        f"Server does not support range requests: {url}"
+                    )
+                # The server sent the whole file: start over
+                mode = "wb"
+            with open(dest, mode) as fp:
+                for chunk in iter(lambda: response.read(self.chunk_size), b""):
+                    fp.write(chunk)
+            # Bytes announced by Content-Length but never received
+            truncated = bool(response.length)
+        if end is None:
+            return not truncated
+        return start + dest.stat().st_size >= end
+
+    def _download_ranges(self, url, dest, headers, size):
+        """
+        Download a large file as byte ranges in parallel and join them.
+
+        Args:
+            url (str): Url of the file.
+            dest (pathlib.Path): Destination file.
+            headers (dict): Headers of the requests.
+            size (int): Size of the file in bytes.
+
+        Raises:
+            RangeNotSupportedError: If the server does not support range requests.
+                The parts are removed.
+        """
+        range_size = -(-size // self.parallel_ranges)
+        ranges = []
+        for i in range(self.parallel_ranges):
+            start = i * range_size
+            end = min(size, start + range_size)
+            if start < end:
+                ranges.append((dest.with_name(f"{dest.name}.range{i}"), start, end))
+
+        errors = []
+
+        def download_part(part_path, start, end):
+            try:
+                self._download_range(url, part_path, headers, start, end, True)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=download_part, args=part) for part in ranges
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            if isinstance(errors[0], RangeNotSupportedError):
+                for part_path, _, _ in ranges:
+                    if part_path.exists():
+                        os.remove(part_path)
+            raise errors[0]
+
+        with open(dest, "wb") as fp:
+            for part_path, _, _ in ranges:
+                with open(part_path, "rb") as part:
+                    shutil.copyfileobj(part, fp, self.chunk_size)
+        for part_path, _, _ in ranges:
+            os.remove(part_path)
+
+    def _verify(self, dest, size):
+        """
+        Check the size of a downloaded file.
+
+        Args:
+            dest (pathlib.Path): Downloaded file.
+            size (int): Expected size or None.
+
+        Raises:
+            IOError: If the file is not as expected. The file is removed.
+        """
+        actual_size = dest.stat().st_size
+        if size is not None and actual_size != size:
+            os.remove(dest)
+            raise IOError(f"Downloaded {actual_size} of {size} bytes of {dest.name}.")
@@ -0,0 +1,183 @@
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import CLIENT_CACHE_HIT, CLIENT_CACHE_MISS, METRICS
+
+# Maximum number of containers kept in memory
+DEFAULT_MAX_SIZE = 256
+
+# Seconds a fetched container is reused before being fetched again
+DEFAULT_TTL = 60
+
+
+class TTLCache:
+    """
+    Size-bounded least-recently-used cache with time-to-live expiry.
+    """
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        """
+        Initialize an empty cache.
+
+        Args:
+            max_size (int, optional): Maximum number of entries.
+            ttl (float, optional): Seconds after which an entry expires.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Retrieve an entry that has not expired.
+
+        Args:
+            key (str): Key of the entry.
+
+        Returns:
+            object: Cached value or None, on a miss.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and time.monotonic() - entry[0] < self.ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        """
+        Store an entry, evicting the least recently used entry if full.
+
+        Args:
+            key (str): Key of the entry.
+            value (object): Value to cache.
+        """
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        """
+        Remove an entry.
+
+        Args:
+            key (str): Key of the entry.
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        Remove all entries and reset the counters.
+        """
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """
+        Report the usage of the cache.
+
+        Returns:
+            dict: Number of entries, hits and misses.
+        """
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class CachedClient:
+    """
+    Flywheel client reusing containers fetched within the last seconds.
+
+    `get` and `reload` are served from a shared TTLCache keyed by container id. Any
+    other attribute is passed through to the wrapped flywheel.Client. Containers
+    must be invalidated after they are changed (e.g. after uploads), or before
+    reading them when they must be current. Hits and misses are counted in METRICS.
+    """
+
+    def __init__(self, client, max_size=DEFAULT_MAX_SIZE, ttl=DEFAULT_TTL):
+        """
+        Wrap a flywheel client.
+
+        Args:
+            client (flywheel.Client): Client to wrap.
+            max_size (int, optional): Maximum number of cached containers.
+            ttl (float, optional): Seconds a container is reused.
+        """
+        self.client = client
+        self.cache = TTLCache(max_size, ttl)
+
+    def get(self, container_id):
+        """
+        Retrieve a container by id.
+
+        Args:
+            container_id (str): Flywheel id of the container.
+
+        Returns:
+            flywheel.Container: The container.
+        """
+        container = self._lookup(container_id)
+        if container is None:
+            with METRICS.span("api.get"):
+                container = self.client.get(container_id)
+            self.cache.put(container_id, container)
+        return container
+
+    def reload(self, container):
+        """
+        Reload a container, unless it was fetched within the time-to-live.
+
+        Args:
+            container (flywheel.Container or ContainerRecord): Container to reload.
+
+        Returns:
+            flywheel.Container: The reloaded container.
+        """
+        reloaded = self._lookup(container.id)
+        if reloaded is None:
+            with METRICS.span("api.reload"):
+                reloaded = container.reload()
+            self.cache.put(container.id, reloaded)
+        return reloaded
+
+    def _lookup(self, container_id):
+        """
+        Look up a container in the cache and count the hit or miss.
+
+        Args:
+            container_id (str): Flywheel id of the container.
+
+        Returns:
+            flywheel.Container: Cached container or None, on a miss.
+        """
+        container = self.cache.get(container_id)
+        METRICS.count(CLIENT_CACHE_MISS if container is None else CLIENT_CACHE_HIT)
+        return container
+
+    def invalidate(self, container_id):
+        """
+        Fetch a container again on its next use.
+
+        Args:
+            container_id (str): Flywheel id of the changed container.
+        """
+        self.cache.invalidate(container_id)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
@@ -0,0 +1,159 @@
+import json
+from pathlib import Path
+
+import DICOMLib
+import slicer
+
+# Tag of the series instance UID
+SERIES_INSTANCE_UID = "0020,000E"
+
+
+def _plugin_name(plugin):
+    """
+    Name of a DICOM plugin instance in slicer.modules.dicomPlugins.
+
+    Args:
+        plugin (DICOMPlugin): Plugin instance.
+
+    Returns:
+        str: Registered name of the plugin class or None.
+    """
+    for name, plugin_class in slicer.modules.dicomPlugins.items():
+        if isinstance(plugin, plugin_class):
+            return name
+    return None
+
+
+def _serialize_loadable(loadable, dicom_dir):
+    """
+    Represent a loadable as a JSON-serializable dict.
+
+    Args:
+        loadable (DICOMLoadable): Loadable computed by a plugin.
+        dicom_dir (pathlib.Path): Directory of the DICOM files of the loadable.
+
+    Returns:
+        dict: Attributes of the loadable, with files relative to dicom_dir, or None
+            if the loadable holds attributes that can not be stored.
+    """
+    attributes = {}
+    for name, value in vars(loadable).items():
+        try:
+            if name == "files":
+                value = [
+                    Path(file_path).relative_to(dicom_dir).as_posix()
+                    for file_path in value
+                ]
+            json.dumps(value)
+        except (TypeError, ValueError):
+            return None
+        attributes[name] = value
+    return attributes
+
+
+def serialize_loadables(loadablesByPlugin, dicom_dir):
+    """
+    Represent the selected loadables of a DICOM directory for storage.
+
+    Args:
+        loadablesByPlugin (dict): Loadables by plugin instance, as returned by
+            DICOMLib.getLoadablesFromFileLists.
+        dicom_dir (str): Directory of the DICOM files.
+
+    Returns:
+        list: Serialized loadables or None, if any of them can not be stored.
+    """
+    dicom_dir = Path(dicom_dir)
+    serialized = []
+    for plugin, loadables in loadablesByPlugin.items():
+        plugin_name = _plugin_name(plugin)
+        for loadable in loadables:
+            if not loadable.selected:
+                continue
+            attributes = _serialize_loadable(loadable, dicom_dir)
+            if plugin_name is None or attributes is None:
+                return None
+            serialized.append({"plugin": plugin_name, "attributes": attributes})
+    return serialized
+
+
+def restore_loadables(serialized, dicom_dir):
+    """
+    Rebuild stored loadables of a DICOM directory without parsing its headers.
+
+    Args:
+        serialized (list): Serialized loadables (see serialize_loadables).
+        dicom_dir (str): Directory of the DICOM files.
+
+    Returns:
+        dict: Loadables by plugin instance for DICOMLib.loadLoadables, or None if a
+            plugin is no longer available or a file is missing.
+    """
+    dicom_dir = Path(dicom_dir)
+    plugins = {}
+    loadablesByPlugin = {}
+    for entry in serialized:
+        plugin_class = slicer.modules.dicomPlugins.get(entry["plugin"])
+        if plugin_class is None:
+            return None
+        if entry["plugin"] not in plugins:
+            plugins[entry["plugin"]] = plugin_class()
+            loadablesByPlugin[plugins[entry["plugin"]]] = []
+        loadable = DICOMLib.DICOMLoadable()
+        for name, value in entry["attributes"].items():
+            setattr(loadable, name, value)
+        loadable.files = [str(dicom_dir / file_path) for file_path in loadable.files]
+        if not all(Path(file_path).exists() for file_path in loadable.files):
+            return None
+        loadablesByPlugin[plugins[entry["plugin"]]].append(loadable)
+    return loadablesByPlugin
+
+
+def series_uids(loadablesByPlugin):
+    """
+    Series instance UIDs of the loadables, from the DICOM database.
+
+    Args:
+        loadablesByPlugin (dict): Loadables by plugin instance.
+
+    Returns:
+        list: Sorted series instance UIDs.
+    """
+    uids = set()
+    for loadables in loadablesByPlugin.values():
+        for loadable in loadables:
+            if loadable.files:
+                file_path = loadable.files[0]
+                uids.add(slicer.dicomDatabase.fileValue(file_path, SERIES_INSTANCE_UID))
+    return sorted(uid for uid in uids if uid)
+
+
+def index_entry(loadablesByPlugin, dicom_dir):
+    """
+    Build the index entry of a DICOM archive from its computed loadables.
+
+    Args:
+        loadablesByPlugin (dict): Loadables by plugin instance.
+        dicom_dir (str): Directory of the DICOM files.
+
+    Returns:
+        dict: "series_uids" and serialized "loadables" or None, if the loadables
+            can not be stored.
+    """
+    loadables = serialize_loadables(loadablesByPlugin, dicom_dir)
+    if loadables is None:
+        return None
+    return {"series_uids": series_uids(loadablesByPlugin), "loadables": loadables}
+
+
+def in_database(entry):
+    """
+    Check that the series of an index entry are in the DICOM database.
+
+    Args:
+        entry (dict): Index entry of a DICOM archive.
+
+    Returns:
+        bool: True if the files of all series are in the database.
+    """
+    return all(slicer.dicomDatabase.filesForSeries(uid) for uid in entry["series_uids"])
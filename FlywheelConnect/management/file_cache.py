@@ -0,0 +1,1076 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from zipfile import ZipFile
+
+from .chunked_download import ChunkedDownloader, sdk_file_request
+from .metrics import CACHE_HIT, CACHE_MISS, METRICS
+
+# Default size limit of the cache in bytes (20 GB)
+DEFAULT_MAX_BYTES = 20 * 1024 ** 3
+
+# Parent containers making up the cache path of a file
+PARENT_TYPES = ["group", "project", "subject", "session", "acquisition"]
+
+# Name of the index file in the cache root
+INDEX_NAME = "cache_index.json"
+
+# Directories of the content-addressed objects and of partial downloads
+OBJECTS_DIR = ".objects"
+TMP_DIR = ".tmp"
+
+# Seconds between two writes of the index for access times only
+INDEX_WRITE_INTERVAL = 30
+
+# Prefix of the keys of files cached before the index, whose content is unknown
+LEGACY_PREFIX = "legacy-"
+
+# Bytes read at a time when hashing files
+CHUNK_SIZE = 1024 * 1024
+
+# Suffix of the directory holding the extracted members of an archive object
+EXTRACTED_SUFFIX = ".extracted"
+
+# Number of threads extracting the members of an archive
+EXTRACT_WORKERS = 4
+
+# Suffix of the byte range parts of a partial download (see ChunkedDownloader)
+RANGE_PART = re.compile(r"\.range\d+$")
+
+# Extensions of the files stored next to a header file of a multi-file format,
+# by extension of the header (MetaImage, Analyze, detached NRRD)
+COMPANION_EXTENSIONS = {
+    ".mhd": [".raw", ".zraw"],
+    ".hdr": [".img", ".img.gz"],
+    ".hdr.gz": [".img.gz"],
+    ".nhdr": [".raw", ".raw.gz"],
+}
+
+
+def content_key(file_obj):
+    """
+    Content key of a Flywheel file from its server-side hash.
+
+    Flywheel hashes are sha384 digests, optionally prefixed (e.g. "v0-sha384-").
+
+    Args:
+        file_obj (flywheel.FileEntry or FileRecord): File to key.
+
+    Returns:
+        str: Hex digest of the file content or None, if the hash is unknown.
+    """
+    file_hash = getattr(file_obj, "hash", None)
+    if not file_hash:
+        return None
+    return str(file_hash).split("-")[-1]
+
+
+def companion_files(file_obj, files):
+    """
+    Find the companion files of a multi-file format (e.g. the .raw of a .mhd).
+
+    Companions are resolved from the file list of the parent, without requests.
+
+    Args:
+        file_obj (flywheel.FileEntry or FileRecord): Header file.
+        files (list): Files of the parent container.
+
+    Returns:
+        list: Companion files found in the parent.
+    """
+    lower_name = file_obj.name.lower()
+    # Longest extension first (".hdr.gz" before ".gz")
+    for ext in sorted(COMPANION_EXTENSIONS, key=len, reverse=True):
+        if lower_name.endswith(ext):
+            stem = lower_name[: -len(ext)]
+            names = {stem + companion for companion in COMPANION_EXTENSIONS[ext]}
+            return [fl for fl in files if fl.name.lower() in names]
+    return []
+
+
+def hash_file(file_path):
+    """
+    Compute the sha384 digest of a local file, the same digest as Flywheel.
+
+    Args:
+        file_path (pathlib.Path): File to hash.
+
+    Returns:
+        str: Hex digest of the file content.
+    """
+    digest = hashlib.sha384()
+    with open(file_path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def extract_archive(archive_path, dest_dir, workers=EXTRACT_WORKERS):
+    """
+    Extract the members of a zip archive with a pool of threads.
+
+    Each thread reads its share of the members through its own handle on the
+    archive, so decompression and writes of members run concurrently.
+
+    Args:
+        archive_path (pathlib.Path): Path to the zip archive.
+        dest_dir (pathlib.Path): Directory to extract the members to.
+        workers (int, optional): Number of threads.
+    """
+    with ZipFile(archive_path) as archive:
+        members = [member for member in archive.infolist() if not member.is_dir()]
+    workers = max(1, min(workers, len(members)))
+
+    def extract_members(share):
+        with ZipFile(archive_path) as archive:
+            for member in share:
+                archive.extract(member, dest_dir)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Consume the results to raise the errors of the threads
+        list(pool.map(extract_members, [members[i::workers] for i in range(workers)]))
+
+
+class FileCache:
+    """
+    Managed, content-addressed disk cache of Flywheel files.
+
+    Each file content is stored once under `.objects/`, keyed by its hash, and
+    hard-linked (or copied, if links are not supported) to the path of the file
+    under its parent containers (cache_root/group/.../file_id/file_name). The same
+    file reached through different parents is stored once.
+
+    An index file records the size, last access time and paths of every object
+    along with the total size of the cache. When the total size exceeds the size
+    limit, the least recently accessed objects are evicted.
+
+    Each path is recorded with the server version, size and hash of the file it
+    holds, so that a file re-uploaded on the server is no longer a cache hit.
+    Downloads are written to a temporary name, checked against the expected size
+    and only then renamed into place. Concurrent fetches of the same file (e.g. a
+    .raw selected along with its .mhd) share a single download. Partial downloads
+    count towards the size limit and are dropped before any object when the cache
+    is over the limit, as are the partial downloads of other versions of a file.
+
+    Archives (e.g. DICOM zips) are extracted once next to their object and the
+    extracted members are reused on later loads. They count towards the size of
+    the cache and are evicted along with the archive.
+
+    Access times of cache hits are written to the index at most every
+    INDEX_WRITE_INTERVAL seconds and at the end of each batch (see batch). Files
+    fetched within a batch are not evicted before the batch ends.
+    """
+
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        """
+        Open (or create) the cache.
+
+        Args:
+            root (pathlib.Path): Root directory of the cache.
+            max_bytes (int, optional): Size limit of the cache in bytes.
+        """
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        # Client used for resumable downloads, once connected
+        self.client = None
+        self.downloader = ChunkedDownloader()
+        self._lock = threading.Lock()
+        # Locks of the partial downloads (by name) and extractions under way, with
+        # their number of users, removed once unused
+        self._partial_locks = {}
+        # Fetches under way by (parent id, file id, version), shared by concurrent
+        # fetches of the same file
+        self._fetches = {}
+        # Names of the partial downloads and extractions under way in TMP_DIR
+        self._active_tmp = set()
+        # Number of batches running and content keys fetched in them
+        self._batches = 0
+        self._pinned = set()
+        # Access times not written to the index yet
+        self._dirty = False
+        self._last_write = 0
+        self._index_path = self.root / INDEX_NAME
+        self._index = self._read_index()
+        # Files cached before the index are swept in the background, once
+        self._sweeper = None
+        if not self._index.get("swept"):
+            self._sweeper = threading.Thread(target=self._sweep, daemon=True)
+            self._sweeper.start()
+
+    def _read_index(self):
+        """
+        Read the index file, or start an empty index.
+
+        Returns:
+            dict: Index with "total_bytes", "objects", "paths" and whether the cache
+                root was "swept" for unindexed files.
+        """
+        if self._index_path.exists():
+            try:
+                with open(self._index_path) as fp:
+                    return json.load(fp)
+            except ValueError:
+                print("Cache index is corrupted and is rebuilt.")
+        return {"total_bytes": 0, "objects": {}, "paths": {}}
+
+    def _write_index(self):
+        """
+        Write the index file atomically. Called with the lock held.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp_path = self._index_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as fp:
+            json.dump(self._index, fp)
+        os.replace(tmp_path, self._index_path)
+        self._dirty = False
+        self._last_write = time.monotonic()
+
+    def _write_access_times(self):
+        """
+        Write the index if access times were recorded since INDEX_WRITE_INTERVAL
+        seconds. Called with the lock held.
+        """
+        if self._dirty and time.monotonic() - self._last_write >= INDEX_WRITE_INTERVAL:
+            self._write_index()
+
+    def flush(self):
+        """
+        Write the access times recorded since the last write of the index.
+        """
+        with self._lock:
+            if self._dirty:
+                self._write_index()
+
+    @contextmanager
+    def batch(self):
+        """
+        Fetch a batch of files (e.g. the files of a load).
+
+        Files fetched or extracted in the context are not evicted until the batch
+        ends, so that earlier files of the batch are still in the cache when they
+        are loaded. The cache is then evicted down to its size limit and the index
+        written.
+        """
+        with self._lock:
+            self._batches += 1
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._batches -= 1
+                if not self._batches:
+                    self._pinned.clear()
+                    self._evict(self.max_bytes)
+                    self._write_index()
+
+    @contextmanager
+    def _partial_lock(self, name):
+        """
+        Hold the lock of a partial download or extraction.
+
+        The lock is shared by the threads working on the same partial file and
+        removed once none is.
+
+        Args:
+            name (str or tuple): Name of the partial download or key of the
+                extraction.
+        """
+        with self._lock:
+            entry = self._partial_locks.setdefault(name, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._partial_locks[name]
+
+    def wait_for_sweep(self):
+        """
+        Wait until the files cached before the index are indexed.
+        """
+        if self._sweeper:
+            self._sweeper.join()
+
+    def _sweep(self):
+        """
+        Index the files left in the cache root without an index. Runs in a
+        background thread, holding the lock for one file at a time, so that opening
+        a large cache does not block.
+
+        Files cached before the index, directly under their parents, are moved to
+        objects keyed with LEGACY_PREFIX and linked back, so that they are counted,
+        evicted and cleared like other files. Their content is checked against the
+        hash of the file on first fetch (see _adopt). Objects missing from the index
+        (e.g. after a corrupted index) are removed.
+        """
+        objects_dir = self.root / OBJECTS_DIR
+        for object_path in list(objects_dir.glob("*/*")):
+            key = object_path.name
+            if key.endswith(EXTRACTED_SUFFIX):
+                key = key[: -len(EXTRACTED_SUFFIX)]
+            with self._lock:
+                if key in self._index["objects"]:
+                    continue
+                if object_path.is_dir():
+                    shutil.rmtree(object_path, ignore_errors=True)
+                elif object_path.exists():
+                    os.remove(object_path)
+
+        for dir_path, dir_names, file_names in os.walk(self.root):
+            if Path(dir_path) == self.root:
+                # Objects, partial downloads and the index itself
+                dir_names[:] = [d for d in dir_names if d not in [OBJECTS_DIR, TMP_DIR]]
+                continue
+            for file_name in file_names:
+                with self._lock:
+                    self._sweep_file(Path(dir_path) / file_name)
+        with self._lock:
+            self._index["swept"] = True
+            self._write_index()
+
+    def _sweep_file(self, file_path):
+        """
+        Index a file left in the cache root, unless indexed. Called with the lock
+        held.
+
+        Args:
+            file_path (pathlib.Path): File under the cache root.
+        """
+        if self._relative(file_path) in self._index["paths"]:
+            return
+        if not file_path.exists():
+            # Removed since the directory was listed
+            return
+        if file_path.name.startswith("."):
+            # Temporary link left by an interrupted session
+            os.remove(file_path)
+            return
+        key = LEGACY_PREFIX + uuid.uuid4().hex
+        object_path = self._object_path(key)
+        object_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(file_path, object_path)
+        size = object_path.stat().st_size
+        self._index["objects"][key] = {
+            "size": size,
+            "paths": [],
+            "atime": object_path.stat().st_mtime,
+        }
+        self._index["total_bytes"] += size
+        self._link(key, file_path, None)
+
+    def _adopt(self, legacy_key, key, file_path, file_obj, file_parent):
+        """
+        Re-key a file cached before the index if it holds the content of a file.
+
+        Args:
+            legacy_key (str): Key of the object swept from the cache root.
+            key (str): Content key of the file on the server.
+            file_path (pathlib.Path): Cache path of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File on the server.
+            file_parent (flywheel.Container or ContainerRecord): Parent of the file.
+
+        Returns:
+            bool: True if the file was adopted under its content key.
+        """
+        object_path = self._object_path(legacy_key)
+        try:
+            if hash_file(object_path) != key:
+                return False
+        except OSError:
+            # Evicted in the meantime
+            return False
+        with self._lock:
+            entry = self._index["objects"].pop(legacy_key, None)
+            if entry is None:
+                return False
+            for rel_path in entry["paths"]:
+                self._index["paths"].pop(rel_path, None)
+            if key in self._index["objects"]:
+                self._index["total_bytes"] -= entry["size"]
+                os.remove(object_path)
+            else:
+                self._object_path(key).parent.mkdir(parents=True, exist_ok=True)
+                os.replace(object_path, self._object_path(key))
+                self._index["objects"][key] = dict(entry, paths=[])
+            self._link(key, file_path, file_obj, file_parent)
+            self._touch(key)
+            self._write_index()
+        return True
+
+    def container_dir(self, file_parent):
+        """
+        Construct the cache directory of a container (e.g. cache_root/group/.../id).
+
+        Args:
+            file_parent (flywheel.Container or ContainerRecord): Parent of files.
+
+        Returns:
+            pathlib.Path: Cache directory of the container.
+        """
+        file_path = self.root
+        for par in PARENT_TYPES:
+            if file_parent.parents[par]:
+                file_path /= file_parent.parents[par]
+        return file_path / file_parent.id
+
+    def cache_path(self, file_parent, file_obj):
+        """
+        Construct cache path of file (e.g. cache_root/group/.../file_id/file_name).
+
+        Args:
+            file_parent (flywheel.Container or ContainerRecord): Parent of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File to locate.
+
+        Returns:
+            pathlib.Path: Cache Path to file indicated.
+        """
+        return self.container_dir(file_parent) / file_obj.id / file_obj.name
+
+    def _relative(self, file_path):
+        """
+        Index key of a path in the cache.
+
+        Args:
+            file_path (pathlib.Path): Path under the cache root.
+
+        Returns:
+            str: Path relative to the cache root.
+        """
+        return file_path.relative_to(self.root).as_posix()
+
+    @staticmethod
+    def _is_valid(entry, file_obj):
+        """
+        Check a path entry of the index against the metadata of a file.
+
+        Args:
+            entry (dict): Path entry with the "key", "version" and "size" cached.
+            file_obj (flywheel.FileEntry or FileRecord): File on the server.
+
+        Returns:
+            bool: True if the cached file is the current version of the file.
+        """
+        if not entry:
+            return False
+        key = content_key(file_obj)
+        if key and entry["key"] != key:
+            return False
+        for attribute in ["version", "size"]:
+            expected = getattr(file_obj, attribute, None)
+            if expected is not None and str(entry.get(attribute)) != str(expected):
+                return False
+        return True
+
+    def is_cached(self, file_parent, file_obj):
+        """
+        Check if the current version of a file is cached, from the index.
+
+        Args:
+            file_parent (flywheel.Container or ContainerRecord): Parent of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File to check.
+
+        Returns:
+            bool: If file is cached locally on disk.
+        """
+        rel_path = self._relative(self.cache_path(file_parent, file_obj))
+        with self._lock:
+            return self._is_valid(self._index["paths"].get(rel_path), file_obj)
+
+    def cached_files(self, file_parent, files):
+        """
+        Check which files of a container are cached, in one lookup of the index.
+
+        Args:
+            file_parent (flywheel.Container or ContainerRecord): Parent of the files.
+            files (list): flywheel.FileEntry or FileRecord objects of the container.
+
+        Returns:
+            set: Ids of the files whose current version is cached.
+        """
+        rel_dir = self._relative(self.container_dir(file_parent))
+        with self._lock:
+            paths = self._index["paths"]
+            return {
+                fl.id
+                for fl in files
+                if self._is_valid(paths.get(f"{rel_dir}/{fl.id}/{fl.name}"), fl)
+            }
+
+    def file_source(self, file_path):
+        """
+        Flywheel parent and name of a cached file, as recorded at download.
+
+        Members extracted from an archive (e.g. the slices of a DICOM zip) are
+        mapped back to the archive they were extracted from.
+
+        Args:
+            file_path (pathlib.Path): Path of a file in the cache.
+
+        Returns:
+            dict: "parent_id", "parent_type" and "name" of the file or None, if the
+                path is not in the cache or was cached without its parent.
+        """
+        try:
+            rel_path = self._relative(Path(file_path))
+        except ValueError:
+            return None
+        with self._lock:
+            key = self._extracted_key(rel_path)
+            if key:
+                object_entry = self._index["objects"].get(key) or {"paths": []}
+                entries = [self._index["paths"][path] for path in object_entry["paths"]]
+            else:
+                entries = [self._index["paths"].get(rel_path)]
+        for entry in entries:
+            if entry and entry.get("parent_type"):
+                return {
+                    attr: entry[attr] for attr in ["parent_id", "parent_type", "name"]
+                }
+        return None
+
+    def is_object_path(self, file_path):
+        """
+        Check if a path is under the content-addressed objects of the cache.
+
+        Args:
+            file_path (pathlib.Path): Path to check.
+
+        Returns:
+            bool: True for objects and the members extracted from them.
+        """
+        try:
+            rel_path = self._relative(Path(file_path))
+        except ValueError:
+            return False
+        return rel_path.startswith(OBJECTS_DIR + "/")
+
+    @staticmethod
+    def _extracted_key(rel_path):
+        """
+        Content key of the archive a cached path was extracted from.
+
+        Args:
+            rel_path (str): Path relative to the cache root.
+
+        Returns:
+            str: Content key of the archive or None, if the path is not an
+                extracted member (.objects/xx/<key>.extracted/...).
+        """
+        parts = rel_path.split("/")
+        if len(parts) > 3 and parts[0] == OBJECTS_DIR:
+            if parts[2].endswith(EXTRACTED_SUFFIX):
+                return parts[2][: -len(EXTRACTED_SUFFIX)]
+        return None
+
+    def usage(self):
+        """
+        Total size of the files in the cache.
+
+        Returns:
+            int: Size in bytes.
+        """
+        with self._lock:
+            return self._index["total_bytes"]
+
+    def fetch(self, file_parent, file_obj, file_path=None):
+        """
+        Retrieve a file from the cache, downloading it if necessary.
+
+        Args:
+            file_parent (flywheel.Container or ContainerRecord): Parent of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File to retrieve.
+            file_path (pathlib.Path, optional): Path in the cache to retrieve the
+                file to (e.g. next to its paired file). Defaults to its cache path.
+
+        Returns:
+            pathlib.Path: Path to file in cache.
+        """
+        if not file_path:
+            file_path = self.cache_path(file_parent, file_obj)
+        # Files cached before the index are reused once indexed
+        self.wait_for_sweep()
+        fetch_key = (file_parent.id, file_obj.id, getattr(file_obj, "version", None))
+        with self._lock:
+            future = self._fetches.get(fetch_key)
+            waiting = future is not None
+            if not waiting:
+                future = self._fetches[fetch_key] = Future()
+        if waiting:
+            # The file is being fetched by another thread: reuse its download
+            if future.result() == file_path:
+                return file_path
+            return self._fetch(file_parent, file_obj, file_path)
+
+        try:
+            future.set_result(self._fetch(file_parent, file_obj, file_path))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._fetches[fetch_key]
+        return future.result()
+
+    def _fetch(self, file_parent, file_obj, file_path):
+        """
+        Retrieve a file from the cache, downloading it if necessary.
+
+        Args:
+            file_parent (flywheel.Container or ContainerRecord): Parent of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File to retrieve.
+            file_path (pathlib.Path): Path in the cache to retrieve the file to.
+
+        Returns:
+            pathlib.Path: Path to file in cache.
+        """
+        rel_path = self._relative(file_path)
+        key = content_key(file_obj)
+        with self._lock:
+            # Cache hit on the path
+            entry = self._index["paths"].get(rel_path)
+            if self._is_valid(entry, file_obj) and file_path.exists():
+                self._touch(entry["key"])
+                self._write_access_times()
+                METRICS.count(CACHE_HIT)
+                return file_path
+            # Cache hit on the content, reached through another parent
+            if key and key in self._index["objects"]:
+                self._link(key, file_path, file_obj, file_parent)
+                self._touch(key)
+                self._write_index()
+                METRICS.count(CACHE_HIT)
+                return file_path
+            legacy_key = None
+            if entry and entry["key"].startswith(LEGACY_PREFIX):
+                legacy_key = entry["key"]
+
+        # Cache hit on a file cached before the index
+        if key and legacy_key and self._adopt(
+            legacy_key, key, file_path, file_obj, file_parent
+        ):
+            METRICS.count(CACHE_HIT)
+            return file_path
+
+        METRICS.count(CACHE_MISS)
+        with METRICS.span("download") as span:
+            tmp_path = self._download(file_parent, file_obj)
+            span["bytes"] = tmp_path.stat().st_size
+        self.store(tmp_path, file_path, file_obj, file_parent)
+        return file_path
+
+    def fetch_with_companions(self, file_parent, file_obj):
+        """
+        Retrieve a file and its companion files (see companion_files).
+
+        Companions are retrieved next to the file, at the same time as the file,
+        each going through the cache like the file itself.
+
+        Args:
+            file_parent (flywheel.Container or ContainerRecord): Parent of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File to retrieve.
+
+        Returns:
+            pathlib.Path: Path to file in cache.
+        """
+        file_path = self.cache_path(file_parent, file_obj)
+        companions = companion_files(file_obj, file_parent.files or [])
+        if not companions:
+            return self.fetch(file_parent, file_obj, file_path)
+        targets = [(file_obj, file_path)] + [
+            (companion, file_path.parent / companion.name) for companion in companions
+        ]
+        with ThreadPoolExecutor(max_workers=len(targets)) as executor:
+            futures = [
+                executor.submit(self.fetch, file_parent, fl, path)
+                for fl, path in targets
+            ]
+            for future in futures:
+                future.result()
+        return file_path
+
+    def _download(self, file_parent, file_obj):
+        """
+        Download a file to a partial path in the cache.
+
+        With a connected client, the file is downloaded in chunks and an
+        interrupted download is resumed from the partial file left by a previous
+        attempt. Otherwise, the SDK downloads the whole file.
+
+        Args:
+            file_parent (flywheel.Container or ContainerRecord): Parent of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File to download.
+
+        Returns:
+            pathlib.Path: Partial path of the downloaded file.
+        """
+        tmp_dir = self.root / TMP_DIR
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        version = getattr(file_obj, "version", None)
+        prefix = f"{file_parent.id}-{file_obj.id}-"
+        tmp_path = tmp_dir / f"{prefix}{version}-{file_obj.name}"
+        with self._lock:
+            # Partial downloads of other versions of the file can not be resumed
+            for stale_path in tmp_dir.glob(f"{prefix}*"):
+                if not stale_path.name.startswith(tmp_path.name):
+                    self._remove_tmp(stale_path)
+
+        with self._partial_lock(tmp_path.name):
+            request = None
+            if self.client:
+                request = sdk_file_request(self.client, file_parent, file_obj.name)
+            if request:
+                url, headers = request
+                size = getattr(file_obj, "size", None)
+                self.downloader.download(
+                    url,
+                    tmp_path,
+                    headers,
+                    size=int(size) if size is not None else None,
+                )
+                return tmp_path
+            try:
+                file_parent.download_file(file_obj.name, str(tmp_path))
+                self._check_size(tmp_path, file_obj)
+            except Exception:
+                if tmp_path.exists():
+                    os.remove(tmp_path)
+                raise
+        return tmp_path
+
+    @staticmethod
+    def _check_size(file_path, file_obj):
+        """
+        Check that a downloaded file is complete.
+
+        Args:
+            file_path (pathlib.Path): Downloaded file.
+            file_obj (flywheel.FileEntry or FileRecord): File on the server.
+
+        Raises:
+            IOError: If the size of the downloaded file is not the expected size.
+        """
+        size = getattr(file_obj, "size", None)
+        if size is not None and file_path.stat().st_size != int(size):
+            raise IOError(
+                f"Incomplete download of {file_obj.name}: "
+                f"{file_path.stat().st_size} of {size} bytes."
+            )
+
+    def store(self, tmp_path, file_path, file_obj, file_parent=None):
+        """
+        Move a downloaded file into the cache and evict over the size limit.
+
+        Args:
+            tmp_path (pathlib.Path): Downloaded file, on the cache file system.
+            file_path (pathlib.Path): Cache path of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File on the server.
+            file_parent (flywheel.Container or ContainerRecord, optional): Parent of
+                the file, recorded with the path.
+        """
+        key = content_key(file_obj) or hash_file(tmp_path)
+        object_path = self._object_path(key)
+        with self._lock:
+            if key in self._index["objects"]:
+                # Same content already stored, possibly from this very download
+                if tmp_path.exists():
+                    os.remove(tmp_path)
+            else:
+                object_path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_path, object_path)
+                size = object_path.stat().st_size
+                self._index["objects"][key] = {"size": size, "paths": []}
+                self._index["total_bytes"] += size
+            self._link(key, file_path, file_obj, file_parent)
+            self._touch(key)
+            self._evict(self.max_bytes, keep=key)
+            self._write_index()
+
+    def _object_path(self, key):
+        """
+        Path of a content-addressed object.
+
+        Args:
+            key (str): Content key.
+
+        Returns:
+            pathlib.Path: Path of the object under the cache root.
+        """
+        return self.root / OBJECTS_DIR / key[:2] / key
+
+    def _extracted_path(self, key):
+        """
+        Path of the directory of the extracted members of an archive object.
+
+        Args:
+            key (str): Content key of the archive.
+
+        Returns:
+            pathlib.Path: Extraction directory under the cache root.
+        """
+        return self._object_path(key).with_name(key + EXTRACTED_SUFFIX)
+
+    def extract(self, file_path, workers=EXTRACT_WORKERS):
+        """
+        Extract a cached zip archive, unless it was extracted before.
+
+        Args:
+            file_path (pathlib.Path): Cache path of the archive.
+            workers (int, optional): Number of threads extracting the members.
+
+        Returns:
+            pathlib.Path: Directory of the extracted members.
+
+        Raises:
+            KeyError: If the file is not in the cache.
+        """
+        rel_path = self._relative(Path(file_path))
+        with self._lock:
+            key = self._index["paths"][rel_path]["key"]
+
+        with self._partial_lock((EXTRACTED_SUFFIX, key)):
+            extracted_path = self._extracted_path(key)
+            with self._lock:
+                entry = self._index["objects"][key]
+                if "extracted_size" in entry and extracted_path.is_dir():
+                    self._touch(key)
+                    self._write_access_times()
+                    return extracted_path
+
+            tmp_dir = self.root / TMP_DIR / uuid.uuid4().hex
+            with self._lock:
+                self._active_tmp.add(tmp_dir.name)
+            with METRICS.span("extract") as span:
+                try:
+                    extract_archive(self._object_path(key), tmp_dir, workers)
+                except Exception:
+                    with self._lock:
+                        self._active_tmp.discard(tmp_dir.name)
+                        shutil.rmtree(tmp_dir, ignore_errors=True)
+                    raise
+                size = sum(
+                    path.stat().st_size
+                    for path in tmp_dir.rglob("*")
+                    if path.is_file()
+                )
+                span["bytes"] = size
+
+            with self._lock:
+                self._active_tmp.discard(tmp_dir.name)
+                if key not in self._index["objects"]:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                    raise KeyError(f"{file_path} was evicted while being extracted.")
+                entry = self._index["objects"][key]
+                # Left over by an interrupted session
+                shutil.rmtree(extracted_path, ignore_errors=True)
+                os.replace(tmp_dir, extracted_path)
+                self._index["total_bytes"] += size - entry.get("extracted_size", 0)
+                entry["extracted_size"] = size
+                self._touch(key)
+                self._evict(self.max_bytes, keep=key)
+                self._write_index()
+        return extracted_path
+
+    def _link(self, key, file_path, file_obj, file_parent=None):
+        """
+        Link an object to a cache path. Called with the lock held.
+
+        The link is created under a temporary name and renamed into place, so the
+        cache path never holds a partial file.
+
+        Args:
+            key (str): Content key of the object.
+            file_path (pathlib.Path): Cache path of the file.
+            file_obj (flywheel.FileEntry or FileRecord): File on the server.
+            file_parent (flywheel.Container or ContainerRecord, optional): Parent of
+                the file, recorded with the path.
+        """
+        rel_path = self._relative(file_path)
+        previous = self._index["paths"].get(rel_path)
+        if previous and previous["key"] in self._index["objects"]:
+            previous_entry = self._index["objects"][previous["key"]]
+            previous_entry["paths"].remove(rel_path)
+            # A file cached before the index is only reachable through its path
+            legacy = previous["key"].startswith(LEGACY_PREFIX)
+            if legacy and not previous_entry["paths"]:
+                self._remove_object(previous["key"])
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        object_path = self._object_path(key)
+        # Already linked (e.g. a new version with the same content): renaming a
+        # link onto the same inode would be a no-op leaving the temporary link
+        if not (file_path.exists() and os.path.samefile(file_path, object_path)):
+            tmp_link = file_path.with_name(f".{uuid.uuid4().hex}-{file_path.name}")
+            try:
+                os.link(object_path, tmp_link)
+            except OSError:
+                shutil.copyfile(object_path, tmp_link)
+            os.replace(tmp_link, file_path)
+        self._index["objects"][key]["paths"].append(rel_path)
+        self._index["paths"][rel_path] = {
+            "key": key,
+            "version": getattr(file_obj, "version", None),
+            "size": self._index["objects"][key]["size"],
+        }
+        if file_parent is not None:
+            self._index["paths"][rel_path].update(
+                {
+                    "parent_id": file_parent.id,
+                    "parent_type": getattr(file_parent, "container_type", None),
+                    "name": file_obj.name,
+                }
+            )
+
+    def _touch(self, key):
+        """
+        Record an access to an object. Called with the lock held.
+
+        Objects accessed within a batch are kept until the batch ends.
+
+        Args:
+            key (str): Content key of the object.
+        """
+        self._index["objects"][key]["atime"] = time.time()
+        self._dirty = True
+        if self._batches:
+            self._pinned.add(key)
+
+    def _remove_object(self, key):
+        """
+        Remove an object and all of its paths. Called with the lock held.
+
+        Args:
+            key (str): Content key of the object.
+        """
+        entry = self._index["objects"].pop(key)
+        self._index["total_bytes"] -= entry["size"] + entry.get("extracted_size", 0)
+        for rel_path in entry["paths"]:
+            self._index["paths"].pop(rel_path, None)
+            file_path = self.root / rel_path
+            if file_path.exists():
+                os.remove(file_path)
+            # Remove the file_id directory, if empty
+            try:
+                file_path.parent.rmdir()
+            except OSError:
+                pass
+        object_path = self._object_path(key)
+        if object_path.exists():
+            os.remove(object_path)
+        shutil.rmtree(self._extracted_path(key), ignore_errors=True)
+
+    def _tmp_in_use(self, tmp_path):
+        """
+        Check if a partial download or extraction is under way. Called with the lock
+        held.
+
+        Args:
+            tmp_path (pathlib.Path): Path in TMP_DIR, including the byte range parts
+                of a partial download (e.g. "<name>.range0").
+
+        Returns:
+            bool: True if the path is being written.
+        """
+        if tmp_path.name in self._active_tmp:
+            return True
+        return RANGE_PART.sub("", tmp_path.name) in self._partial_locks
+
+    def _remove_tmp(self, tmp_path):
+        """
+        Remove a partial download or extraction, unless in use. Called with the lock
+        held.
+
+        Args:
+            tmp_path (pathlib.Path): Path in TMP_DIR.
+        """
+        if self._tmp_in_use(tmp_path):
+            return
+        if tmp_path.is_dir():
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        elif tmp_path.exists():
+            os.remove(tmp_path)
+
+    def _idle_tmp(self):
+        """
+        Partial downloads and extractions left by interrupted transfers. Called with
+        the lock held.
+
+        Returns:
+            list: (path, size) tuples of the paths in TMP_DIR not in use, oldest
+                first.
+        """
+        tmp_dir = self.root / TMP_DIR
+        if not tmp_dir.is_dir():
+            return []
+        idle = []
+        for tmp_path in tmp_dir.iterdir():
+            if self._tmp_in_use(tmp_path):
+                continue
+            if tmp_path.is_dir():
+                size = sum(
+                    path.stat().st_size
+                    for path in tmp_path.rglob("*")
+                    if path.is_file()
+                )
+            else:
+                size = tmp_path.stat().st_size
+            idle.append((tmp_path.stat().st_mtime, tmp_path, size))
+        return [(tmp_path, size) for _, tmp_path, size in sorted(idle)]
+
+    def _evict(self, max_bytes, keep=None):
+        """
+        Evict least recently accessed objects down to a size. Called with the lock
+        held.
+
+        Partial downloads left by interrupted transfers count towards the size and
+        are dropped first, oldest first, as they can not be loaded. Objects accessed
+        within a running batch are not evicted.
+
+        Args:
+            max_bytes (int): Size to evict down to.
+            keep (str, optional): Content key never to evict.
+        """
+        idle_tmp = self._idle_tmp()
+        tmp_bytes = sum(size for _, size in idle_tmp)
+        for tmp_path, size in idle_tmp:
+            if self._index["total_bytes"] + tmp_bytes <= max_bytes:
+                return
+            self._remove_tmp(tmp_path)
+            tmp_bytes -= size
+        if self._index["total_bytes"] <= max_bytes:
+            return
+        by_access = sorted(
+            self._index["objects"].items(), key=lambda item: item[1].get("atime", 0)
+        )
+        for key, _ in by_access:
+            if self._index["total_bytes"] <= max_bytes:
+                break
+            if key != keep and key not in self._pinned:
+                self._remove_object(key)
+
+    def evict(self, max_bytes=None):
+        """
+        Evict least recently accessed files down to the size limit.
+
+        Args:
+            max_bytes (int, optional): Size to evict down to. Defaults to the size
+                limit of the cache.
+        """
+        with self._lock:
+            self._evict(self.max_bytes if max_bytes is None else max_bytes)
+            self._write_index()
+
+    def clear(self):
+        """
+        Remove all files from the cache.
+        """
+        self.wait_for_sweep()
+        self.evict(0)
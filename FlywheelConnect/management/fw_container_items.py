@@ -5,17 +5,55 @@ from PythonQt import QtGui
 from PythonQt.QtCore import Qt
 from qt import QAbstractItemView
 
-# Common paired file types
-PAIRED_FILE_TYPES = {
-    "mhd": "raw",
-    "hdr": "img"
-}
+from .child_loader import ChildLoader
+
+# Directory of the module resources, resolved once
+SOURCE_DIR = Path(os.path.realpath(__file__)).parents[1]
+ICONS_DIR = SOURCE_DIR / "Resources" / "Icons"
+
+# Icons shared by all tree nodes, by path relative to SOURCE_DIR
+ICONS = {}
+
+
+def load_icons():
+    """
+    Load every icon of the module resources into the icon registry, once.
+    """
+    if ICONS:
+        return
+    for icon_file in sorted(ICONS_DIR.glob("*.png")):
+        ICONS[icon_file.relative_to(SOURCE_DIR).as_posix()] = QtGui.QIcon(
+            str(icon_file)
+        )
+
+
+def _icon(icon_path):
+    """
+    Retrieve a shared icon from the icon registry.
+
+    Args:
+        icon_path (str): Path of the icon relative to SOURCE_DIR (e.g.
+            "Resources/Icons/file.png").
+
+    Returns:
+        QtGui.QIcon: The shared icon.
+    """
+    load_icons()
+    if icon_path not in ICONS:
+        ICONS[icon_path] = QtGui.QIcon(str(SOURCE_DIR / icon_path))
+    return ICONS[icon_path]
+
 
 class FolderItem(QtGui.QStandardItem):
     """
     Folder Items are for the convenience of collapsing long lists into a tree node.
+
+    Folder items are appended to their parent container item when created, on the
+    first expansion of the container item.
     """
 
+    __slots__ = ("tree_management", "parent_item", "parent_container")
+
     def __init__(self, parent_item, folder_name):
         """
         Initialize Folder Items unpopulated.
@@ -25,12 +63,11 @@ class FolderItem(QtGui.QStandardItem):
             folder_name (str): A name for the folder item (e.g. SESSIONS).
         """
         super(FolderItem, self).__init__()
-        self.source_dir = parent_item.source_dir
+        self.tree_management = parent_item.tree_management
         icon_path = "Resources/Icons/folder.png"
-        icon = QtGui.QIcon(str(self.source_dir / icon_path))
+        icon = _icon(icon_path)
         self.parent_item = parent_item
         self.parent_container = parent_item.container
-        self.folderItem = QtGui.QStandardItem()
         self.setText(folder_name)
         self.setIcon(icon)
         parent_item.appendRow(self)
@@ -41,6 +78,8 @@ class AnalysisFolderItem(FolderItem):
     Folder Item specifically for analyses.
     """
 
+    __slots__ = ()
+
     def __init__(self, parent_item):
         """
         Initialize AnalysisFolderItem unpopulated.
@@ -53,28 +92,57 @@ class AnalysisFolderItem(FolderItem):
         super(AnalysisFolderItem, self).__init__(parent_item, folder_name)
         # TODO: put folder w/ download icon
         icon_path = "Resources/Icons/dwnld-folder.png"
-        icon = QtGui.QIcon(str(self.source_dir / icon_path))
+        icon = _icon(icon_path)
         self.setIcon(icon)
         # TODO: ensure that these work.
         self.setToolTip("Double-Click to list Analyses.")
 
     def _dblclicked(self):
         if hasattr(self.parent_container, "analyses"):
-            self.parent_container = self.parent_container.reload()
+            fw_client = self.tree_management.main_window.fw_client
+            self.parent_container = fw_client.reload(self.parent_container)
             icon_path = "Resources/Icons/folder.png"
-            icon = QtGui.QIcon(str(self.source_dir / icon_path))
+            icon = _icon(icon_path)
             self.setIcon(icon)
             if not self.hasChildren() and self.parent_container.analyses:
-
-                for analysis in self.parent_container.analyses:
-                    AnalysisItem(self, analysis)
+                self.appendRows(
+                    [
+                        AnalysisItem(self, analysis)
+                        for analysis in self.parent_container.analyses
+                    ]
+                )
 
 
 class ContainerItem(QtGui.QStandardItem):
     """
     TreeView node to host all common functionality for Flywheel containers.
+
+    Container items are built detached from the tree. Callers attach them to their
+    parent, in bulk with appendRows for lists of children, so that the view is
+    updated once per list rather than once per item.
+
+    A container item is a single row until expanded: its folders are only created
+    on the first expansion (see create_folders), the tree model reporting children
+    for it in the meantime (see TreeModel.hasChildren). Icons, child folder names
+    and analysis support are class attributes and the instance attributes are
+    slots, so that each node only holds its parent, tree management and container
+    (a compact ContainerRecord when listed from the metadata cache).
     """
 
+    __slots__ = (
+        "parent_item",
+        "tree_management",
+        "container",
+        "filesItem",
+        "analysesItem",
+        "folderItem",
+        "child_loader",
+    )
+
+    icon_path = None
+    child_container_name = None
+    has_analyses = False
+
     def __init__(self, parent_item, container):
         """
         Initialize new container item with its parent and flywheel container object.
@@ -84,15 +152,33 @@ class ContainerItem(QtGui.QStandardItem):
             container (flywheel.Container): Flywheel container (e.g. group, project,...)
         """
         super(ContainerItem, self).__init__()
-        self.has_analyses = False
         self.parent_item = parent_item
+        self.tree_management = parent_item.tree_management
         self.container = container
-        self.source_dir = Path(os.path.realpath(__file__)).parents[1]
         title = container.label
         self.setData(container.id)
         self.setText(title)
         self._set_icon()
-        self.parent_item.appendRow(self)
+
+    def has_folders(self):
+        """
+        Check if the item gets folders once expanded.
+
+        Returns:
+            bool: True if the container has files, analyses or child containers.
+        """
+        return bool(
+            hasattr(self.container, "files")
+            or hasattr(self.container, "analyses")
+            or self.child_container_name
+        )
+
+    def create_folders(self):
+        """
+        Create the folders of the item, unless created before.
+        """
+        if self.hasChildren():
+            return
         self._files_folder()
         self._analyses_folder()
         self._child_container_folder()
@@ -101,7 +187,7 @@ class ContainerItem(QtGui.QStandardItem):
         """
         Set the icon for the container item.
         """
-        icon = QtGui.QIcon(str(self.source_dir / self.icon_path))
+        icon = _icon(self.icon_path)
         self.setIcon(icon)
 
     def _files_folder(self):
@@ -114,12 +200,19 @@ class ContainerItem(QtGui.QStandardItem):
     def _list_files(self):
         """
         List all file items of a container object under the "FILES" folder.
+
+        The cached status of all files is resolved in one lookup of the cache index.
         TODO: Make this a part of a filesFolderItem???
         """
         if hasattr(self.container, "files"):
             if not self.filesItem.hasChildren() and self.container.files:
-                for fl in self.container.files:
-                    FileItem(self.filesItem, fl)
+                files = self.container.files
+                cached = self.tree_management.file_cache.cached_files(
+                    self.container, files
+                )
+                self.filesItem.appendRows(
+                    [FileItem(self.filesItem, fl, fl.id in cached) for fl in files]
+                )
 
     def _analyses_folder(self):
         """
@@ -132,22 +225,74 @@ class ContainerItem(QtGui.QStandardItem):
         """
         Create a folder with the name of the child containers (e.g. SESSIONS)
         """
-        if hasattr(self, "child_container_name"):
+        if self.child_container_name:
             self.folderItem = FolderItem(self, self.child_container_name)
 
+    def _list_children(self, child_type, item_class):
+        """
+        List child containers under the child container folder in the background.
+
+        Children are listed one page at a time, with a "Load more..." node for the
+        next page. Listings cached on disk are drawn right away and revalidated, or
+        revalidated again if collapsed before the revalidation completed.
+
+        Args:
+            child_type (str): Name of the SDK finder of the child containers (e.g.
+                "subjects").
+            item_class (type): ContainerItem subclass for the child containers.
+        """
+        # Children are listed, or being listed with a placeholder shown.
+        if not self.folderItem.hasChildren():
+            self.child_loader = ChildLoader(
+                self.folderItem,
+                self.container,
+                child_type,
+                item_class,
+                self.tree_management.metadata_cache,
+            )
+            self.child_loader.start()
+        elif hasattr(self, "child_loader"):
+            self.child_loader.resume()
+
+    def _refresh(self, container):
+        """
+        Update the tree node with a modified container.
+
+        Args:
+            container (flywheel.Container or ContainerRecord): Up-to-date container.
+        """
+        self.container = container
+        self.setText(container.label)
+        # Relist files that were already listed
+        if hasattr(self, "filesItem") and self.filesItem.hasChildren():
+            self.filesItem.removeRows(0, self.filesItem.rowCount())
+            self._list_files()
+
     def _on_expand(self):
         """
-        On expansion of container tree node, list all files.
+        On expansion of container tree node, create its folders and list all files.
         """
-        # super(ContainerItem, self)._on_expand()
+        self.create_folders()
         self._list_files()
 
+    def _on_collapse(self):
+        """
+        On collapse of container tree node, cancel listing of child containers.
+        """
+        if hasattr(self, "child_loader"):
+            self.child_loader.cancel()
+
 
 class GroupItem(ContainerItem):
     """
     TreeView Node for the functionality of group containers.
     """
 
+    __slots__ = ()
+
+    icon_path = "Resources/Icons/group.png"
+    child_container_name = "PROJECTS"
+
     def __init__(self, parent_item, group):
         """
         Initialize Group Item with parent and group container.
@@ -156,18 +301,13 @@ class GroupItem(ContainerItem):
             parent_item (QtGui.QStandardItemModel): Top-level tree item or model.
             group (flywheel.Group): Flywheel group container to attach as tree node.
         """
-        self.icon_path = "Resources/Icons/group.png"
-        self.child_container_name = "PROJECTS"
-        self.group = group
         super(GroupItem, self).__init__(parent_item, group)
 
     def _list_projects(self):
         """
         Populate with flywheel projects.
         """
-        if not self.folderItem.hasChildren():
-            for project in self.group.projects():
-                ProjectItem(self.folderItem, project)
+        self._list_children("projects", ProjectItem)
 
     def _on_expand(self):
         """
@@ -182,6 +322,12 @@ class ProjectItem(ContainerItem):
     TreeView Node for the functionality of Project containers.
     """
 
+    __slots__ = ()
+
+    icon_path = "Resources/Icons/project.png"
+    child_container_name = "SUBJECTS"
+    has_analyses = True
+
     def __init__(self, parent_item, project):
         """
         Initialize Project Item with parent and project container.
@@ -191,19 +337,13 @@ class ProjectItem(ContainerItem):
             project (flywheel.Project): Flywheel project container to attach as tree
                 node.
         """
-        self.icon_path = "Resources/Icons/project.png"
-        self.child_container_name = "SUBJECTS"
         super(ProjectItem, self).__init__(parent_item, project)
-        self.has_analyses = True
-        self.project = self.container
 
     def _list_subjects(self):
         """
         Populate with flywheel subjects.
         """
-        if not self.folderItem.hasChildren():
-            for subject in self.project.subjects():
-                SubjectItem(self.folderItem, subject)
+        self._list_children("subjects", SubjectItem)
 
     def _on_expand(self):
         """
@@ -218,6 +358,12 @@ class SubjectItem(ContainerItem):
     TreeView Node for the functionality of Subject containers.
     """
 
+    __slots__ = ()
+
+    icon_path = "Resources/Icons/subject.png"
+    child_container_name = "SESSIONS"
+    has_analyses = True
+
     def __init__(self, parent_item, subject):
         """
         Initialize Subject Item with parent and project container.
@@ -227,19 +373,13 @@ class SubjectItem(ContainerItem):
             subject (flywheel.Subject): Flywheel subject container to attach as tree
                 node.
         """
-        self.icon_path = "Resources/Icons/subject.png"
-        self.child_container_name = "SESSIONS"
         super(SubjectItem, self).__init__(parent_item, subject)
-        self.has_analyses = True
-        self.subject = self.container
 
     def _list_sessions(self):
         """
         Populate with flywheel sessions.
         """
-        if not self.folderItem.hasChildren():
-            for session in self.subject.sessions():
-                SessionItem(self.folderItem, session)
+        self._list_children("sessions", SessionItem)
 
     def _on_expand(self):
         """
@@ -254,6 +394,12 @@ class SessionItem(ContainerItem):
     TreeView Node for the functionality of Session containers.
     """
 
+    __slots__ = ()
+
+    icon_path = "Resources/Icons/session.png"
+    child_container_name = "ACQUISITIONS"
+    has_analyses = True
+
     def __init__(self, parent_item, session):
         """
         Initialize Session Item with parent and subject container.
@@ -263,19 +409,13 @@ class SessionItem(ContainerItem):
             session (flywheel.Session): Flywheel session container to attach as tree
                 node.
         """
-        self.icon_path = "Resources/Icons/session.png"
-        self.child_container_name = "ACQUISITIONS"
         super(SessionItem, self).__init__(parent_item, session)
-        self.has_analyses = True
-        self.session = self.container
 
     def _list_acquisitions(self):
         """
         Populate with flywheel acquisitions.
         """
-        if not self.folderItem.hasChildren():
-            for acquisition in self.session.acquisitions():
-                AcquisitionItem(self.folderItem, acquisition)
+        self._list_children("acquisitions", AcquisitionItem)
 
     def _on_expand(self):
         """
@@ -290,6 +430,11 @@ class AcquisitionItem(ContainerItem):
     TreeView Node for the functionality of Acquisition containers.
     """
 
+    __slots__ = ()
+
+    icon_path = "Resources/Icons/acquisition.png"
+    has_analyses = True
+
     def __init__(self, parent_item, acquisition):
         """
         Initialize Acquisition Item with parent and Acquisition container.
@@ -299,10 +444,7 @@ class AcquisitionItem(ContainerItem):
             acquisition (flywheel.Acquisition): Flywheel acquisitin container to attach
                 as tree node.
         """
-        self.icon_path = "Resources/Icons/acquisition.png"
         super(AcquisitionItem, self).__init__(parent_item, acquisition)
-        self.has_analyses = True
-        self.acquisition = self.container
 
 
 class AnalysisItem(ContainerItem):
@@ -310,6 +452,10 @@ class AnalysisItem(ContainerItem):
     TreeView Node for the functionality of Analysis objects.
     """
 
+    __slots__ = ()
+
+    icon_path = "Resources/Icons/analysis.png"
+
     def __init__(self, parent_item, analysis):
         """
         Initialize Subject Item with parent and analysis object.
@@ -319,7 +465,6 @@ class AnalysisItem(ContainerItem):
             analysis (flywheel.Analysis): Flywheel analysis object to attach as tree
                 node.
         """
-        self.icon_path = "Resources/Icons/analysis.png"
         super(AnalysisItem, self).__init__(parent_item, analysis)
 
 
@@ -328,74 +473,61 @@ class FileItem(ContainerItem):
     TreeView Node for the functionality of File objects.
     """
 
-    def __init__(self, parent_item, file_obj):
+    __slots__ = ("file", "file_type", "cached")
+
+    icon_path = "Resources/Icons/file.png"
+    cached_icon_path = "Resources/Icons/file_cached.png"
+
+    def __init__(self, parent_item, file_obj, cached=None):
         """
         Initialize File Item with parent and file object.
 
         Args:
             parent_item (FolderItem): The folder item tree node that is the parent.
             file_obj (flywheel.FileEntry): File object of the tree node.
+            cached (bool, optional): Whether the file is cached, if already known
+                for the whole container. Looked up in the cache index otherwise.
         """
         file_obj.label = file_obj.name
         self.parent_item = parent_item
+        self.tree_management = parent_item.tree_management
         self.container = file_obj
-        
+
         self.file = file_obj
         self.file_type = file_obj.type
-        if self._is_cached():
-            self.icon_path = "Resources/Icons/file_cached.png"
-        else:
-            self.icon_path = "Resources/Icons/file.png"
+        if cached is None:
+            cached = self._is_cached()
+        self.cached = bool(cached)
         super(FileItem, self).__init__(parent_item, file_obj)
-        if self._is_cached():
+        if cached:
             self.setToolTip("File is cached.")
         else:
             self.setToolTip("File is not cached")
 
-    def _get_cache_path(self):
+    def has_folders(self):
         """
-        Construct cache path of file (e.g. cache_root/group/.../file_id/file_name).
+        Files have no folders.
 
         Returns:
-            pathlib.Path: Cache Path to file indicated.
+            bool: False.
         """
-        file_parent = self.parent_item.parent().container
-        file_path = Path(os.path.expanduser("~") + "/flywheelIO/")
+        return False
 
-        for par in ["group", "project", "subject", "session", "acquisition"]:
-            if file_parent.parents[par]:
-                file_path /= file_parent.parents[par]
-        file_path /= file_parent.id
-        file_path /= self.container.id
-        file_path /= self.container.name
-        return file_path
-
-    def _is_paired_type(self):
+    def _set_icon(self):
         """
-        Determine if this file is of a paired type.
-
-        Returns:
-            bool: True or False of paired type.
-        """        
-        return self.container.name.split(".")[-1] in PAIRED_FILE_TYPES.keys()
+        Set the icon of the file item, depending on whether the file is cached.
+        """
+        self.setIcon(_icon(self.cached_icon_path if self.cached else self.icon_path))
 
-    def _get_paired_file(self):
+    def _get_cache_path(self):
         """
-        Get the pair of current file, if exists
+        Construct cache path of file (e.g. cache_root/group/.../file_id/file_name).
 
         Returns:
-            str: Name of paired file
-        """        
-        file_parent = self.parent_item.parent().container
-        fl_ext = self.container.name.split(".")[-1]
-        paired_ext = PAIRED_FILE_TYPES[fl_ext]
-        paired_file_name = self.container.name[:-len(fl_ext)] + paired_ext
-
-        # file definition is retrieved or a None is returned.
-        if file_parent.get_file(paired_file_name):
-            return paired_file_name
-        else:
-            return None
+            pathlib.Path: Cache Path to file indicated.
+        """
+        file_parent = self.parent_item.parent_item.container
+        return self.tree_management.file_cache.cache_path(file_parent, self.container)
 
     def _is_cached(self):
         """
@@ -404,31 +536,13 @@ class FileItem(ContainerItem):
         Returns:
             bool: If file is cached locally on disk.
         """
-        return self._get_cache_path().exists()
+        file_parent = self.parent_item.parent_item.container
+        return self.tree_management.file_cache.is_cached(file_parent, self.container)
 
-    def _add_to_cache(self):
+    def _set_cached(self):
         """
-        Add file to cache directory under path.
-
-        Returns:
-            pathlib.Path, str: Path to file in cache and flywheel file_type
+        Update the icon and tooltip of a file that has been cached.
         """
-        file_path = self._get_cache_path()
-        file_parent = self.parent_item.parent().container
-
-        if not file_path.exists():
-            if not file_path.parents[0].exists():
-                os.makedirs(file_path.parents[0])
-            file_parent.download_file(self.file.name, str(file_path))
-            self.icon_path = "Resources/Icons/file_cached.png"
-            self.setToolTip("File is cached.")
-            self._set_icon()
-        # Check if this file is of a paired type
-        if self._is_paired_type():
-            # attempt to find the paired type
-            paired_file_name = self._get_paired_file()
-            # if found, download the adjoining pair into original directory
-            if paired_file_name:
-                file_parent.download_file(paired_file_name, str(file_path.parents[0]/paired_file_name))
-
-        return file_path, self.file_type
+        self.cached = True
+        self.setToolTip("File is cached.")
+        self._set_icon()
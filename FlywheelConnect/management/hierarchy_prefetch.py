@@ -0,0 +1,104 @@
+from .child_loader import SORT_ORDER
+from .metrics import METRICS
+
+# Number of containers requested per page of a project-wide query
+PREFETCH_PAGE_SIZE = 1000
+
+# Levels of the project hierarchy: (child type, parent type)
+HIERARCHY = [
+    ("subjects", "project"),
+    ("sessions", "subject"),
+    ("acquisitions", "session"),
+]
+
+# Name of the listing recorded once the hierarchy of a project is prefetched
+HIERARCHY_LISTING = "hierarchy"
+
+
+def _find_in_project(finder, project_id, page_size, cancelled=None, name="find"):
+    """
+    List all containers of a type in a project, one page at a time.
+
+    Args:
+        finder (flywheel.Finder): Site-wide finder of the containers (e.g.
+            client.sessions).
+        project_id (str): Flywheel id of the project.
+        page_size (int): Number of containers requested per page.
+        cancelled (threading.Event, optional): Set to stop listing.
+        name (str, optional): Name of the containers in the recorded metrics.
+
+    Returns:
+        list: Containers of the project, sorted by label.
+    """
+    containers = []
+    while not (cancelled and cancelled.is_set()):
+        with METRICS.span(f"api.prefetch.{name}") as span:
+            page = finder.find(
+                f"parents.project={project_id}",
+                sort=SORT_ORDER,
+                limit=page_size,
+                skip=len(containers),
+            )
+            span["containers"] = len(page)
+        containers.extend(page)
+        if len(page) < page_size:
+            break
+    return containers
+
+
+def prefetch_project(
+    client, metadata_cache, project, page_size=PREFETCH_PAGE_SIZE, cancelled=None
+):
+    """
+    Store the subject, session, acquisition and file skeleton of a project.
+
+    Each level of the hierarchy is listed with a few project-wide paged queries
+    instead of one request per expanded container. The containers are grouped by
+    parent and stored as the listings of their parents, so that the tree draws
+    any node of the project from the metadata cache. Parents without children get
+    an empty listing, and every listing is stored as complete. The levels listed
+    before any cancellation are stored in a single transaction. Once complete, the
+    prefetch is recorded as the HIERARCHY_LISTING listing of the project. Runs in a
+    worker thread.
+
+    Args:
+        client (flywheel.Client): Client to list the containers with.
+        metadata_cache (MetadataCache): Cache to store the listings in.
+        project (flywheel.Project or ContainerRecord): Project to prefetch.
+        page_size (int, optional): Number of containers requested per page.
+        cancelled (threading.Event, optional): Set to stop prefetching.
+
+    Returns:
+        dict: Number of containers stored by child type.
+    """
+    levels = []
+    parent_ids = [project.id]
+    for child_type, parent_type in HIERARCHY:
+        if cancelled and cancelled.is_set():
+            break
+        containers = _find_in_project(
+            getattr(client, child_type), project.id, page_size, cancelled, child_type
+        )
+        # A cancelled level may be partial: do not store it as complete listings
+        if cancelled and cancelled.is_set():
+            break
+        by_parent = {parent_id: [] for parent_id in parent_ids}
+        for container in containers:
+            by_parent.setdefault(container.parents[parent_type], []).append(container)
+        levels.append((child_type, by_parent, len(containers)))
+        parent_ids = [container.id for container in containers]
+    complete = len(levels) == len(HIERARCHY)
+
+    counts = {}
+    with metadata_cache.transaction():
+        for child_type, by_parent, count in levels:
+            for parent_id, children in by_parent.items():
+                metadata_cache.put_children(
+                    parent_id, child_type, children, complete=True
+                )
+            counts[child_type] = count
+        if complete:
+            metadata_cache.put_listing(project.id, HIERARCHY_LISTING)
+    for child_type, count in counts.items():
+        METRICS.count(f"prefetch.{child_type}", count)
+    return counts
@@ -0,0 +1,178 @@
+import queue
+import threading
+
+# Default number of jobs buffered between two stages
+DEFAULT_QUEUE_SIZE = 2
+
+# Marks the end of the jobs flowing through a queue
+_END = object()
+
+
+class PipelineStage:
+    """
+    A stage of the load pipeline run by one or more worker threads.
+    """
+
+    def __init__(self, name, func, workers=1):
+        """
+        Initialize a pipeline stage.
+
+        Args:
+            name (str): Name of the stage (e.g. "download").
+            func (callable): Called with a job dictionary and returns the job
+                dictionary for the next stage. Must not touch Qt objects.
+            workers (int, optional): Number of threads running this stage.
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+
+
+class LoadPipeline:
+    """
+    Staged producer/consumer pipeline connected by bounded queues.
+
+    Jobs are dictionaries passed from stage to stage. All stages run at the same
+    time in worker threads, while the calling (GUI) thread consumes the jobs that
+    leave the last stage. Bounded queues between the stages apply backpressure, so
+    a fast stage never runs more than `queue_size` jobs ahead of a slow one.
+
+    A job that raises in a stage is passed on with its "error" key set and is
+    skipped by the remaining stages.
+    """
+
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE, poll_interval=0.1):
+        """
+        Initialize an empty pipeline.
+
+        Args:
+            queue_size (int, optional): Maximum number of jobs waiting between two
+                stages.
+            poll_interval (float, optional): Seconds to wait for a job before calling
+                the idle callback again.
+        """
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.stages = []
+        self._stop = threading.Event()
+
+    def add_stage(self, name, func, workers=1):
+        """
+        Append a stage to the pipeline.
+
+        Args:
+            name (str): Name of the stage.
+            func (callable): Function mapping a job dictionary to a job dictionary.
+            workers (int, optional): Number of threads running this stage.
+        """
+        self.stages.append(PipelineStage(name, func, workers))
+
+    def _put(self, out_queue, job):
+        """
+        Put a job on a bounded queue, giving up if the pipeline was stopped.
+
+        Args:
+            out_queue (queue.Queue): Queue to put the job on.
+            job (dict or object): Job dictionary or end marker.
+
+        Returns:
+            bool: True if the job was queued.
+        """
+        while not self._stop.is_set():
+            try:
+                out_queue.put(job, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed(self, jobs, out_queue):
+        """
+        Feed the jobs into the first stage.
+
+        Args:
+            jobs (iterable): Job dictionaries.
+            out_queue (queue.Queue): Input queue of the first stage.
+        """
+        for job in jobs:
+            if not self._put(out_queue, job):
+                return
+        self._put(out_queue, _END)
+
+    def _work(self, stage, in_queue, out_queue, finished):
+        """
+        Process jobs of a stage until its input is exhausted.
+
+        Args:
+            stage (PipelineStage): Stage being run.
+            in_queue (queue.Queue): Queue of jobs for this stage.
+            out_queue (queue.Queue): Queue of jobs for the next stage.
+            finished (list): Shared countdown of running workers of this stage.
+        """
+        while not self._stop.is_set():
+            try:
+                job = in_queue.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+            if job is _END:
+                # Let sibling workers see the end marker too
+                self._put(in_queue, _END)
+                break
+            if not job.get("error"):
+                try:
+                    job = stage.func(job)
+                except Exception as e:
+                    job["error"] = e
+                    job["failed_stage"] = stage.name
+            if not self._put(out_queue, job):
+                return
+        with finished[1]:
+            finished[0] -= 1
+            last_worker = finished[0] == 0
+        if last_worker:
+            self._put(out_queue, _END)
+
+    def run(self, jobs, idle_callback=None):
+        """
+        Run the jobs through all stages and yield them as they leave the pipeline.
+
+        Args:
+            jobs (iterable): Job dictionaries to process.
+            idle_callback (callable, optional): Called on the calling thread while
+                waiting for jobs (e.g. to process GUI events).
+
+        Yields:
+            dict: Processed job dictionaries, in completion order.
+        """
+        self._stop.clear()
+        queues = [
+            queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)
+        ]
+        threads = [threading.Thread(target=self._feed, args=(jobs, queues[0]))]
+        for i, stage in enumerate(self.stages):
+            finished = [stage.workers, threading.Lock()]
+            for _ in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(stage, queues[i], queues[i + 1], finished),
+                    )
+                )
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        try:
+            while True:
+                try:
+                    job = queues[-1].get(timeout=self.poll_interval)
+                except queue.Empty:
+                    if idle_callback:
+                        idle_callback()
+                    continue
+                if job is _END:
+                    break
+                yield job
+        finally:
+            # Release the worker threads if the consumer stopped early
+            self._stop.set()
@@ -0,0 +1,592 @@
+import datetime
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+# Parent containers recorded for each container
+PARENT_TYPES = ["group", "project", "subject", "session", "acquisition"]
+
+# Container types hosting files and analyses
+FILE_CONTAINERS = ["project", "subject", "session", "acquisition", "analysis"]
+ANALYSIS_CONTAINERS = ["project", "subject", "session", "acquisition"]
+
+# File attributes recorded for each file of a container
+FILE_ATTRIBUTES = [
+    "id",
+    "file_id",
+    "name",
+    "type",
+    "modality",
+    "version",
+    "size",
+    "hash",
+    "modified",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS containers (
+    id TEXT PRIMARY KEY,
+    container_type TEXT,
+    label TEXT,
+    modified TEXT,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS children (
+    parent_id TEXT,
+    child_type TEXT,
+    child_id TEXT,
+    position INTEGER,
+    PRIMARY KEY (parent_id, child_type, child_id)
+);
+CREATE TABLE IF NOT EXISTS listings (
+    parent_id TEXT,
+    child_type TEXT,
+    listed_at TEXT,
+    complete INTEGER,
+    PRIMARY KEY (parent_id, child_type)
+);
+CREATE TABLE IF NOT EXISTS dicom_loadables (
+    file_id TEXT,
+    version TEXT,
+    data TEXT,
+    PRIMARY KEY (file_id, version)
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    container_id TEXT,
+    name TEXT,
+    sha384 TEXT,
+    uploaded_at TEXT,
+    PRIMARY KEY (container_id, name)
+);
+"""
+
+
+def _to_text(value):
+    """
+    Represent a metadata value as text for storage and comparison.
+
+    Args:
+        value (object): Value of a container attribute (e.g. modified datetime).
+
+    Returns:
+        str: Text representation or None.
+    """
+    if value is None:
+        return None
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _to_json(value):
+    """
+    Represent a metadata value as a JSON-serializable value.
+
+    Args:
+        value (object): Value of a file attribute.
+
+    Returns:
+        object: Value as None, number or text.
+    """
+    if value is None or isinstance(value, (int, float)):
+        return value
+    return _to_text(value)
+
+
+def modified_text(container):
+    """
+    Retrieve the modified timestamp of a container or record as text.
+
+    Args:
+        container (flywheel.Container or ContainerRecord): Container to inspect.
+
+    Returns:
+        str: Modified timestamp or None.
+    """
+    return _to_text(getattr(container, "modified", None))
+
+
+class FileRecord:
+    """
+    File metadata stored in the metadata cache.
+    """
+
+    __slots__ = FILE_ATTRIBUTES + ["label"]
+
+    def __init__(self, data):
+        """
+        Initialize a file record from its stored attributes.
+
+        Args:
+            data (dict): Stored file attributes (see FILE_ATTRIBUTES).
+        """
+        for attribute in FILE_ATTRIBUTES:
+            setattr(self, attribute, data.get(attribute))
+        self.label = self.name
+
+
+class ContainerRecord:
+    """
+    Container metadata stored in the metadata cache.
+
+    Records expose the label, id, parents and files of a container, so that the
+    tree can be drawn without any request to the server. Children are listed with
+    the site-wide finders of the client and `reload` fetches the container in one
+    request. Any other attribute (e.g. download_file, upload_file) is resolved on
+    the SDK container, which is fetched once on first use.
+
+    Records are slotted and listed children do not hold their SDK container, so
+    that a tree node costs little more than its id, label and file list.
+    """
+
+    __slots__ = [
+        "_cache",
+        "_container",
+        "id",
+        "container_type",
+        "label",
+        "modified",
+        "parents",
+        "timestamp",
+        "files",
+        "analyses",
+    ]
+
+    def __init__(self, cache, container_id, container_type, label, modified, data):
+        """
+        Initialize a container record.
+
+        Args:
+            cache (MetadataCache): Metadata cache the record belongs to.
+            container_id (str): Flywheel id of the container.
+            container_type (str): Type of the container (e.g. "session").
+            label (str): Label of the container.
+            modified (str): Modified timestamp of the container.
+            data (dict): Stored parents, timestamp and files of the container.
+        """
+        self._cache = cache
+        self._container = None
+        self.id = container_id
+        self.container_type = container_type
+        self.label = label
+        self.modified = modified
+        self.parents = data.get("parents", {})
+        self.timestamp = data.get("timestamp")
+        if container_type in FILE_CONTAINERS:
+            self.files = [FileRecord(fl) for fl in data.get("files", [])]
+        if container_type in ANALYSIS_CONTAINERS:
+            # Analyses are listed on demand from the reloaded SDK container.
+            self.analyses = None
+
+    def sdk_container(self):
+        """
+        Fetch the SDK container of this record, once.
+
+        Concurrent first uses may both fetch the container, which is harmless.
+
+        Returns:
+            flywheel.Container: The SDK container.
+        """
+        if self._container is None:
+            self._container = self._cache.client.get(self.id)
+        return self._container
+
+    def reload(self):
+        """
+        Fetch the SDK container of this record again.
+
+        Returns:
+            flywheel.Container: The SDK container.
+        """
+        self._container = self._cache.client.get(self.id)
+        return self._container
+
+    def __getattr__(self, name):
+        # Only called for attributes not set on the record itself. Files and
+        # analyses are only set for the container types that have them.
+        if name.startswith("_") or name in ["files", "analyses"]:
+            raise AttributeError(name)
+        return getattr(self.sdk_container(), name)
+
+
+class MetadataCache:
+    """
+    Persistent SQLite store of the container hierarchy, keyed by container id.
+
+    Each container is stored with its modified timestamp, parents and files. The
+    listing of the children of a container is stored in server order, so that a
+    tree node can be drawn from disk and then revalidated against the server.
+
+    The DICOM loadables of each version of a DICOM archive are stored as well, so
+    that a series loaded before is loaded again without parsing its headers.
+
+    Each write is committed on its own, unless run within a transaction (see
+    transaction), which commits many writes at once.
+    """
+
+    def __init__(self, db_path, client):
+        """
+        Open (or create) the metadata cache database.
+
+        Args:
+            db_path (pathlib.Path): Path to the SQLite database.
+            client (flywheel.Client): Client used to fetch SDK containers of records.
+        """
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.db_path = db_path
+        self.client = client
+        # Records are written from worker threads, serialized by the lock, which is
+        # held for the whole of a transaction.
+        self._lock = threading.RLock()
+        self._transactions = 0
+        self._db = sqlite3.connect(str(db_path), check_same_thread=False)
+        with self._writing():
+            self._db.executescript(SCHEMA)
+            columns = [
+                row[1] for row in self._db.execute("PRAGMA table_info(listings)")
+            ]
+            # Databases created before listings recorded their completeness
+            if "complete" not in columns:
+                self._db.execute("ALTER TABLE listings ADD COLUMN complete INTEGER")
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commit the writes made in the context at once, or none of them on error.
+
+        Other threads wait for the end of the transaction to read or write.
+
+        Yields:
+            MetadataCache: The cache.
+        """
+        with self._lock:
+            if self._transactions:
+                # Nested in a transaction, committed by the outermost one
+                self._transactions += 1
+                try:
+                    yield self
+                finally:
+                    self._transactions -= 1
+                return
+            self._transactions += 1
+            try:
+                with self._db:
+                    yield self
+            finally:
+                self._transactions -= 1
+
+    @contextmanager
+    def _writing(self):
+        """
+        Write to the database, committing at the end unless in a transaction.
+        """
+        with self._lock:
+            if self._transactions:
+                yield
+            else:
+                with self._db:
+                    yield
+
+    def _record_from_row(self, row):
+        """
+        Build a container record from a database row.
+
+        Args:
+            row (tuple): (id, container_type, label, modified, data) row.
+
+        Returns:
+            ContainerRecord: The container record.
+        """
+        container_id, container_type, label, modified, data = row
+        return ContainerRecord(
+            self, container_id, container_type, label, modified, json.loads(data)
+        )
+
+    @staticmethod
+    def _container_row(container):
+        """
+        Represent an SDK container or record as a database row.
+
+        Args:
+            container (flywheel.Container or ContainerRecord): Container to store.
+
+        Returns:
+            tuple: (id, container_type, label, modified, data) row.
+        """
+        data = {}
+        parents = getattr(container, "parents", None)
+        if parents:
+            data["parents"] = {par: parents[par] for par in PARENT_TYPES}
+        timestamp = getattr(container, "timestamp", None)
+        if timestamp:
+            data["timestamp"] = _to_text(timestamp)
+        files = getattr(container, "files", None)
+        if files:
+            data["files"] = [
+                {
+                    attribute: _to_json(getattr(fl, attribute, None))
+                    for attribute in FILE_ATTRIBUTES
+                }
+                for fl in files
+            ]
+        return (
+            container.id,
+            getattr(container, "container_type", None),
+            container.label,
+            modified_text(container),
+            json.dumps(data),
+        )
+
+    def get(self, container_id):
+        """
+        Retrieve the record of a container.
+
+        Args:
+            container_id (str): Flywheel id of the container.
+
+        Returns:
+            ContainerRecord: The record or None, if the container is not cached.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, container_type, label, modified, data FROM containers "
+                "WHERE id = ?",
+                (container_id,),
+            ).fetchone()
+        return self._record_from_row(row) if row else None
+
+    def put(self, container):
+        """
+        Store a container and return its record.
+
+        Args:
+            container (flywheel.Container): SDK container to store.
+
+        Returns:
+            ContainerRecord: Record of the stored container.
+        """
+        row = self._container_row(container)
+        with self._writing():
+            self._db.execute(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?, ?, ?)", row
+            )
+        record = self._record_from_row(row)
+        record._container = container
+        return record
+
+    def get_children(self, parent_id, child_type):
+        """
+        Retrieve the cached listing of the children of a container.
+
+        Args:
+            parent_id (str): Flywheel id of the parent ("" for the site).
+            child_type (str): Name of the children (e.g. "subjects").
+
+        Returns:
+            list: ContainerRecords in server order or None, if never listed.
+        """
+        with self._lock:
+            listed = self._db.execute(
+                "SELECT listed_at FROM listings WHERE parent_id = ? AND child_type = ?",
+                (parent_id, child_type),
+            ).fetchone()
+            if not listed:
+                return None
+            rows = self._db.execute(
+                "SELECT c.id, c.container_type, c.label, c.modified, c.data "
+                "FROM children ch JOIN containers c ON c.id = ch.child_id "
+                "WHERE ch.parent_id = ? AND ch.child_type = ? ORDER BY ch.position",
+                (parent_id, child_type),
+            ).fetchall()
+        return [self._record_from_row(row) for row in rows]
+
+    def find_in_project(self, project_id, container_types):
+        """
+        Retrieve the cached containers of a project.
+
+        Args:
+            project_id (str): Flywheel id of the project.
+            container_types (list): Types of the containers (e.g. ["session"]).
+
+        Returns:
+            list: ContainerRecords of the containers cached under the project.
+        """
+        placeholders = ", ".join("?" for _ in container_types)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, container_type, label, modified, data FROM containers "
+                f"WHERE container_type IN ({placeholders}) "
+                "AND json_extract(data, '$.parents.project') = ? ORDER BY label",
+                (*container_types, project_id),
+            ).fetchall()
+        return [self._record_from_row(row) for row in rows]
+
+    def listing_age(self, parent_id, child_type):
+        """
+        Seconds since the children of a container were last listed.
+
+        Args:
+            parent_id (str): Flywheel id of the parent ("" for the site).
+            child_type (str): Name of the children (e.g. "subjects").
+
+        Returns:
+            float: Age of the listing in seconds or None, if never listed.
+        """
+        with self._lock:
+            listed = self._db.execute(
+                "SELECT listed_at FROM listings WHERE parent_id = ? AND child_type = ?",
+                (parent_id, child_type),
+            ).fetchone()
+        if not listed:
+            return None
+        listed_at = datetime.datetime.fromisoformat(listed[0])
+        return (datetime.datetime.now() - listed_at).total_seconds()
+
+    def listing_complete(self, parent_id, child_type):
+        """
+        Check if the cached listing of the children of a container is complete.
+
+        Args:
+            parent_id (str): Flywheel id of the parent ("" for the site).
+            child_type (str): Name of the children (e.g. "subjects").
+
+        Returns:
+            bool: True if the listing holds all children, False if more children
+                may be listed from the server.
+        """
+        with self._lock:
+            listed = self._db.execute(
+                "SELECT complete FROM listings WHERE parent_id = ? AND child_type = ?",
+                (parent_id, child_type),
+            ).fetchone()
+        return bool(listed and listed[0])
+
+    def put_listing(self, parent_id, child_type):
+        """
+        Record that the children of a container were listed, without storing them.
+
+        Args:
+            parent_id (str): Flywheel id of the parent.
+            child_type (str): Name of what was listed (e.g. "hierarchy").
+        """
+        with self._writing():
+            self._db.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                (parent_id, child_type, datetime.datetime.now().isoformat(), True),
+            )
+
+    def put_children(self, parent_id, child_type, containers, skip=0, complete=False):
+        """
+        Store a page of the children of a container and return their records.
+
+        The records do not hold the SDK containers, which are fetched again if
+        needed, so that listings of many children stay small in memory.
+
+        Args:
+            parent_id (str): Flywheel id of the parent ("" for the site).
+            child_type (str): Name of the children (e.g. "subjects").
+            containers (list): SDK containers in server order.
+            skip (int, optional): Position of the first container of the page. The
+                previous listing is replaced when storing the first page.
+            complete (bool, optional): The page is the last page of the children.
+
+        Returns:
+            list: ContainerRecords of the stored containers.
+        """
+        rows = [self._container_row(container) for container in containers]
+        with self._writing():
+            if skip == 0:
+                self._db.execute(
+                    "DELETE FROM children WHERE parent_id = ? AND child_type = ?",
+                    (parent_id, child_type),
+                )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO containers VALUES (?, ?, ?, ?, ?)", rows
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO children VALUES (?, ?, ?, ?)",
+                [
+                    (parent_id, child_type, row[0], skip + position)
+                    for position, row in enumerate(rows)
+                ],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO listings VALUES (?, ?, ?, ?)",
+                (parent_id, child_type, datetime.datetime.now().isoformat(), complete),
+            )
+        return [self._record_from_row(row) for row in rows]
+
+    def get_dicom_loadables(self, file_id, version):
+        """
+        Retrieve the DICOM index entry of a version of a file.
+
+        Args:
+            file_id (str): Flywheel id of the DICOM archive.
+            version (int): Version of the file.
+
+        Returns:
+            dict: Series instance UIDs and serialized loadables or None, if the file
+                was never loaded.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM dicom_loadables WHERE file_id = ? AND version = ?",
+                (file_id, _to_text(version)),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put_dicom_loadables(self, file_id, version, entry):
+        """
+        Store the DICOM index entry of a version of a file.
+
+        Args:
+            file_id (str): Flywheel id of the DICOM archive.
+            version (int): Version of the file.
+            entry (dict): Series instance UIDs and serialized loadables (see
+                dicom_index.index_entry).
+        """
+        with self._writing():
+            self._db.execute(
+                "INSERT OR REPLACE INTO dicom_loadables VALUES (?, ?, ?)",
+                (file_id, _to_text(version), json.dumps(entry)),
+            )
+
+    def get_uploads(self, container_id):
+        """
+        Retrieve the digests of the files uploaded to a container from here.
+
+        Args:
+            container_id (str): Flywheel id of the container.
+
+        Returns:
+            dict: sha384 digest of the last upload of each file by name.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT name, sha384 FROM uploads WHERE container_id = ?",
+                (container_id,),
+            ).fetchall()
+        return dict(rows)
+
+    def put_upload(self, container_id, name, sha384):
+        """
+        Record the upload of a file to a container.
+
+        Args:
+            container_id (str): Flywheel id of the container.
+            name (str): Name of the uploaded file.
+            sha384 (str): sha384 digest of the uploaded content.
+        """
+        with self._writing():
+            self._db.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+                (container_id, name, sha384, datetime.datetime.now().isoformat()),
+            )
+
+    def close(self):
+        """
+        Close the database.
+        """
+        with self._lock:
+            self._db.close()
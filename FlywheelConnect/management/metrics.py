@@ -0,0 +1,210 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Maximum number of spans kept in memory, the oldest are dropped first
+MAX_SPANS = 10000
+
+# Counters of the file cache, reported as a hit ratio
+CACHE_HIT = "cache.hit"
+CACHE_MISS = "cache.miss"
+
+# Counters of the in-memory container cache, reported as a hit ratio
+CLIENT_CACHE_HIT = "client_cache.hit"
+CLIENT_CACHE_MISS = "client_cache.miss"
+
+
+def _ratio(counters, hit, miss):
+    """
+    Ratio of hits to lookups.
+
+    Args:
+        counters (dict): Counters by name.
+        hit (str): Name of the hit counter.
+        miss (str): Name of the miss counter.
+
+    Returns:
+        float: Hit ratio or None, without lookups.
+    """
+    hits = counters.get(hit, 0)
+    lookups = hits + counters.get(miss, 0)
+    return hits / lookups if lookups else None
+
+
+class Metrics:
+    """
+    Thread-safe recorder of timed spans and counters.
+
+    A span times one operation (e.g. "api.get", "download") and may carry
+    attributes, such as the "bytes" transferred. A counter counts events (e.g.
+    "cache.hit"). Only the last `max_spans` spans are kept for export, while the
+    totals of each span name are kept for the whole session.
+    """
+
+    def __init__(self, max_spans=MAX_SPANS):
+        """
+        Initialize an empty recorder.
+
+        Args:
+            max_spans (int, optional): Maximum number of spans kept for export.
+        """
+        self._spans = deque(maxlen=max_spans)
+        self._totals = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, **attributes):
+        """
+        Time the operation run in the context.
+
+        The attributes are yielded, so that the operation can add to them (e.g. the
+        number of bytes downloaded). A failed operation is recorded with its
+        "error" before the exception is raised again.
+
+        Args:
+            name (str): Name of the operation (e.g. "api.list.sessions").
+            **attributes: Attributes recorded with the span.
+
+        Yields:
+            dict: Attributes of the span.
+        """
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield attributes
+        except Exception as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            self.record(name, time.perf_counter() - started, start, **attributes)
+
+    def record(self, name, duration, start=None, **attributes):
+        """
+        Record a span timed by the caller.
+
+        Args:
+            name (str): Name of the operation.
+            duration (float): Duration in seconds.
+            start (float, optional): Epoch time at which the operation started.
+            **attributes: Attributes recorded with the span.
+        """
+        if start is None:
+            start = time.time() - duration
+        span = {"name": name, "start": start, "duration": duration}
+        span.update(attributes)
+        with self._lock:
+            self._spans.append(span)
+            totals = self._totals.setdefault(
+                name, {"count": 0, "seconds": 0.0, "max": 0.0, "bytes": 0, "errors": 0}
+            )
+            totals["count"] += 1
+            totals["seconds"] += duration
+            totals["max"] = max(totals["max"], duration)
+            totals["bytes"] += attributes.get("bytes") or 0
+            totals["errors"] += "error" in attributes
+
+    def count(self, name, value=1):
+        """
+        Add to a counter.
+
+        Args:
+            name (str): Name of the counter (e.g. "cache.hit").
+            value (int, optional): Value to add.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        Summarize the spans and counters recorded in the session.
+
+        Returns:
+            dict: "spans" totals by name, with their "mean" duration and the
+                "throughput" in bytes per second of spans with bytes, "counters"
+                by name, the "cache_hit_ratio" of the file cache and the
+                "client_cache_hit_ratio" of the container cache (None without
+                lookups).
+        """
+        with self._lock:
+            spans = {name: dict(totals) for name, totals in self._totals.items()}
+            counters = dict(self._counters)
+        for totals in spans.values():
+            totals["mean"] = totals["seconds"] / totals["count"]
+            if totals["bytes"] and totals["seconds"]:
+                totals["throughput"] = totals["bytes"] / totals["seconds"]
+        return {
+            "spans": spans,
+            "counters": counters,
+            "cache_hit_ratio": _ratio(counters, CACHE_HIT, CACHE_MISS),
+            "client_cache_hit_ratio": _ratio(
+                counters, CLIENT_CACHE_HIT, CLIENT_CACHE_MISS
+            ),
+        }
+
+    def format_summary(self):
+        """
+        Describe the summary as text, one line per span name and counter.
+
+        Returns:
+            str: Summary of the session.
+        """
+        summary = self.summary()
+        lines = []
+        for name, totals in sorted(summary["spans"].items()):
+            line = (
+                f"{name}: {totals['count']} in {totals['seconds']:.2f} s "
+                f"(mean {totals['mean'] * 1000:.0f} ms, "
+                f"max {totals['max'] * 1000:.0f} ms)"
+            )
+            if "throughput" in totals:
+                line += (
+                    f", {totals['bytes'] / 1024 ** 2:.1f} MB "
+                    f"at {totals['throughput'] / 1024 ** 2:.1f} MB/s"
+                )
+            if totals["errors"]:
+                line += f", {totals['errors']} failed"
+            lines.append(line)
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"{name}: {value}")
+        if summary["cache_hit_ratio"] is not None:
+            lines.append(f"cache hit ratio: {summary['cache_hit_ratio']:.0%}")
+        if summary["client_cache_hit_ratio"] is not None:
+            lines.append(
+                f"client cache hit ratio: {summary['client_cache_hit_ratio']:.0%}"
+            )
+        return "\n".join(lines) or "Nothing recorded yet."
+
+    def export(self, file_path):
+        """
+        Write the spans and counters as JSON lines.
+
+        Each line is an object with a "type" of "span" or "counter".
+
+        Args:
+            file_path (str or pathlib.Path): Path of the file to write.
+        """
+        with self._lock:
+            spans = list(self._spans)
+            counters = dict(self._counters)
+        with open(file_path, "w") as fp:
+            for span in spans:
+                fp.write(json.dumps({"type": "span", **span}, default=str) + "\n")
+            for name, value in sorted(counters.items()):
+                record = {"type": "counter", "name": name, "value": value}
+                fp.write(json.dumps(record) + "\n")
+
+    def clear(self):
+        """
+        Remove all spans and counters.
+        """
+        with self._lock:
+            self._spans.clear()
+            self._totals.clear()
+            self._counters.clear()
+
+
+# Recorder shared by the module
+METRICS = Metrics()
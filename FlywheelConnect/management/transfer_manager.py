@@ -0,0 +1,180 @@
+import concurrent.futures
+import functools
+import os
+import time
+from pathlib import Path
+
+from .file_cache import hash_file
+from .metrics import METRICS
+
+# Default number of concurrent transfers
+DEFAULT_MAX_WORKERS = 4
+
+# Number of retries of a failed upload
+MAX_RETRIES = 3
+
+# Seconds to wait before the first retry, doubled on each retry
+BACKOFF = 1.0
+
+
+def _is_retryable(error):
+    """
+    Check if a failed transfer may succeed on retry.
+
+    Args:
+        error (Exception): Error raised by the transfer.
+
+    Returns:
+        bool: False for client errors (e.g. 403, 409), which fail again on retry.
+    """
+    status = getattr(error, "status", None)
+    return not (isinstance(status, int) and 400 <= status < 500 and status != 429)
+
+
+class TransferManager:
+    """
+    Schedule transfer tasks on a bounded pool of worker threads.
+
+    Tasks run concurrently in the worker threads while the calling (GUI) thread
+    collects their results in completion order. Tasks must not touch Qt objects.
+    """
+
+    def __init__(self, max_workers=DEFAULT_MAX_WORKERS, poll_interval=0.1):
+        """
+        Initialize the transfer manager.
+
+        Args:
+            max_workers (int, optional): Maximum number of concurrent transfers.
+            poll_interval (float, optional): Seconds to wait for a task to complete
+                before calling the idle callback again.
+        """
+        self.max_workers = max(1, int(max_workers))
+        self.poll_interval = poll_interval
+
+    def run(self, tasks, idle_callback=None):
+        """
+        Run all tasks concurrently and yield their results as they complete.
+
+        Args:
+            tasks (iterable): (key, callable) tuples. Each callable is run in a
+                worker thread without arguments.
+            idle_callback (callable, optional): Called on the calling thread while
+                waiting for tasks to complete (e.g. to process GUI events).
+
+        Yields:
+            tuple: (key, result) in completion order. Exceptions raised by a task are
+                re-raised when its result is yielded.
+        """
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.max_workers
+        ) as executor:
+            pending = {executor.submit(task): key for key, task in tasks}
+            try:
+                while pending:
+                    done, _ = concurrent.futures.wait(
+                        pending,
+                        timeout=self.poll_interval,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
+                    for future in done:
+                        key = pending.pop(future)
+                        yield key, future.result()
+                    if idle_callback:
+                        idle_callback()
+            finally:
+                # Do not start queued transfers if the consumer stopped early
+                for future in pending:
+                    future.cancel()
+
+
+class UploadManager(TransferManager):
+    """
+    Upload files to a Flywheel container concurrently, retrying failed uploads.
+    """
+
+    def __init__(
+        self,
+        max_workers=DEFAULT_MAX_WORKERS,
+        poll_interval=0.1,
+        max_retries=MAX_RETRIES,
+        backoff=BACKOFF,
+    ):
+        """
+        Initialize the upload manager.
+
+        Args:
+            max_workers (int, optional): Maximum number of concurrent uploads.
+            poll_interval (float, optional): Seconds to wait for an upload to
+                complete before calling the idle callback again.
+            max_retries (int, optional): Number of retries of a failed upload.
+            backoff (float, optional): Seconds to wait before the first retry.
+        """
+        super().__init__(max_workers, poll_interval)
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+    def _upload_file(self, container, file_path, known_hashes=None):
+        """
+        Upload a file, retrying with exponential backoff. Runs in a worker thread.
+
+        With known hashes, the file is hashed first and not uploaded if a file of
+        the same name and content already exists in the container. A file of the
+        same name with a different content is uploaded as a new version.
+
+        Args:
+            container (flywheel.Container): Container to upload the file to.
+            file_path (str): Path of the file.
+            known_hashes (dict, optional): sha384 digests of the files in the
+                container by name.
+
+        Returns:
+            dict: "sha384" digest of the file (if hashed), "uploaded" flag and
+                "error" of the last attempt (None, if the upload succeeded).
+        """
+        result = {"sha384": None, "uploaded": False, "error": None}
+        if known_hashes is not None:
+            try:
+                result["sha384"] = hash_file(file_path)
+            except OSError as e:
+                result["error"] = e
+                return result
+            if known_hashes.get(Path(file_path).name) == result["sha384"]:
+                return result
+        for attempt in range(self.max_retries + 1):
+            try:
+                with METRICS.span("upload", bytes=os.path.getsize(file_path)):
+                    container.upload_file(str(file_path))
+                result["uploaded"] = True
+                return result
+            except Exception as e:
+                if attempt == self.max_retries or not _is_retryable(e):
+                    result["error"] = e
+                    return result
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def upload(self, container, file_paths, idle_callback=None, known_hashes=None):
+        """
+        Upload files to a container and yield them in completion order.
+
+        A failed upload does not stop the other uploads.
+
+        Args:
+            container (flywheel.Container): Container to upload the files to.
+            file_paths (list): Paths of the files.
+            idle_callback (callable, optional): Called while waiting on uploads.
+            known_hashes (dict, optional): sha384 digests of the files in the
+                container by name. Unchanged files are skipped.
+
+        Yields:
+            tuple: (file_path, result) for each file (see _upload_file).
+        """
+        tasks = [
+            (
+                file_path,
+                functools.partial(
+                    self._upload_file, container, file_path, known_hashes
+                ),
+            )
+            for file_path in file_paths
+        ]
+        yield from self.run(tasks, idle_callback)
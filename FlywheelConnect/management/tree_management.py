@@ -1,15 +1,90 @@
+import threading
+from contextlib import contextmanager
+
+import slicer
 from PythonQt import QtGui
-from PythonQt.QtCore import Qt
-from qt import QAbstractItemView, QItemSelectionModel, QMenu
+from PythonQt.QtCore import QModelIndex, Qt
+from qt import QAbstractItemView, QApplication, QItemSelectionModel, QMenu
 
+from .child_loader import FRESH_FOR, BackgroundTask, ChildLoader, LoadMoreItem
 from .fw_container_items import (
     AnalysisFolderItem,
+    AcquisitionItem,
     AnalysisItem,
     ContainerItem,
     FileItem,
     GroupItem,
     ProjectItem,
+    SessionItem,
+    SubjectItem,
 )
+from .hierarchy_prefetch import HIERARCHY_LISTING, prefetch_project
+from .tree_search import search
+
+# Tree item class of each level of the search results
+SEARCH_ITEM_CLASSES = {
+    "subject": SubjectItem,
+    "session": SessionItem,
+    "acquisition": AcquisitionItem,
+}
+
+
+class TreeModel(QtGui.QStandardItemModel):
+    """
+    Item model of the tree, giving tree items access to the tree management.
+
+    Container items are a single row until expanded: the model reports children
+    for them, so that the view draws an expander, and creates their folders when
+    the view fetches their rows (see ContainerItem.create_folders).
+    """
+
+    def __init__(self, tree_management):
+        """
+        Initialize the model of a tree.
+
+        Args:
+            tree_management (TreeManagement): Tree management owning the model.
+        """
+        super(TreeModel, self).__init__()
+        self.tree_management = tree_management
+
+    def _unfolded_item(self, parent):
+        """
+        Retrieve the container item of an index whose folders are not created yet.
+
+        Args:
+            parent (QtCore.QModelIndex): Index of the item.
+
+        Returns:
+            ContainerItem: The item or None.
+        """
+        if not parent.isValid():
+            return None
+        item = self.itemFromIndex(parent)
+        if (
+            isinstance(item, ContainerItem)
+            and not item.hasChildren()
+            and item.has_folders()
+        ):
+            return item
+        return None
+
+    def hasChildren(self, parent=QModelIndex()):
+        if self._unfolded_item(parent):
+            return True
+        return QtGui.QStandardItemModel.hasChildren(self, parent)
+
+    def canFetchMore(self, parent):
+        if self._unfolded_item(parent):
+            return True
+        return QtGui.QStandardItemModel.canFetchMore(self, parent)
+
+    def fetchMore(self, parent):
+        item = self._unfolded_item(parent)
+        if item:
+            item.create_folders()
+        else:
+            QtGui.QStandardItemModel.fetchMore(self, parent)
 
 
 class TreeManagement:
@@ -26,7 +101,13 @@ class TreeManagement:
         """
         self.main_window = main_window
         self.treeView = self.main_window.treeView
-        self.cache_files = {}
+        self.metadata_cache = None
+        self.file_cache = None
+        # Module logic fetching the files of the tree
+        self.logic = None
+        self.prefetch_task = None
+        self._prefetch_cancelled = threading.Event()
+        self.search_task = None
         tree = self.treeView
         # https://doc.qt.io/archives/qt-4.8/qabstractitemview.html
         tree.selectionMode = QAbstractItemView.ExtendedSelection
@@ -34,10 +115,11 @@ class TreeManagement:
         tree.clicked.connect(self.tree_clicked)
         tree.doubleClicked.connect(self.tree_dblclicked)
         tree.expanded.connect(self.on_expanded)
+        tree.collapsed.connect(self.on_collapsed)
 
         tree.setContextMenuPolicy(Qt.CustomContextMenu)
         tree.customContextMenuRequested.connect(self.open_menu)
-        self.source_model = QtGui.QStandardItemModel()
+        self.source_model = TreeModel(self)
         tree.setModel(self.source_model)
         self.selection_model = QItemSelectionModel(self.source_model)
         tree.setSelectionModel(self.selection_model)
@@ -60,7 +142,7 @@ class TreeManagement:
             index (QtCore.QModelIndex): Index of tree node double clicked.
         """
         item = self.get_id(index)
-        if isinstance(item, AnalysisFolderItem):
+        if isinstance(item, (AnalysisFolderItem, LoadMoreItem)):
             item._dblclicked()
 
     def populateTree(self):
@@ -68,14 +150,198 @@ class TreeManagement:
         Populate the tree starting with groups
         """
         groups = self.main_window.fw_client.groups()
-        for group in groups:
-            group_item = GroupItem(self.source_model, group)
+        group_items = [GroupItem(self.source_model, group) for group in groups]
+        self.source_model.invisibleRootItem().appendRows(group_items)
 
-    def populateTreeFromProject(self, project):
+    def populateTreeFromProject(self, project, prefetch=False):
         """
         Populate Tree from a single Project
+
+        Args:
+            project (flywheel.Project or ContainerRecord): Project at the tree root.
+            prefetch (bool, optional): Prefetch the whole hierarchy of the project
+                into the metadata cache in the background.
+
+        Returns:
+            ProjectItem: Root node of the tree.
+        """
+        project_item = ProjectItem(self.source_model, project)
+        self.source_model.appendRow(project_item)
+        if prefetch and self.metadata_cache:
+            self.prefetch_hierarchy(project)
+        return project_item
+
+    def prefetch_hierarchy(self, project):
+        """
+        Prefetch the subjects, sessions, acquisitions and files of a project.
+
+        The hierarchy is listed with a few project-wide queries in the background
+        and stored in the metadata cache, from which tree nodes are then drawn on
+        expansion without further requests.
+
+        Args:
+            project (flywheel.Project or ContainerRecord): Project to prefetch.
+        """
+        self.cancel_prefetch()
+        cancelled = threading.Event()
+        self._prefetch_cancelled = cancelled
+        fw_client = self.main_window.fw_client
+        metadata_cache = self.metadata_cache
+        self.prefetch_task = BackgroundTask(
+            lambda: prefetch_project(
+                fw_client, metadata_cache, project, cancelled=cancelled
+            ),
+            self._prefetch_finished,
+            self._prefetch_failed,
+        )
+        self.prefetch_task.start()
+
+    def _prefetch_finished(self, counts):
+        """
+        Forget the finished prefetch task.
+
+        The number of prefetched containers is reported in the metrics panel
+        ("prefetch.<child type>" counters).
+
+        Args:
+            counts (dict): Number of containers stored by child type.
+        """
+        self.prefetch_task = None
+
+    def _prefetch_failed(self, error):
+        """
+        Forget the failed prefetch task and report the error.
+
+        Listings not prefetched are still listed on expansion.
+
+        Args:
+            error (Exception): Error of the prefetch.
+        """
+        self.prefetch_task = None
+        slicer.util.errorDisplay(f"Failed to prefetch the project: {error}")
+
+    def cancel_prefetch(self):
+        """
+        Stop prefetching the hierarchy of the current project.
+        """
+        self._prefetch_cancelled.set()
+        if self.prefetch_task:
+            self.prefetch_task.cancel()
+            self.prefetch_task = None
+
+    def clear_tree(self):
+        """
+        Cancel any background listing and remove all rows from the tree.
+        """
+        self.cancel_prefetch()
+        self.cancel_search()
+        self._remove_rows()
+
+    def _remove_rows(self):
+        """
+        Cancel the listing of child containers and remove all rows from the tree.
+        """
+        ChildLoader.cancel_all()
+        tree_rows = self.source_model.rowCount()
+        if tree_rows > 0:
+            self.source_model.removeRows(0, tree_rows)
+
+    def search(self, project, criteria):
+        """
+        Search a project and show only the paths to the matching containers.
+
+        Matches are first searched in the metadata cache and shown. Unless the
+        hierarchy of the project was prefetched recently, they are then searched
+        with server-side filtered requests in the background and shown again.
+
+        Args:
+            project (flywheel.Project or ContainerRecord): Project to search.
+            criteria (dict): Value searched by field (see tree_search.parse_query).
+        """
+        self.cancel_search()
+        fw_client = self.main_window.fw_client
+        metadata_cache = self.metadata_cache
+        age = metadata_cache.listing_age(project.id, HIERARCHY_LISTING)
+        prefetched = age is not None and age < FRESH_FOR
+
+        def search_server(local_paths):
+            self.show_search_results(project, local_paths)
+            if prefetched:
+                self.search_task = None
+                return
+            self.search_task = BackgroundTask(
+                lambda: search(fw_client, metadata_cache, project.id, criteria, False),
+                lambda paths: self.show_search_results(project, paths),
+                self._search_failed,
+            )
+            self.search_task.start()
+
+        self.search_task = BackgroundTask(
+            lambda: search(fw_client, metadata_cache, project.id, criteria, True),
+            search_server,
+            self._search_failed,
+        )
+        self.search_task.start()
+
+    def _search_failed(self, error):
+        """
+        Forget the failed search task and report the error.
+
+        Args:
+            error (Exception): Error of the search.
+        """
+        self.search_task = None
+        slicer.util.errorDisplay(f"Search failed: {error}")
+
+    def cancel_search(self):
+        """
+        Drop the results of a running search.
+        """
+        if self.search_task:
+            self.search_task.cancel()
+            self.search_task = None
+
+    def show_search_results(self, project, paths):
+        """
+        Show the project with only the paths to search results.
+
+        Folders on the paths hold only the matching branches, so that they are not
+        listed on expansion. Below the matches, the tree is listed as usual.
+
+        Args:
+            project (flywheel.Project or ContainerRecord): Project searched.
+            paths (list): Paths to the matches as lists of records, from the subject
+                level down (see tree_search.resolve_paths).
         """
+        self._remove_rows()
         project_item = ProjectItem(self.source_model, project)
+        self.source_model.appendRow(project_item)
+        project_item.create_folders()
+        if not paths:
+            no_match = QtGui.QStandardItem("No matches")
+            no_match.setEnabled(False)
+            no_match.setSelectable(False)
+            project_item.folderItem.appendRow(no_match)
+
+        items = {}
+        expanded = [project_item]
+        for path in paths:
+            parent_item = project_item
+            for container in path:
+                item = items.get(container.id)
+                if item is None:
+                    parent_item.create_folders()
+                    item_class = SEARCH_ITEM_CLASSES[container.container_type]
+                    item = item_class(parent_item.folderItem, container)
+                    parent_item.folderItem.appendRow(item)
+                    items[container.id] = item
+                    if container is not path[-1]:
+                        expanded.append(item)
+                parent_item = item
+
+        for item in expanded:
+            self.treeView.expand(self.source_model.indexFromItem(item))
+            self.treeView.expand(self.source_model.indexFromItem(item.folderItem))
 
     def get_id(self, index):
         """
@@ -143,18 +409,83 @@ class TreeManagement:
         self.main_window.uploadFilesButton.enabled = upload_enabled
         self.main_window.asAnalysisCheck.enabled = upload_enabled
 
+    @contextmanager
+    def transferring(self):
+        """
+        Disable the tree and the controls rebuilding it while files are transferred.
+
+        Events are processed during transfers, so the tree could otherwise be
+        cleared or rebuilt under the running jobs.
+        """
+        main_window = self.main_window
+        controls = [
+            main_window.connectAPIButton,
+            main_window.groupSelector,
+            main_window.projectSelector,
+            main_window.searchLineEdit,
+            self.treeView,
+            main_window.loadFilesButton,
+            main_window.uploadFilesButton,
+        ]
+        enabled = [control.enabled for control in controls]
+        for control in controls:
+            control.enabled = False
+        try:
+            yield
+        finally:
+            for control, was_enabled in zip(controls, enabled):
+                control.enabled = was_enabled
+            self.on_selection_changed()
+
+    def _file_items(self, file_id):
+        """
+        Find the tree nodes of a file, looked up again after a transfer.
+
+        Background revalidations may have rebuilt the nodes in the meantime.
+
+        Args:
+            file_id (str): Flywheel id of the file.
+
+        Returns:
+            list: FileItem objects of the file in the tree.
+        """
+        if not self.source_model.rowCount():
+            return []
+        indexes = self.source_model.match(
+            self.source_model.index(0, 0),
+            Qt.UserRole + 1,
+            file_id,
+            -1,
+            Qt.MatchRecursive,
+        )
+        items = [self.source_model.itemFromIndex(index) for index in indexes]
+        return [item for item in items if isinstance(item, FileItem)]
+
+    def _selected_file_items(self):
+        """
+        Retrieve the file items selected in the tree.
+
+        Returns:
+            list: Selected FileItem objects.
+        """
+        file_items = []
+        for index in self.treeView.selectedIndexes():
+            item = self.source_model.itemFromIndex(index)
+            if isinstance(item, FileItem):
+                file_items.append(item)
+        return file_items
+
     def _cache_selected(self):
         """
-        Cache selected files to local directory,
+        Cache selected files to local directory, reporting the failed downloads.
         """
-        # TODO: Acknowledge this is for files only or change for all files of selected
-        #       Acquisitions.
-        indexes = self.treeView.selectedIndexes()
-        if len(indexes) > 0:
-            for index in indexes:
-                item = self.source_model.itemFromIndex(index)
-                if isinstance(item, FileItem):
-                    item._add_to_cache()
+        failed = []
+        with self.transferring():
+            for job in self.cache_selected_for_open(extract=False):
+                if "file_path" not in job:
+                    failed.append(f"{job['file'].name}: {job.get('error')}")
+        if failed:
+            slicer.util.errorDisplay("Failed to cache:\n" + "\n".join(failed))
 
     def on_expanded(self, index):
         """
@@ -170,19 +501,45 @@ class TreeManagement:
         if hasattr(item, "_on_expand"):
             item._on_expand()
 
-    def cache_selected_for_open(self):
+    def on_collapsed(self, index):
         """
-        Cache selected files if necessary for opening in application.
+        Triggered on the collapse of any tree node.
+
+        Cancels the background listing of the subtree, if it is still running.
+
+        Args:
+            index (QtCore.QModelIndex): Index of collapsed tree node.
         """
-        tree = self.treeView
-        self.cache_files.clear()
-        for index in tree.selectedIndexes():
-            file_path = self.main_window.CacheDir
-            item = self.source_model.itemFromIndex(index)
-            if isinstance(item, FileItem):
-                file_path, file_type = item._add_to_cache()
+        item = self.source_model.itemFromIndex(index)
+        if hasattr(item, "_on_collapse"):
+            item._on_collapse()
 
-                self.cache_files[item.container.id] = {
-                    "file_path": str(file_path),
-                    "file_type": file_type,
-                }
+    def cache_selected_for_open(self, extract=True):
+        """
+        Cache selected files if necessary for opening in application.
+
+        Files are fetched by the module logic (see flywheel_connectLogic.fetch_files),
+        each cached file being yielded while later downloads are still running.
+        Jobs do not hold tree nodes: the nodes of each cached file are looked up
+        again by file id.
+
+        Args:
+            extract (bool, optional): Extract the DICOM archives of the files.
+
+        Yields:
+            dict: Jobs with the "parent", "file", "file_path", "file_type" and
+                "dicom_dir" of each cached file, in completion order. Failed jobs
+                have their "error" set.
+        """
+        files = [
+            (item.parent_item.parent_item.container, item.file)
+            for item in self._selected_file_items()
+        ]
+        self.logic.download_workers = self.main_window.downloadWorkersSpinBox.value
+        for job in self.logic.fetch_files(
+            files, idle_callback=QApplication.processEvents, extract=extract
+        ):
+            if "file_path" in job:
+                for item in self._file_items(job["file"].id):
+                    item._set_cached()
+            yield job
@@ -0,0 +1,298 @@
+import datetime
+import re
+from collections import defaultdict
+
+from .child_loader import SORT_ORDER
+from .metadata_cache import ContainerRecord
+from .metrics import METRICS
+
+# Fields of a search query, with the level of the hierarchy they match (None for
+# any level)
+SEARCH_FIELDS = {
+    "label": None,
+    "subject": "subject",
+    "date": "session",
+    "modality": "acquisition",
+    "type": "acquisition",
+}
+
+# Levels of the hierarchy under a project, from the top
+LEVELS = ["subject", "session", "acquisition"]
+
+# Number of containers requested per page of a server-side query
+SEARCH_PAGE_SIZE = 500
+
+
+def parse_query(text):
+    """
+    Parse a search query made of field:value terms.
+
+    Terms without a field match labels (e.g. "T1 subject:001 date:2020-01-31").
+
+    Args:
+        text (str): Search query.
+
+    Returns:
+        dict: Value searched by field.
+
+    Raises:
+        ValueError: For an unknown field, an invalid date or a comma in a value.
+    """
+    criteria = {}
+    for term in text.split():
+        field, sep, value = term.partition(":")
+        if not sep:
+            field, value = "label", term
+        field = field.lower()
+        if field not in SEARCH_FIELDS:
+            raise ValueError(f"Unknown search field: {field}")
+        if "," in value:
+            raise ValueError(f"Search values can not contain commas: {value}")
+        if field == "date":
+            datetime.date.fromisoformat(value)
+        if field == "label" and field in criteria:
+            value = f"{criteria[field]} {value}"
+        if value:
+            criteria[field] = value
+    return criteria
+
+
+def _matches(container, field, value):
+    """
+    Check a container against a search criterion.
+
+    Args:
+        container (flywheel.Container or ContainerRecord): Container to check.
+        field (str): Searched field (see SEARCH_FIELDS).
+        value (str): Searched value.
+
+    Returns:
+        bool: True if the container matches.
+    """
+    container_type = getattr(container, "container_type", None)
+    if SEARCH_FIELDS[field] and container_type != SEARCH_FIELDS[field]:
+        return False
+    if field in ["label", "subject"]:
+        return value.lower() in (container.label or "").lower()
+    if field == "date":
+        timestamp = getattr(container, "timestamp", None)
+        return str(timestamp or "")[:10] == value
+    return any(
+        str(getattr(fl, field, None) or "").lower() == value.lower()
+        for fl in container.files or []
+    )
+
+
+def _lineage(container):
+    """
+    Ids of a container and of its parents.
+
+    Args:
+        container (flywheel.Container or ContainerRecord): Container.
+
+    Returns:
+        set: Flywheel ids.
+    """
+    return {container.id} | {par for par in container.parents.values() if par}
+
+
+def combine(criteria, candidates):
+    """
+    Select the containers matching all criteria along their branch.
+
+    A criterion is met by a container if it, one of its parents or one of its
+    candidate descendants matches it. Only the deepest containers meeting all
+    criteria are kept, their parents being shown on their path.
+
+    Args:
+        criteria (dict): Value searched by field.
+        candidates (dict): Containers matching each field.
+
+    Returns:
+        list: Matching containers.
+    """
+    ids = {
+        field: {container.id for container in containers}
+        for field, containers in candidates.items()
+    }
+    pool = {}
+    for containers in candidates.values():
+        for container in containers:
+            pool[container.id] = container
+    descendants = defaultdict(set)
+    for container in pool.values():
+        for parent_id in _lineage(container) - {container.id}:
+            descendants[parent_id].add(container.id)
+
+    kept = [
+        container
+        for container in pool.values()
+        if all(
+            ids.get(field, set()) & (_lineage(container) | descendants[container.id])
+            for field in criteria
+        )
+    ]
+    kept_ids = {container.id for container in kept}
+    return [
+        container for container in kept if not descendants[container.id] & kept_ids
+    ]
+
+
+def search_local(metadata_cache, project_id, criteria):
+    """
+    Search the containers of a project in the metadata cache.
+
+    Args:
+        metadata_cache (MetadataCache): Cache to search.
+        project_id (str): Flywheel id of the project.
+        criteria (dict): Value searched by field.
+
+    Returns:
+        list: Matching ContainerRecords.
+    """
+    containers = metadata_cache.find_in_project(project_id, LEVELS)
+    candidates = {
+        field: [c for c in containers if _matches(c, field, value)]
+        for field, value in criteria.items()
+    }
+    return combine(criteria, candidates)
+
+
+def _server_filters(field, value):
+    """
+    Server-side filters of a search criterion.
+
+    Args:
+        field (str): Searched field (see SEARCH_FIELDS).
+        value (str): Searched value.
+
+    Returns:
+        list: (finder name, filter) tuples.
+    """
+    if field == "label":
+        return [(f"{level}s", f"label=~{re.escape(value)}") for level in LEVELS]
+    if field == "subject":
+        return [("subjects", f"label=~{re.escape(value)}")]
+    if field == "date":
+        day = datetime.date.fromisoformat(value)
+        next_day = day + datetime.timedelta(days=1)
+        return [("sessions", f"timestamp>={day},timestamp<{next_day}")]
+    return [("acquisitions", f"files.{field}={value}")]
+
+
+def _find_pages(finder, filter_string, page_size, name):
+    """
+    List all containers matching a server-side filter, one page at a time.
+
+    Args:
+        finder (flywheel.Finder): Site-wide finder of the containers (e.g.
+            client.sessions).
+        filter_string (str): Filter of the containers.
+        page_size (int): Number of containers requested per page.
+        name (str): Name of the containers in the recorded metrics.
+
+    Returns:
+        list: Matching containers, sorted by label.
+    """
+    containers = []
+    while True:
+        with METRICS.span(f"api.search.{name}") as span:
+            page = finder.find(
+                filter_string,
+                sort=SORT_ORDER,
+                limit=page_size,
+                skip=len(containers),
+            )
+            span["containers"] = len(page)
+        containers.extend(page)
+        if len(page) < page_size:
+            return containers
+
+
+def search_server(client, project_id, criteria, page_size=SEARCH_PAGE_SIZE):
+    """
+    Search the containers of a project with server-side filtered requests.
+
+    Args:
+        client (flywheel.Client): Client to search with.
+        project_id (str): Flywheel id of the project.
+        criteria (dict): Value searched by field.
+        page_size (int, optional): Number of containers requested per page. All
+            pages of each query are listed.
+
+    Returns:
+        list: Matching SDK containers.
+    """
+    candidates = {}
+    for field, value in criteria.items():
+        found = []
+        for finder_name, filter_string in _server_filters(field, value):
+            found.extend(
+                _find_pages(
+                    getattr(client, finder_name),
+                    f"parents.project={project_id},{filter_string}",
+                    page_size,
+                    finder_name,
+                )
+            )
+        # Match case-insensitively, as in the metadata cache
+        candidates[field] = [c for c in found if _matches(c, field, value)]
+    return combine(criteria, candidates)
+
+
+def resolve_paths(client, metadata_cache, matches):
+    """
+    Resolve the path of each match from the subject level down.
+
+    Matches and parents are stored in, or read from, the metadata cache.
+
+    Args:
+        client (flywheel.Client): Client to fetch uncached parents with.
+        metadata_cache (MetadataCache): Cache of the container records.
+        matches (list): Matching containers or records.
+
+    Returns:
+        list: Paths as lists of ContainerRecords, sorted by labels.
+    """
+    records = {}
+
+    def record(container_id):
+        if container_id not in records:
+            records[container_id] = metadata_cache.get(
+                container_id
+            ) or metadata_cache.put(client.get(container_id))
+        return records[container_id]
+
+    paths = []
+    for match in matches:
+        depth = LEVELS.index(match.container_type)
+        path = [
+            record(match.parents[level])
+            for level in LEVELS[:depth]
+            if match.parents.get(level)
+        ]
+        if not isinstance(match, ContainerRecord):
+            match = metadata_cache.put(match)
+        paths.append(path + [match])
+    return sorted(paths, key=lambda path: [c.label for c in path])
+
+
+def search(client, metadata_cache, project_id, criteria, local):
+    """
+    Search a project and resolve the paths of the matches. Runs in a worker thread.
+
+    Args:
+        client (flywheel.Client): Client to search with.
+        metadata_cache (MetadataCache): Cache of the container records.
+        project_id (str): Flywheel id of the project.
+        criteria (dict): Value searched by field.
+        local (bool): Search the metadata cache instead of the server.
+
+    Returns:
+        list: Paths to the matches (see resolve_paths).
+    """
+    if local:
+        matches = search_local(metadata_cache, project_id, criteria)
+    else:
+        matches = search_server(client, project_id, criteria)
+    return resolve_paths(client, metadata_cache, matches)